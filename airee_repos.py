@@ -10,22 +10,55 @@ It use mainly github and cookiecutter frameworks.
     repo1_obj = repo1.create_empty_repo_gh("infra")
     repo1.delete_repo(repo1_obj)
 """
-from github import Github
 from github.GithubException import GithubException
-import pygit2
-from pair_key import PairKey
-import config, util
-from cookiecutter.main import cookiecutter
+from github.InputGitAuthor import InputGitAuthor
+from pair_key import PairKey, KeyPool
+from template_cache import TemplateCache
+import template_render
+import config, util, gh_client, metrics
 from os.path import join as path_join 
+from concurrent.futures import ThreadPoolExecutor
+from retry import retry
+import hashlib
+import json
+import os
 import sys
 import logging
-from retry import retry
+import threading
 
 logger = logging.getLogger(__name__)
 logger.setLevel(config.log_lvl)
 logger.addHandler(config.ch)
 logger.propagate = False
 
+# cookiecutter with Jinja2 is needed only to render templates
+cookiecutter_main = util.lazy_import('cookiecutter.main')
+
+# cookiecutter renders files inside os.chdir() to the template directory,
+# working directory is shared by all threads so rendering must be serialized
+_cookiecutter_lock = threading.Lock()
+
+# file with template commit and context of repository, it's used by upgrade
+TEMPLATE_METADATA = '.airee/template.json'
+
+
+def template_metadata(template, commit, checkout, extra_context):
+    """Return bytes with content of TEMPLATE_METADATA file.
+
+    Args:
+        template: string name of template repository, e.g. from config.template
+        commit: string sha of template commit which repository was rendered from
+        checkout: string branch or tag of template
+        extra_context: dict with cookiecutter context of repository
+    """
+    metadata = {'template': template, 'commit': commit, 'checkout': checkout, 'context': extra_context}
+    return (json.dumps(metadata, indent=2, sort_keys=True) + '\n').encode()
+
+
+# organization secrets written by this process, value is written once and later only repositories are added
+_org_secrets = set()
+_org_secrets_lock = threading.Lock()
+
 class Airee_gh_repo:
     """Airee GitHub organization connector.
 
@@ -42,15 +75,23 @@ class Airee_gh_repo:
         token: string value of PAT
         gh: GitHub class object
         gh_org: GitHub Organization object
+        template_cache: TemplateCache object with local copies of templates
+        key_pool: KeyPool object with pre-generated deploy keys, keys are generated inline if None
     """
-    def __init__(self, token, workspace, org='DsAirKube', env='prd') -> None:
-        """Create Airee_gh_repo object."""
+    def __init__(self, token, workspace, org='DsAirKube', env='prd', template_cache=None, gh_org=None, key_pool=None) -> None:
+        """Create Airee_gh_repo object.
+
+        GitHub client is shared by all objects using the same token. Organization
+        object can be passed to skip its lookup, e.g. when many workspaces are provisioned.
+        """
         self.workspace = workspace
         self.env = env
         self.org = org
         self.token = token
-        self.gh = Github(token)
-        self.gh_org = self.__set_org()
+        self.template_cache = template_cache if template_cache else TemplateCache()
+        self.key_pool = key_pool
+        self.gh = gh_client.get_github(token)
+        self.gh_org = gh_org if gh_org else self.__set_org()
         logger.debug("Airee Obj created")
 
     def __set_org(self):
@@ -59,6 +100,21 @@ class Airee_gh_repo:
         logger.debug(f"Organization set to {self.org}")
         return org_obj
 
+    def for_workspace(self, workspace, env=None):
+        """Return new object for other workspace sharing GitHub client, organization, template cache and key pool.
+
+        Args:
+            workspace: string with name of Ariee workspace
+            env: string with environment, default the same as in this object
+        Returns:
+            Airee_gh_repo object.
+        """
+        return Airee_gh_repo(self.token, workspace, org=self.org, env=env if env else self.env, template_cache=self.template_cache, gh_org=self.gh_org, key_pool=self.key_pool)
+
+    def fork(self):
+        """Return new object for the same workspace, e.g. to be used by other thread."""
+        return self.for_workspace(self.workspace)
+
     def repo_naming(self, type):
         """Return name in order to naming convention.
         
@@ -70,11 +126,13 @@ class Airee_gh_repo:
         """
         return f'{self.workspace}_{type}_{self.env}'
 
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
+    @metrics.timed('create_repo')
+    @retry(gh_client.CONNECTION_ERRORS, tries=2, delay=20, backoff=2, logger=metrics.retry_logger(logger, 'create_repo'))
     def create_repo(self, name, private=True, **kwargs):
         """Method to create git repository in GitHub.
         
         If name already exist, program is exit with 1.
+        If connection is lost, request is repeated unless repository was created.
 
         Args:
             name: string with name of repository
@@ -88,6 +146,13 @@ class Airee_gh_repo:
             repo_obj = self.gh_org.create_repo(name, private=private, **kwargs)
             logger.debug(f"Repositoy {name} created in {self.org}")
             logger.debug(f"Repositoy url: {repo_obj.git_url}")
+        except gh_client.CONNECTION_ERRORS as e:
+            # repository could be created before connection was lost, it's looked up before request is repeated
+            try:
+                repo_obj = self.gh_org.get_repo(name)
+            except GithubException:
+                raise e
+            logger.warning(f"Repository {name} was created before connection was lost")
         except GithubException as e:
             if e.status==422 and (any(mesg.get('message')=='name already exists on this account' for mesg in e.data.get('errors', []))):
                 logger.error(f"Repository name {name} already exist in {self.org}")
@@ -96,7 +161,6 @@ class Airee_gh_repo:
                 raise e
         return repo_obj
 
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
     def create_empty_repo_gh(self, type):
         """Create GitHub repository using Airee naming convention.
 
@@ -108,7 +172,6 @@ class Airee_gh_repo:
         name = self.repo_naming(type)
         return self.create_repo(name)
     
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
     def get_airee_repo(self, type):
         """Get GitHub repository object by Airee type.
         
@@ -120,7 +183,11 @@ class Airee_gh_repo:
         name = self.repo_naming(type)
         return self.gh_org.get_repo(name)
 
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
+    def git_token(self):
+        """Return token for git over HTTPS, GitHub App installation token or PAT, shared by process."""
+        return gh_client.git_tokens.get(self.token, self.org)
+
+    @metrics.timed('set_deploy_key')
     def set_deploy_key(self, name, repo_obj, read_only=True):
         """Method to set deploy_key on repository.
         
@@ -131,26 +198,40 @@ class Airee_gh_repo:
         Returns:
             Method return priv, pub keys and GH key object
         """
-        priv_key, pub_key = PairKey.generate_pair_ecdsa()
-        key_obj = repo_obj.create_key(name, pub_key.decode(), read_only)
+        priv_key, pub_key = self.key_pool.get('ecdsa') if self.key_pool else PairKey.generate_pair_ecdsa()
+        key_obj = self.__create_key(repo_obj, name, pub_key.decode(), read_only)
         return priv_key, pub_key, key_obj
+
+    @retry(gh_client.CONNECTION_ERRORS, tries=2, delay=20, backoff=2, logger=metrics.retry_logger(logger, 'set_deploy_key'))
+    def __create_key(self, repo_obj, name, pub_key, read_only):
+        """Create deploy key, if connection is lost key is looked up before request is repeated."""
+        try:
+            return repo_obj.create_key(name, pub_key, read_only)
+        except gh_client.CONNECTION_ERRORS as e:
+            key = pub_key.split()[:2]
+            found = [key_obj for key_obj in repo_obj.get_keys() if key_obj.key.split()[:2] == key]
+            if not found:
+                raise e
+            logger.warning(f"Deploy key {name} was created before connection was lost")
+            return found[0]
     
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
-    def remove_deploy_key(self, key_obj):
+    def remove_deploy_key(self, key_obj, priv_key=None):
         """Method to remove deploy key in repository.
         
         Args:
-            repo_obj: GH repository object where key will deleted
+            key_obj: GH key object which will be deleted
+            priv_key: private key of deploy key, zeroed if it comes from key pool
         Returns:
             Status of delete operation.
         """
-        return key_obj.delete()
+        r = key_obj.delete()
+        KeyPool.discard(priv_key)
+        return r
     
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
     def set_secret(self, repo_obj, name, secret):
         """Method to set secret in GH repository.
 
-        If secret exists, method rise an Exeption.
+        If secret exists, it's updated.
         
         Args:
             repo_obj: GH repository object where secret will be placed
@@ -159,39 +240,231 @@ class Airee_gh_repo:
         Returns:
             Status of creation operation.
             """
+        return self.set_secrets(repo_obj, {name: secret})[name]
+
+    @metrics.timed('set_secret')
+    def set_secrets(self, repo_obj, secrets):
+        """Method to set many secrets in GH repository.
+
+        Public key of repository is fetched once and cached, secrets are encrypted
+        locally and uploaded in parallel.
+
+        Args:
+            repo_obj: GH repository object where secrets will be placed
+            secrets: dict with names and string values of secrets
+        Returns:
+            dict with name and status of creation operation per secret.
+        """
         try:
-            r = repo_obj.create_secret(name, secret)
+            return self.__put_secrets(repo_obj, f'{repo_obj.url}/actions/secrets', secrets)
         except Exception as e:
-            logger.error(f"Can't create secret {secret} in repo {repo_obj.name}")
+            logger.error(f"Can't create secrets {', '.join(secrets)} in repo {repo_obj.name}")
             raise e
-        return r
 
+    @metrics.timed('set_org_secret')
+    def set_org_secret(self, name, secret, repos=[]):
+        """Method to set secret in GH Organization visible only to selected repositories.
+
+        Shared value is written once instead of once per repository. Selected repositories
+        are replaced, use add_repo_to_org_secret to add repository to existing secret.
+
+        Args:
+            name: string name of a secret in GH Organization
+            secret: string value of secret
+            repos: list of GH repository objects which can use secret
+        Returns:
+            Status of creation operation.
+        """
+        return self.__set_org_secret(name, secret, [repo_obj.id for repo_obj in repos])
+
+    def add_repo_to_org_secret(self, name, repo_obj, secret=None):
+        """Method to add repository to selected repositories of organization secret.
+
+        If secret is passed, value of organization secret is written once per process
+        with repositories which already use it, e.g. to rotate PAT.
+
+        Args:
+            name: string name of a secret in GH Organization
+            repo_obj: GH repository object which can use secret
+            secret: string value of secret
+        Returns:
+            Status of operation.
+        """
+        url = f'{self.gh_org.url}/actions/secrets/{name}'
+        if secret is not None:
+            # only hash of value is kept in memory
+            key = (url, hashlib.sha256(secret.encode()).hexdigest())
+            with _org_secrets_lock:
+                if key not in _org_secrets:
+                    try:
+                        repo_ids = [repo['id'] for repo in self.__org_secret_repos(url)]
+                    except GithubException as e:
+                        if e.status != 404:
+                            raise e
+                        repo_ids = []
+                    r = self.__set_org_secret(name, secret, repo_ids + [repo_obj.id])
+                    _org_secrets.add(key)
+                    return r
+        self.__put(self.gh_org, f'{url}/repositories/{repo_obj.id}')
+        logger.debug(f"Repository {repo_obj.name} added to organization secret {name}")
+        return True
+
+    def __set_org_secret(self, name, secret, repo_ids):
+        """Set organization secret visible to repositories with given ids."""
+        extra = {'visibility': 'selected', 'selected_repository_ids': sorted(set(repo_ids))}
+        return self.__put_secrets(self.gh_org, f'{self.gh_org.url}/actions/secrets', {name: secret}, extra)[name]
+
+    def __org_secret_repos(self, url):
+        """Return list of repositories selected in organization secret."""
+        repos, page = [], 1
+        while True:
+            _, data = self.gh_org._requester.requestJsonAndCheck('GET', f'{url}/repositories', parameters={'per_page': 100, 'page': page})
+            repos += data['repositories']
+            if len(repos) >= data['total_count'] or not data['repositories']:
+                return repos
+            page += 1
+
+    def __public_key(self, owner, secrets_url, refresh=False):
+        """Return tuple with key_id and key of repository or organization, cached in gh_client.public_keys."""
+        key = None if refresh else gh_client.public_keys.get(secrets_url)
+        if key is None:
+            _, data = owner._requester.requestJsonAndCheck('GET', f'{secrets_url}/public-key')
+            key = (data['key_id'], data['key'])
+            gh_client.public_keys.put(secrets_url, *key)
+        return key
+
+    def __put_secrets(self, owner, secrets_url, secrets, extra={}):
+        """Encrypt secrets with public key of owner and upload them in parallel.
+
+        If GitHub rejects encrypted value (422), public key was rotated and upload is repeated once with new key.
+        """
+        def put(name, key_id, encrypted):
+            self.__put(owner, f'{secrets_url}/{name}', dict(extra, key_id=key_id, encrypted_value=encrypted))
+            logger.debug(f"Secret {name} set in {secrets_url}")
+            return True
+
+        for refresh in (False, True):
+            key_id, key = self.__public_key(owner, secrets_url, refresh)
+            encrypted = {name: gh_client.encrypt(key, value) for name, value in secrets.items()}
+            try:
+                if len(encrypted) == 1:
+                    return {name: put(name, key_id, value) for name, value in encrypted.items()}
+                with ThreadPoolExecutor(max_workers=min(len(encrypted), config.secret_workers)) as executor:
+                    futures = {name: executor.submit(put, name, key_id, value) for name, value in encrypted.items()}
+                    return {name: future.result() for name, future in futures.items()}
+            except GithubException as e:
+                if e.status != 422 or refresh:
+                    raise e
+                logger.warning(f"Secret rejected with public key {key_id}, public key is fetched again")
+                gh_client.public_keys.invalidate(secrets_url)
+
+    @retry(gh_client.CONNECTION_ERRORS, tries=2, delay=20, backoff=2, logger=metrics.retry_logger(logger, 'put'))
+    def __put(self, owner, url, input=None):
+        """Send PUT request, it's idempotent so it's repeated if connection is lost."""
+        return owner._requester.requestJsonAndCheck('PUT', url, input=input)
+
+    @metrics.timed('get_file')
+    def get_file(self, repo_obj, path, ref=None):
+        """Method to read file from GH repository with Contents API, without clone.
+
+        Args:
+            repo_obj: GH repository object where file is placed
+            path: string path of file in repository
+            ref: string branch, tag or commit, default branch of repository if not passed
+        Returns:
+            bytes with file content and string with blob sha of file.
+        """
+        content_file = repo_obj.get_contents(path, ref=ref) if ref else repo_obj.get_contents(path)
+        return content_file.decoded_content, content_file.sha
+
+    @metrics.timed('update_file')
+    def update_file(self, repo_obj, path, message, content, sha, author=["Init", "test@dsstream.com"]):
+        """Method to commit new content of file in GH repository with Contents API, without clone.
+
+        Blob sha of replaced file is used for optimistic concurrency, if file was changed
+        in meantime GithubException with status 409 is raised. Method is not retried for that reason.
+
+        Args:
+            repo_obj: GH repository object where file is placed
+            path: string path of file in repository
+            message: string with commit message
+            content: string or bytes with new content of file
+            sha: string blob sha of file which is replaced, returned by get_file
+            author: list of two strings with name and email of changes author and commiter
+        Returns:
+            string sha of created commit.
+        """
+        auth = InputGitAuthor(*author)
+        r = repo_obj.update_file(path, message, content, sha, committer=auth, author=auth)
+        logger.debug(f"File {path} updated in repo {repo_obj.name}")
+        return r['commit'].sha
+
+    @metrics.timed('generate_from_template')
     def generate_from_template(self, type, path, org=None, **kwargs):
         """Method to generate files from template stored on github.
         
         Method use a cookiecutter framework to create files from template.
+        Template is taken from local template cache, checked against GitHub branch or tag.
+        TEMPLATE_METADATA file with template commit and context is written to generated project.
         Will rise exeption if any issue with creation appear
 
         Args:
             type: string value from list [infra, app, workspace_data]
             path: string path where files will be placed
             org: string name of Github Organization where repo is placed
-            kwargs: dict with other params that can be ued by cookiecutter method, e.g extra_context
+            kwargs: dict with other params that can be ued by cookiecutter method, e.g extra_context, checkout
         Returns:
             return a root path of creted file from template.
         """
         org_name = org if org else self.org
-        git_url = f'https://{self.token}@github.com/{org_name}/{config.template[type]}'
+        checkout = kwargs.pop('checkout', None) or 'main'
         try:
-            cookiecutter(git_url, output_dir=path, **kwargs)
-            logger.debug(f"Created repo from template url {git_url.replace(self.token, 'git')}")
+            with self.template_cache.use(self.token, org_name, config.template[type], checkout) as template_dir, _cookiecutter_lock:
+                project_dir = cookiecutter_main.cookiecutter(template_dir, output_dir=path, **kwargs)
+            metadata_path = path_join(project_dir, TEMPLATE_METADATA)
+            os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+            with open(metadata_path, 'wb') as metadata_file:
+                metadata_file.write(template_metadata(config.template[type], TemplateCache.commit_of(template_dir), checkout, kwargs.get('extra_context')))
+            logger.debug(f"Created repo from template {config.template[type]} ({checkout})")
             return path
         except Exception as e:
             # configure logging
             logger.error("Can't create repo from template - check logs")
             raise e
 
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
+    @metrics.timed('render_from_template')
+    def render_from_template(self, type, path, org=None, **kwargs):
+        """Method to render files from template stored on github in memory.
+
+        Files are rendered with template_render and committed with Gitrepo.commit_files, without working tree.
+        Template is taken from local template cache, the same as in generate_from_template.
+        TEMPLATE_METADATA file with template commit and context is added, so repository can be upgraded.
+        Templates with hooks are rendered by cookiecutter on disk with generate_from_template.
+
+        Args:
+            type: string value from list [infra, app, workspace_data]
+            path: string path where files will be placed if template has hooks
+            org: string name of Github Organization where repo is placed
+            kwargs: dict with other params of cookiecutter method, extra_context, default_config and checkout are used in memory
+        Returns:
+            dict with rendered files for Gitrepo.commit_files, None if files were rendered on disk in path.
+        """
+        org_name = org if org else self.org
+        checkout = kwargs.get('checkout') or 'main'
+        try:
+            with self.template_cache.use(self.token, org_name, config.template[type], checkout) as template_dir:
+                if template_render.has_hooks(template_dir):
+                    logger.info(f"Template {config.template[type]} has hooks, files are rendered on disk")
+                    self.generate_from_template(type, path, org, **kwargs)
+                    return None
+                files = template_render.render_files(template_dir, kwargs.get('extra_context'), kwargs.get('default_config', False))
+            files[TEMPLATE_METADATA] = (template_metadata(config.template[type], TemplateCache.commit_of(template_dir), checkout, kwargs.get('extra_context')), False)
+            logger.debug(f"Rendered {len(files)} files from template {config.template[type]} ({checkout})")
+            return files
+        except Exception as e:
+            logger.error("Can't create repo from template - check logs")
+            raise e
+
     def delete_repo(self, repo_obj):
         """Method to delete GH repository.
         
@@ -0,0 +1,338 @@
+"""Module with asyncio variants of Airee_gh_repo and Gitrepo.
+
+All operations of many workspaces can run on single event loop instead of thread per operation.
+GitHub REST API is called with one pooled aiohttp session, requests use the same rate limit
+budget and retry policy as gh_client, so sync and async code share limits of a token.
+pygit2 and git command line operations are blocking, they are offloaded to bounded executor.
+
+GitHub repositories and deploy keys are returned as dicts with GitHub API json,
+not as PyGithub objects. Errors are raised as GithubException, the same as in sync classes,
+but coroutines never call sys.exit, so failure of one workspace doesn't stop operations of other workspaces
+running on the same event loop, e.g. collect them with asyncio.gather(..., return_exceptions=True).
+
+    Typical usege:
+
+    async with AsyncGitHub(PAT) as gh:
+        airee = AsyncAireeRepo(gh, name_of_workspace, github_org, env)
+        repo = await airee.create_empty_repo_gh("infra")
+        priv_k, pub_k, key = await airee.set_deploy_key("deploy_key", repo, False)
+        infra_git = AsyncGitrepo(repo['ssh_url'], priv_k, pub_k)
+        await infra_git.clone_repo(path)
+"""
+from github.GithubException import GithubException
+from pair_key import PairKey, KeyPool
+from git_module import Gitrepo
+import config, gh_client, metrics
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import asyncio
+import functools
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+_lock = threading.Lock()
+_executor = None
+
+
+def executor():
+    """Return bounded executor shared by all blocking git and key generation operations.
+
+    Number of threads is config.git_workers, so many coroutines don't start more
+    clones and pushes than network and disk can handle.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.git_workers, thread_name_prefix='airee-git')
+        return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run blocking function in shared executor and wait for its result."""
+    return await asyncio.get_running_loop().run_in_executor(executor(), functools.partial(func, *args, **kwargs))
+
+
+class AsyncGitHub:
+    """Class with async GitHub REST API client.
+
+    Requests wait for rate limit budget of token without blocking event loop,
+    rate limited and failed requests are retried with gh_client.retry_delay.
+
+    Attributes:
+        token: string value of PAT
+        base_url: string url of GitHub API
+        session: aiohttp ClientSession with pool of connections
+    """
+    def __init__(self, token, base_url=None):
+        """Create AsyncGitHub object, session is opened by "async with" or open method."""
+        self.token = token
+        self.base_url = (base_url if base_url else config.gh_api_url).rstrip('/')
+        self.session = None
+        self.__headers = {
+            'Authorization': f'token {token}',
+            'Accept': 'application/vnd.github.v3+json',
+            'User-Agent': 'airee-controller',
+        }
+
+    async def open(self):
+        """Open session with pool of config.gh_pool_size connections."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=config.gh_pool_size)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.__headers)
+        return self
+
+    async def close(self):
+        """Close session and its connections."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, verb, url, input=None):
+        """Method to send request to GitHub API.
+
+        Args:
+            verb: string HTTP method
+            url: string path of API endpoint, e.g. /orgs/ds-stream/repos, or full url
+            input: dict with json body of request
+        Returns:
+            int status, dict with headers and json body of response (None if body is empty).
+            GithubException is raised if status is 400 or above.
+        """
+        await self.open()
+        url = url if url.startswith('http') else f'{self.base_url}{url}'
+        budget = gh_client.get_budget(self.__headers['Authorization'], gh_client.resource_of(url))
+        attempt = 0
+        while True:
+            wait = budget.reserve(write=verb.upper() not in ('GET', 'HEAD'))
+            if wait > 0:
+                logger.debug(f"Waiting {wait:.2f}s for GitHub rate limit budget")
+                metrics.rate_limit_wait(wait, 'budget')
+                await asyncio.sleep(wait)
+            async with self.session.request(verb, url, json=input, allow_redirects=False) as r:
+                status, headers, text = r.status, dict(r.headers), await r.text()
+            budget.update(headers)
+            delay = gh_client.retry_delay(verb, status, headers, text, attempt)
+            if delay is None:
+                break
+            attempt += 1
+            logger.warning(f"GitHub answered {status} for {verb} {url.split('?')[0]}, retry {attempt} in {delay:.1f}s")
+            gh_client.count_retry(status, delay)
+            await asyncio.sleep(delay)
+
+        try:
+            data = json.loads(text) if text else None
+        except ValueError:
+            data = {'message': text}
+        if status >= 400:
+            raise GithubException(status, data, headers)
+        return status, headers, data
+
+
+class AsyncAireeRepo:
+    """Async Airee GitHub organization connector.
+
+    It has the same methods as Airee_gh_repo, but they are coroutines and
+    GitHub objects are dicts with GitHub API json.
+
+    Attributes:
+        gh: AsyncGitHub object shared by all workspaces
+        workspace: string with name of Ariee workspace
+        org: string with name of GitHub Organization
+        env: string with environment variable [e.g prd, dev, uat]
+        key_pool: KeyPool object with pre-generated deploy keys, keys are generated in executor if None
+    """
+    def __init__(self, gh, workspace, org='DsAirKube', env='prd', key_pool=None):
+        """Create AsyncAireeRepo object."""
+        self.gh = gh
+        self.workspace = workspace
+        self.org = org
+        self.env = env
+        self.key_pool = key_pool
+
+    def for_workspace(self, workspace, env=None):
+        """Return new object for other workspace sharing GitHub client and key pool."""
+        return AsyncAireeRepo(self.gh, workspace, org=self.org, env=env if env else self.env, key_pool=self.key_pool)
+
+    def repo_naming(self, type):
+        """Return name in order to naming convention."""
+        return f'{self.workspace}_{type}_{self.env}'
+
+    async def create_repo(self, name, private=True, **kwargs):
+        """Method to create git repository in GitHub.
+
+        If name already exist, GithubException with status 422 is raised.
+
+        Args:
+            name: string with name of repository
+            private: bool, default value True
+            kwargs: dict with other params of GitHub "create organization repository" endpoint
+        Returns:
+            dict with GitHub repository.
+        """
+        try:
+            _, _, repo = await self.gh.request('POST', f'/orgs/{self.org}/repos', dict(kwargs, name=name, private=private))
+            logger.debug(f"Repositoy {name} created in {self.org}")
+        except GithubException as e:
+            if e.status == 422 and any(mesg.get('message') == 'name already exists on this account' for mesg in (e.data or {}).get('errors', [])):
+                logger.error(f"Repository name {name} already exist in {self.org}")
+            raise e
+        return repo
+
+    async def create_empty_repo_gh(self, type):
+        """Create GitHub repository using Airee naming convention."""
+        return await self.create_repo(self.repo_naming(type))
+
+    async def get_airee_repo(self, type):
+        """Get dict with GitHub repository by Airee type."""
+        _, _, repo = await self.gh.request('GET', f'/repos/{self.org}/{self.repo_naming(type)}')
+        return repo
+
+    async def set_deploy_key(self, name, repo, read_only=True):
+        """Method to set deploy_key on repository.
+
+        Args:
+            name: string name of "deploy key" in GH repository
+            repo: dict with GitHub repository where key will be placed
+            read_only: bool read only flag, default True
+        Returns:
+            Method return priv, pub keys and dict with GitHub key
+        """
+        if self.key_pool:
+            priv_key, pub_key = await run_blocking(self.key_pool.get, 'ecdsa')
+        else:
+            priv_key, pub_key = await run_blocking(PairKey.generate_pair_ecdsa)
+        _, _, key = await self.gh.request('POST', f"/repos/{repo['full_name']}/keys", {'title': name, 'key': pub_key.decode(), 'read_only': read_only})
+        return priv_key, pub_key, key
+
+    async def remove_deploy_key(self, repo, key, priv_key=None):
+        """Method to remove deploy key in repository.
+
+        Args:
+            repo: dict with GitHub repository
+            key: dict with GitHub key which will be deleted
+            priv_key: private key of deploy key, zeroed if it comes from key pool
+        Returns:
+            int status of delete operation.
+        """
+        status, _, _ = await self.gh.request('DELETE', f"/repos/{repo['full_name']}/keys/{key['id']}")
+        KeyPool.discard(priv_key)
+        return status
+
+    async def set_secret(self, repo, name, secret):
+        """Method to set secret in GH repository.
+
+        Args:
+            repo: dict with GitHub repository where secret will be placed
+            name: string name of a secret in GH git repository
+            secret: string value of secret
+        Returns:
+            bool True if secret was set.
+        """
+        return (await self.set_secrets(repo, {name: secret}))[name]
+
+    async def set_secrets(self, repo, secrets):
+        """Method to set many secrets in GH repository.
+
+        Public key of repository is cached in gh_client.public_keys, shared with sync code,
+        secrets are encrypted locally and uploaded concurrently.
+
+        Args:
+            repo: dict with GitHub repository where secrets will be placed
+            secrets: dict with names and string values of secrets
+        Returns:
+            dict with name and status of operation per secret.
+        """
+        secrets_url = f"{self.gh.base_url}/repos/{repo['full_name']}/actions/secrets"
+
+        async def put(name, key_id, encrypted):
+            await self.gh.request('PUT', f'{secrets_url}/{name}', {'key_id': key_id, 'encrypted_value': encrypted})
+            return True
+
+        try:
+            for refresh in (False, True):
+                key = None if refresh else gh_client.public_keys.get(secrets_url)
+                if key is None:
+                    _, _, data = await self.gh.request('GET', f'{secrets_url}/public-key')
+                    key = (data['key_id'], data['key'])
+                    gh_client.public_keys.put(secrets_url, *key)
+                try:
+                    results = await asyncio.gather(*[put(name, key[0], gh_client.encrypt(key[1], value)) for name, value in secrets.items()])
+                    return dict(zip(secrets, results))
+                except GithubException as e:
+                    if e.status != 422 or refresh:
+                        raise e
+                    gh_client.public_keys.invalidate(secrets_url)
+        except Exception as e:
+            logger.error(f"Can't create secrets {', '.join(secrets)} in repo {repo['name']}")
+            raise e
+
+    async def delete_repo(self, repo):
+        """Method to delete GH repository.
+
+        Args:
+            repo: dict with GitHub repository that will be deleted.
+        Returns:
+            Return 0 (int) if repopository will be deleted.
+            If any issue appear, GithubException is raised.
+        """
+        try:
+            await self.gh.request('DELETE', f"/repos/{repo['full_name']}")
+        except GithubException as e:
+            if (e.data or {}).get('message') == 'Must have admin rights to Repository.':
+                logger.error("Must have admin rights to Repository.")
+            raise
+        return 0
+
+
+class AsyncGitrepo:
+    """Async variant of Gitrepo.
+
+    Network and disk operations of wrapped Gitrepo object are run in shared bounded executor.
+
+    Attributes:
+        git: Gitrepo object
+    """
+    def __init__(self, ssh_url, prv_k=None, pub_k=None, token=None):
+        """Create AsyncGitrepo object, see Gitrepo."""
+        self.git = Gitrepo(ssh_url, prv_k, pub_k, token)
+
+    async def clone_repo(self, path, mode='full', branch='main', paths=None):
+        """Clone repository, see Gitrepo.clone_repo."""
+        return await run_blocking(self.git.clone_repo, path, mode=mode, branch=branch, paths=paths)
+
+    async def clone_cheapest(self, path, paths=None, branch='main', modes=None):
+        """Clone repository in the cheapest mode which works, see Gitrepo.clone_cheapest."""
+        return await run_blocking(self.git.clone_cheapest, path, paths=paths, branch=branch, modes=modes)
+
+    async def commit_all(self, comment, **kwargs):
+        """Commit all changes in local repository, see Gitrepo.commit_all."""
+        return await run_blocking(self.git.commit_all, comment, **kwargs)
+
+    async def push(self, **kwargs):
+        """Push to remote repository, see Gitrepo.push."""
+        return await run_blocking(self.git.push, **kwargs)
+
+    async def add_submodule(self, git_repo, path):
+        """Add submodule to repository, see Gitrepo.add_submodule, git_repo can be AsyncGitrepo or Gitrepo."""
+        return await run_blocking(self.git.add_submodule, self.__unwrap(git_repo), path)
+
+    async def link_submodule(self, git_repo, path, commit=None, checkout=False):
+        """Add submodule without clone of submodule repository, see Gitrepo.link_submodule, git_repo can be AsyncGitrepo or Gitrepo."""
+        return await run_blocking(self.git.link_submodule, self.__unwrap(git_repo), path, commit=commit, checkout=checkout)
+
+    @staticmethod
+    def __unwrap(git_repo):
+        """Return Gitrepo object used by sync methods."""
+        return git_repo.git if isinstance(git_repo, AsyncGitrepo) else git_repo
@@ -0,0 +1,412 @@
+"""Offline benchmark of controller operations.
+
+Benchmark runs create, pause, start and destroy against local fake GitHub server (fake_github),
+local bare git repositories and local cookiecutter templates, so it doesn't need GitHub organization
+or network. Single operations are measured as latency, batches as throughput. Results are appended
+to json lines file and compared with the last result with the same parameters, so performance
+regressions are visible before they reach production. Cold start of CLI is checked against
+time budget and it shouldn't import cookiecutter or pygit2 for --help and status commands.
+
+Templates are synthetic copies with the same context as config.template templates,
+real templates can be used with --templates directory.
+
+    Typical usege:
+
+    python benchmark.py --workspaces 16 --workers 4 --latency-ms 50
+    python benchmark.py --scenarios create,pause --repeat 10 --fail-on-regression
+"""
+from fake_github import FakeGitHub, git
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join as path_join
+
+logger = logging.getLogger('benchmark')
+
+SCENARIOS = ['startup-help', 'startup-status', 'create', 'pause', 'start', 'destroy', 'create-batch', 'bulk-pause', 'bulk-start', 'bulk-destroy', 'reconcile-steady', 'reconcile-create']
+# action and status set by status scenarios, in order in which they are run
+STATUS_SCENARIOS = {'pause': 'pause', 'start': 'start', 'destroy': 'destroy'}
+ORG = 'airee-bench'
+HERE = os.path.dirname(os.path.abspath(__file__))
+# cold start of CLI in new interpreter: python arguments and packages which it shouldn't import
+STARTUP = {
+    'startup-help': (['entrypoint_init.py', '--help'], ('github', 'cookiecutter', 'jinja2', 'pygit2')),
+    'startup-status': (['-c', 'import entrypoint_init; entrypoint_init.airee_repos.Airee_gh_repo'], ('cookiecutter', 'jinja2', 'pygit2')),
+}
+TOKEN = 'benchmark-token'
+
+# context of synthetic templates, the same keys as passed by entrypoint_init.create_kwargs
+TEMPLATE_CONTEXT = {
+    'workspace_data': ['repo_name', 'env', 'workspace', 'org', 'labels', 'nfs_dags', 'project_id'],
+    'app': ['repo_name', 'env', 'workspace', 'org', 'labels', 'project_id', 'key_name', 'cert_name', 'nfs_dags'],
+    'infra': ['repo_name', 'env', 'workspace', 'org', 'airflow_performance', 'labels', 'project_id', 'tf_backend', 'domain', 'dns_zone', 'cert_name', 'nfs_dags'],
+}
+TEMPLATE_FILES = {
+    'workspace_data': {'dags/example_dag.py': '# DAG of {{cookiecutter.workspace}} in {{cookiecutter.env}}\nPROJECT = "{{cookiecutter.project_id}}"\n'},
+    'app': {
+        'values.yaml': 'workspace: {{cookiecutter.workspace}}\nenv: {{cookiecutter.env}}\ncert: {{cookiecutter.cert_name}}\nkey: {{cookiecutter.key_name}}\n',
+        'Dockerfile': 'FROM apache/airflow:2.2.5\nLABEL workspace="{{cookiecutter.workspace}}"\n',
+    },
+    'infra': {
+        'status.json': '{\n  "status": "up"\n}\n',
+        'terraform.tfvars': 'project = "{{cookiecutter.project_id}}"\nbackend = "{{cookiecutter.tf_backend}}"\ntier = "{{cookiecutter.airflow_performance}}"\n',
+        # CRLF newlines of template file are kept by cookiecutter 2.x, 1.x writes os.linesep
+        'scripts/setup.bat': '@echo off\r\nset WORKSPACE={{cookiecutter.workspace}}\r\nset ENV={{cookiecutter.env}}\r\n',
+    },
+}
+
+
+def build_templates(root, templates, extra_files=0, source=None, static_files=0):
+    """Function to create bare repositories with cookiecutter templates.
+
+    Args:
+        root: string path of directory where template repositories are created as <root>/<org>/<template>
+        templates: dict with type and repository name of templates, config.template
+        extra_files: int number of additional rendered files per template
+        source: string path of directory with real templates named as repositories without .git
+        static_files: int number of additional files per template which don't use context
+    """
+    for type, template in templates.items():
+        name = template[:-len('.git')] if template.endswith('.git') else template
+        work_dir = tempfile.mkdtemp(prefix=f'template_{name}')
+        if source and os.path.isdir(path_join(source, name)):
+            shutil.copytree(path_join(source, name), work_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns('.git'))
+        else:
+            with open(path_join(work_dir, 'cookiecutter.json'), 'w') as f:
+                json.dump({key: '' for key in TEMPLATE_CONTEXT[type]}, f, indent=2)
+            files = dict(TEMPLATE_FILES[type], **{f'files/file_{i}.txt': f'{i} {{{{cookiecutter.workspace}}}} {{{{cookiecutter.env}}}}\n' * 20 for i in range(extra_files)})
+            files.update({f'static/static_{i}.txt': f'{i} {type} static {{{{ "file" | upper }}}}\n' * 20 for i in range(static_files)})
+            for path, content in files.items():
+                file_path = path_join(work_dir, '{{cookiecutter.repo_name}}', path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'w', newline='') as f:
+                    f.write(content)
+        bare = path_join(root, ORG, template)
+        git('init', '-q', work_dir)
+        git('add', '-A', cwd=work_dir)
+        git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'template', cwd=work_dir)
+        git('branch', '-M', 'main', cwd=work_dir)
+        os.makedirs(os.path.dirname(bare), exist_ok=True)
+        git('clone', '-q', '--bare', work_dir, bare)
+        shutil.rmtree(work_dir)
+
+
+def percentile(values, p):
+    """Return p-th percentile of values with nearest rank method."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def stats(latencies, seconds, failed, ops):
+    """Return dict with latency and throughput of scenario."""
+    return {
+        'ops': ops, 'failed': failed, 'seconds': round(seconds, 4),
+        'ops_per_sec': round(ops / seconds, 3) if seconds else None,
+        'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'max': max(latencies) if latencies else None,
+    }
+
+
+def imported_packages(python_args):
+    """Return set of top level packages imported by python with given arguments, read from -X importtime output."""
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + python_args, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return {line.rsplit('|', 1)[1].strip().split('.')[0] for line in process.stderr.splitlines() if line.startswith('import time:')}
+
+
+def check_startup(scenarios, budget):
+    """Function to check cold start of CLI against time budget and forbidden imports.
+
+    Args:
+        scenarios: dict with results per scenario
+        budget: float seconds allowed for p50 of cold start
+    Returns:
+        list of strings with violations.
+    """
+    violations = []
+    for name in STARTUP:
+        result = scenarios.get(name)
+        if not result:
+            continue
+        if result['p50'] is not None and result['p50'] > budget:
+            violations.append(f"{name} p50 {result['p50']}s is over budget {budget}s")
+        if result['imported']:
+            violations.append(f"{name} imports {', '.join(result['imported'])}")
+    return violations
+
+
+def check_render(root, templates):
+    """Function to check that templates rendered in memory are the same as rendered by cookiecutter on disk.
+
+    Args:
+        root: string path of directory with template repositories <root>/<org>/<template>
+        templates: dict with type and repository name of templates, config.template
+    Returns:
+        list of strings with differences.
+    """
+    from cookiecutter.main import cookiecutter
+    import template_render
+    differences = []
+    for template in templates.values():
+        work_dir = tempfile.mkdtemp(prefix='airee-render')
+        try:
+            template_dir = path_join(work_dir, 'template')
+            git('clone', '-q', path_join(root, ORG, template), template_dir)
+            project_dir = cookiecutter(template_dir, output_dir=path_join(work_dir, 'out'), no_input=True)
+            on_disk = {}
+            for walk_root, _, names in os.walk(project_dir):
+                for name in names:
+                    path = path_join(walk_root, name)
+                    with open(path, 'rb') as f:
+                        on_disk[os.path.relpath(path, project_dir).replace(os.path.sep, '/')] = (f.read(), bool(os.stat(path).st_mode & 0o100))
+            in_memory = template_render.render_files(template_dir)
+            for path in sorted(set(on_disk) | set(in_memory)):
+                if on_disk.get(path) != in_memory.get(path):
+                    differences.append(f"{template} {path} rendered in memory differs from cookiecutter")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return differences
+
+
+def workspace(name):
+    """Return manifest entry of benchmark workspace."""
+    return {'workspace': name, 'env': 'dev', 'tier': 'small', 'project': 'bench-project', 'tfbuckend': 'bench-bucket'}
+
+
+def run(args, server):
+    """Function to run selected scenarios.
+
+    Controller modules are imported here, after environment points them to local stand-ins.
+
+    Returns:
+        dict with results per scenario.
+    """
+    import config, metrics, fleet, entrypoint_init
+    from airee_repos import Airee_gh_repo
+    config.ch.setLevel(logging.WARNING)
+
+    results = {}
+    airee = Airee_gh_repo(TOKEN, None, org=ORG, env='dev')
+    single = [f'bench-s-{i:04d}' for i in range(args.repeat)]
+    batch = [f'bench-b-{i:04d}' for i in range(args.workspaces)]
+
+    def scenario(name, func):
+        metrics.reset()
+        requests_before = dict(server.requests)
+        start = time.perf_counter()
+        latencies, failed, ops = func()
+        seconds = time.perf_counter() - start
+        results[name] = stats(latencies, seconds, failed, ops)
+        results[name]['steps'] = {step: {k: round(v, 5) for k, v in s.items()} for step, s in metrics.summary().items()}
+        results[name]['requests'] = sum(server.requests.values()) - sum(requests_before.values())
+        latency = f", p50 {results[name]['p50']}s, p95 {results[name]['p95']}s" if latencies else ''
+        logger.warning(f"{name}: {results[name]['ops']} ops, {results[name]['failed']} failed{latency}, {results[name]['ops_per_sec']} ops/s")
+
+    def startup(name):
+        def func():
+            python_args, _ = STARTUP[name]
+            latencies, failed = [], 0
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable] + python_args, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                latencies.append(round(time.perf_counter() - start, 4))
+                failed += process.returncode != 0
+            return latencies, failed, len(latencies)
+        return func
+
+    def create_single():
+        latencies, failed = [], 0
+        for name in single:
+            result = fleet.create_one(airee, workspace(name))
+            latencies.append(result['seconds'])
+            failed += result['status'] == 'failed'
+        return latencies, failed, len(latencies)
+
+    def status_single(action):
+        def func():
+            latencies, failed = [], 0
+            for name in single:
+                start = time.perf_counter()
+                result = fleet.status_one(airee, name, 'dev', entrypoint_init.STATUS_ACTIONS[action])
+                latencies.append(round(time.perf_counter() - start, 4))
+                failed += result['result'] != 'changed'
+            return latencies, failed, len(latencies)
+        return func
+
+    def create_batch():
+        report = fleet.create_batch(TOKEN, ORG, [workspace(name) for name in batch], args.workers)
+        return [r['seconds'] for r in report], sum(r['status'] == 'failed' for r in report), len(report)
+
+    def bulk(action):
+        def func():
+            summary = fleet.bulk_status(TOKEN, ORG, entrypoint_init.STATUS_ACTIONS[action], env='dev', match='bench-b-*', workers=args.workers)
+            # bulk reports only results, latency of single workspace is not measured
+            failed = len(summary['failed']) + len(summary['skipped'])
+            return [], failed, len(summary['changed']) + failed
+        return func
+
+    def reconcile_steady():
+        # manifest equal to actual state, nothing is cloned or written
+        results = fleet.reconcile(TOKEN, ORG, [workspace(name) for name in batch], args.workers)
+        failed = sum(r['result'] != 'unchanged' for r in results)
+        return [], failed, len(results)
+
+    def reconcile_create():
+        # new workspaces with status equal to template default ("up") and different from it, all are changed
+        manifest = [dict(workspace(f'bench-r-{i:04d}'), status='up' if i % 2 else 'pause') for i in range(args.workspaces)]
+        results = fleet.reconcile(TOKEN, ORG, manifest, args.workers)
+        failed = sum(r['result'] != 'changed' for r in results)
+        return [], failed, len(results)
+
+    selected = args.scenarios
+    for name, (python_args, forbidden) in STARTUP.items():
+        if name in selected:
+            scenario(name, startup(name))
+            results[name]['imported'] = sorted(imported_packages(python_args) & set(forbidden))
+    if set(selected) & {'create', 'pause', 'start', 'destroy'}:
+        if 'create' in selected:
+            scenario('create', create_single)
+        else:
+            create_single()
+        for action in STATUS_SCENARIOS:
+            if action in selected:
+                scenario(action, status_single(action))
+    if set(selected) & {'create-batch', 'bulk-pause', 'bulk-start', 'bulk-destroy', 'reconcile-steady'}:
+        if 'create-batch' in selected:
+            scenario('create-batch', create_batch)
+        else:
+            create_batch()
+        for action in STATUS_SCENARIOS:
+            if f'bulk-{action}' in selected:
+                scenario(f'bulk-{action}', bulk(action))
+        if 'reconcile-steady' in selected:
+            scenario('reconcile-steady', reconcile_steady)
+    if 'reconcile-create' in selected:
+        scenario('reconcile-create', reconcile_create)
+    return results
+
+
+def commit():
+    """Return current commit of repository and flag if working tree is changed."""
+    try:
+        sha = git('rev-parse', 'HEAD', cwd=HERE).strip()
+        dirty = bool(git('status', '--porcelain', '--untracked-files=no', cwd=HERE).strip())
+    except (subprocess.CalledProcessError, OSError):
+        return None, None
+    return sha, dirty
+
+
+def compare(record, path, threshold):
+    """Function to compare result with the last result with the same parameters.
+
+    Single operations are compared by p50 latency, batches by throughput.
+
+    Returns:
+        list of strings with regressions.
+    """
+    previous = None
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    old = json.loads(line)
+                    if old.get('params') == record['params']:
+                        previous = old
+    if previous is None:
+        logger.warning("No previous result with the same parameters")
+        return []
+
+    regressions = []
+    print(f"{'scenario':<14} {'metric':<12} {'previous':>10} {'current':>10} {'change':>8}")
+    for name, result in record['scenarios'].items():
+        old = previous['scenarios'].get(name)
+        if not old:
+            continue
+        metric, higher_better = ('ops_per_sec', True) if name.startswith(('bulk-', 'create-batch', 'reconcile-')) else ('p50', False)
+        if not old.get(metric) or result.get(metric) is None:
+            continue
+        change = (result[metric] - old[metric]) / old[metric]
+        print(f"{name:<14} {metric:<12} {old[metric]:>10} {result[metric]:>10} {change:>+8.1%}")
+        if (-change if higher_better else change) > threshold:
+            regressions.append(f"{name} {metric} {old[metric]} -> {result[metric]} ({change:+.1%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of Airee controller')
+    parser.add_argument('-s', '--scenarios', action='store', default=','.join(SCENARIOS), help=f"comma separated scenarios - default={','.join(SCENARIOS)}")
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=5, help="number of single operations per scenario - default=5")
+    parser.add_argument('-n', '--workspaces', action='store', type=int, default=8, help="number of workspaces in batch scenarios - default=8")
+    parser.add_argument('-j', '--workers', action='store', type=int, default=4, help="number of workers in batch scenarios - default=4")
+    parser.add_argument('--latency-ms', action='store', type=float, default=0, help="latency added to every fake GitHub request - default=0")
+    parser.add_argument('--rate-limit', action='store', type=int, default=0, help="requests allowed by fake GitHub per hour, unlimited if 0")
+    parser.add_argument('--secondary-every', action='store', type=int, default=0, help="every n-th write is answered with secondary rate limit, disabled if 0")
+    parser.add_argument('--production-limits', action='store_true', help="keep client rate limit budget of production, by default it's disabled to measure controller itself")
+    parser.add_argument('--no-fast-path', action='store_true', help="change status with clone instead of Contents API")
+    parser.add_argument('--template-files', action='store', type=int, default=0, help="additional files rendered by every synthetic template - default=0")
+    parser.add_argument('--static-files', action='store', type=int, default=0, help="additional files without context variables in every synthetic template - default=0")
+    parser.add_argument('--templates', action='store', default=None, help="directory with real templates named as config.template repositories without .git")
+    parser.add_argument('-o', '--results', action='store', default='results.jsonl', help="json lines file where result is appended - default=results.jsonl")
+    parser.add_argument('--threshold', action='store', type=float, default=0.2, help="relative change reported as regression - default=0.2")
+    parser.add_argument('--fail-on-regression', action='store_true', help="exit with 1 if regression is found")
+    parser.add_argument('--startup-budget', action='store', type=float, default=0.5, help="seconds allowed for p50 of CLI cold start - default=0.5")
+    parser.add_argument('--keep', action='store_true', help="keep working directory with repositories")
+    args = parser.parse_args(argv)
+    args.scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios {', '.join(sorted(unknown))}")
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(message)s')
+
+    root = tempfile.mkdtemp(prefix='airee-bench')
+    server = FakeGitHub(path_join(root, 'remotes'), latency=args.latency_ms / 1000, rate_limit=args.rate_limit, secondary_every=args.secondary_every).start()
+    # configuration is read from environment when config is imported
+    os.environ.update({
+        'AIREE_GH_API_URL': server.url,
+        'AIREE_TEMPLATE_URL': f'file://{root}/templates/{{org}}/{{template}}',
+        'AIREE_TEMPLATE_CACHE': path_join(root, 'template-cache'),
+        'AIREE_BLOB_STORE': path_join(root, 'blobs'),
+        'AIREE_JOURNAL_DIR': '',
+        'AIREE_MIRROR_CACHE': '',
+        'AIREE_STATUS_FAST_PATH': 'no' if args.no_fast_path else 'yes',
+    })
+    if not args.production_limits:
+        os.environ.update({'AIREE_GH_MAX_RATE': '1000000', 'AIREE_GH_WRITE_RATE': '1000000', 'AIREE_GH_BURST': '1000000'})
+    try:
+        import config
+        build_templates(path_join(root, 'templates'), config.template, args.template_files, args.templates, args.static_files)
+        differences = check_render(path_join(root, 'templates'), config.template)
+        scenarios = run(args, server)
+    finally:
+        server.stop()
+        if args.keep:
+            logger.warning(f"Working directory kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    sha, dirty = commit()
+    params = {k: v for k, v in vars(args).items() if k not in ('results', 'threshold', 'fail_on_regression', 'startup_budget', 'keep')}
+    record = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'commit': sha, 'dirty': dirty,
+        'python': platform.python_version(), 'params': params, 'scenarios': scenarios,
+    }
+    regressions = compare(record, args.results, args.threshold) + check_startup(scenarios, args.startup_budget) + differences
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    logger.warning(f"Result appended to {args.results}")
+    for regression in regressions:
+        logger.warning(f"Regression: {regression}")
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,11 +2,78 @@
 
 Atributes:
     template: dict with names of cookiecutter templates git repositories, used in ariee_repos
+    template_url: string url of template repository, formated with token, org and template
+    template_cache_dir: string path of local template cache, used in template_cache, user cache dir if /var/cache/airee can't be written
+    template_cache_max_age: int seconds after which unused cached template is removed
+    template_cache_max_size: int bytes limit of template cache on disk
+    render_cache_size: int max number of rendered template files kept in memory by template_render, disabled if 0
+    blob_store_dir: string path of bare repository with blobs of rendered files shared by repositories (git alternates), disabled if empty
+    gh_api_url: string url of GitHub REST API
+    gh_pool_size: int max number of pooled connections to GitHub API
+    gh_rate_limit_reserve: int number of GitHub requests left after which workers wait for rate limit reset
+    gh_max_rate: float max GitHub requests per second sent with one token
+    gh_write_rate: float max GitHub write requests per second, secondary rate limit allows 80 per minute
+    gh_burst: int number of GitHub requests which can be sent at once
+    gh_max_retries: int max retries of rate limited or failed GitHub request
+    gh_max_wait: int max seconds to wait for rate limit reset before request fails
+    gh_backoff: float base seconds of exponential backoff of failed GitHub request
+    gh_public_key_ttl: int seconds for which GitHub Actions public key of repository is cached
+    gh_graphql_batch: int max number of repositories read by one GraphQL query
+    gh_cache_size: int max number of GitHub responses kept for conditional requests, disabled if 0
+    gh_cache_ttl: int seconds after which cached GitHub response which wasn't validated is removed
+    gh_cache_db: string path of sqlite database with cached GitHub responses, responses are kept only in memory if empty
+    gh_app_id: string id of GitHub App which installation tokens are used by git over HTTPS, PAT is used if empty
+    gh_app_key_file: string path of private key (PEM) of GitHub App
+    gh_app_installation_id: string id of GitHub App installation, found by organization if empty
+    secret_workers: int max number of secrets uploaded in parallel
+    org_secrets: bool flag if PAT is kept as organization secret visible to selected repositories instead of secret per repository
+    batch_workers: int default number of workspaces provisioned in parallel by create-batch
+    git_workers: int number of threads running blocking git operations of async_repos
+    key_pool_size: int number of deploy key pairs pre-generated per algorithm by KeyPool
+    mirror_cache_dir: string path of local mirrors of infra repositories used by status change, disabled if empty
+    mirror_cache_max_size: int bytes limit of mirror cache on disk
+    journal_dir: string path of journals with finished steps of "create", user state dir if /var/lib/airee can't be written, journal is kept only in memory if set to empty
+    service_db: string path of sqlite database with job queue of controller service
+    service_api_key: string key required by controller service API, API listens only on 127.0.0.1 if empty
+    status_fast_path: bool flag if status.json is changed with GitHub Contents API instead of clone
+    git_credentials: string credentials of git used by status change [https, ssh], https uses tokens instead of temporary deploy keys
     log_lvl: logging level
     ch: channel of logging
     formatter: logging formatter used in controller
 """
 import logging
+import os
+import tempfile
+
+
+def writable_dir(path):
+    """Return True if directory can be written by current user, or created if it doesn't exist."""
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return os.access(path, os.W_OK | os.X_OK)
+
+
+def default_dir(system_dir, xdg_variable, xdg_default):
+    """Return system_dir if it can be used, otherwise the same name in XDG directory of user or in temp directory.
+
+    Args:
+        system_dir: string path used by controller running as root, e.g. in Docker image
+        xdg_variable: string name of XDG environment variable, e.g. XDG_CACHE_HOME
+        xdg_default: string default of XDG directory, e.g. ~/.cache
+    Returns:
+        string path of directory.
+    """
+    if writable_dir(system_dir):
+        return system_dir
+    name = os.path.basename(system_dir)
+    user_dir = os.path.join(os.environ.get(xdg_variable) or os.path.expanduser(xdg_default), 'airee', name)
+    if writable_dir(user_dir):
+        return user_dir
+    return os.path.join(tempfile.gettempdir(), f'airee-{os.getuid()}', name)
+
 
 template = {
     'infra': 'airee-template-infra-gcp.git',
@@ -20,4 +87,53 @@ ch.setLevel(log_lvl)
 # create formatter
 formatter = logging.Formatter('%(asctime)s - %(filename)s:%(lineno)s - %(funcName)s() - %(levelname)s - %(message)s')
 # add formatter to ch
-ch.setFormatter(formatter)
\ No newline at end of file
+ch.setFormatter(formatter)
+
+# url of template repositories, formated with token, org and template name
+template_url = os.environ.get('AIREE_TEMPLATE_URL', 'https://{token}@github.com/{org}/{template}')
+# local cache of template repositories
+template_cache_dir = os.environ.get('AIREE_TEMPLATE_CACHE') or default_dir('/var/cache/airee/templates', 'XDG_CACHE_HOME', '~/.cache')
+template_cache_max_age = int(os.environ.get('AIREE_TEMPLATE_CACHE_MAX_AGE', 7 * 24 * 3600))
+template_cache_max_size = int(os.environ.get('AIREE_TEMPLATE_CACHE_MAX_SIZE', 512 * 1024 * 1024))
+render_cache_size = int(os.environ.get('AIREE_RENDER_CACHE_SIZE', 4096))
+blob_store_dir = os.environ.get('AIREE_BLOB_STORE', '')
+
+# GitHub API client
+gh_api_url = os.environ.get('AIREE_GH_API_URL', 'https://api.github.com')
+gh_pool_size = int(os.environ.get('AIREE_GH_POOL_SIZE', 32))
+gh_rate_limit_reserve = int(os.environ.get('AIREE_GH_RATE_LIMIT_RESERVE', 50))
+gh_max_rate = float(os.environ.get('AIREE_GH_MAX_RATE', 10))
+gh_write_rate = float(os.environ.get('AIREE_GH_WRITE_RATE', 80 / 60))
+gh_burst = int(os.environ.get('AIREE_GH_BURST', 10))
+gh_max_retries = int(os.environ.get('AIREE_GH_MAX_RETRIES', 5))
+gh_max_wait = int(os.environ.get('AIREE_GH_MAX_WAIT', 900))
+gh_backoff = float(os.environ.get('AIREE_GH_BACKOFF', 2))
+gh_public_key_ttl = int(os.environ.get('AIREE_GH_PUBLIC_KEY_TTL', 3600))
+gh_graphql_batch = int(os.environ.get('AIREE_GH_GRAPHQL_BATCH', 100))
+gh_cache_size = int(os.environ.get('AIREE_GH_CACHE_SIZE', 1024))
+gh_cache_ttl = int(os.environ.get('AIREE_GH_CACHE_TTL', 24 * 3600))
+gh_cache_db = os.environ.get('AIREE_GH_CACHE_DB', '')
+gh_app_id = os.environ.get('AIREE_GH_APP_ID', '')
+gh_app_key_file = os.environ.get('AIREE_GH_APP_KEY_FILE', '')
+gh_app_installation_id = os.environ.get('AIREE_GH_APP_INSTALLATION_ID', '')
+
+secret_workers = int(os.environ.get('AIREE_SECRET_WORKERS', 8))
+org_secrets = os.environ.get('AIREE_ORG_SECRETS', 'no') == 'yes'
+
+batch_workers = int(os.environ.get('AIREE_BATCH_WORKERS', 4))
+git_workers = int(os.environ.get('AIREE_GIT_WORKERS', 8))
+
+key_pool_size = int(os.environ.get('AIREE_KEY_POOL_SIZE', 16))
+
+mirror_cache_dir = os.environ.get('AIREE_MIRROR_CACHE', '')
+mirror_cache_max_size = int(os.environ.get('AIREE_MIRROR_CACHE_MAX_SIZE', 2 * 1024 * 1024 * 1024))
+
+# journal is on disk by default, so failed "create" run again continues from failed step
+journal_dir = os.environ['AIREE_JOURNAL_DIR'] if 'AIREE_JOURNAL_DIR' in os.environ else default_dir('/var/lib/airee/journal', 'XDG_STATE_HOME', '~/.local/state')
+
+# controller service
+service_db = os.environ.get('AIREE_SERVICE_DB', '/var/lib/airee/jobs.db')
+service_api_key = os.environ.get('AIREE_API_KEY', '')
+
+status_fast_path = os.environ.get('AIREE_STATUS_FAST_PATH', 'yes') == 'yes'
+git_credentials = os.environ.get('AIREE_GIT_CREDENTIALS', 'https')
@@ -1,12 +1,16 @@
 """Module with entrypoint functions and script for docker image.
 """
-from airee_repos import Airee_gh_repo
-from git_module import Gitrepo
-import config, util
+from journal import Journal
+import config, util, metrics
 import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from os.path import join as path_join 
 import logging
 import json 
+import os
+import shutil
 import re #library for name check
 
 logger = logging.getLogger(__name__)
@@ -14,6 +18,18 @@ logger.setLevel(config.log_lvl)
 logger.addHandler(config.ch)
 logger.propagate = False
 
+# modules with heavy dependencies are imported on first use, so --help doesn't import them
+# and status commands don't import cookiecutter and pygit2 when status is changed with GitHub API
+airee_repos = util.lazy_import('airee_repos')
+git_module = util.lazy_import('git_module')
+template_cache = util.lazy_import('template_cache')
+github_exception = util.lazy_import('github.GithubException')
+
+# status set in status.json by pause, start and destroy commands
+STATUS_ACTIONS = {'pause': 'pause', 'start': 'up', 'destroy': 'down'}
+# operations changing repositories of the same workspace are serialized in process, different workspaces run in parallel
+workspace_leases = util.Leases()
+
 
 def name_check(name, pattern, max_len, min_len):
     """Function to validate workspace name.
@@ -27,133 +43,352 @@ def name_check(name, pattern, max_len, min_len):
     return True
 
 
-def create_repo_with_keypair(airee_repo, type):
+def create_repo_with_keypair(airee_repo, type, journal=None):
     """Function to create GH repositorie with deploy key using project naming convntion.
 
+    If repository was created by previous run recorded in journal, it's only checked that it still exists.
+    Private key of previous run is not kept, so its deploy key is replaced with new one.
+
     Args:
         airee_repo: Airee_gh_repo object
         type: string with type ["infra", "app", "workspace_data"]
+        journal: Journal object with finished steps
 
     Returns:
         Repository object with deploy key pair.
     """
-    # create repo
+    journal = journal if journal else Journal()
     name = airee_repo.repo_naming(type)
-    logger.info(f"Create repo '{name}' for workspace {airee_repo.workspace}")
-    repo_gh = airee_repo.create_repo(name, auto_init=True)
+    repo_gh = None
+    if journal.done(type, 'repo'):
+        try:
+            repo_gh = airee_repo.get_airee_repo(type)
+            logger.info(f"Repo '{name}' already created, it's reused")
+        except github_exception.GithubException as e:
+            if e.status != 404:
+                raise e
+            logger.warning(f"Repo '{name}' recorded in journal doesn't exist, it's created again")
+            journal.forget(type)
+    if repo_gh is None:
+        # create repo
+        logger.info(f"Create repo '{name}' for workspace {airee_repo.workspace}")
+        repo_gh = airee_repo.create_repo(name, auto_init=True)
+        journal.record(type, 'repo', id=repo_gh.id)
+
+    old_key = journal.done(type, 'key')
+    if old_key:
+        try:
+            airee_repo.remove_deploy_key(repo_gh.get_key(old_key['id']))
+        except github_exception.GithubException as e:
+            if e.status != 404:
+                raise e
     # create deploy-key for init push
     logger.info(f"Added Deploy Key")
     priv_k, pub_k, dk = airee_repo.set_deploy_key('init_push', repo_gh, False)
+    journal.record(type, 'key', id=dk.id)
 
     return repo_gh, priv_k, pub_k
 
-def add_token_to_sectets(airee_repo, repo_gh):
+def push_once(journal, type, git_repo, comment, files=None):
+    """Function to commit and push files of repository and record it in journal.
+
+    Args:
+        journal: Journal object with finished steps
+        type: string with type ["infra", "app", "workspace_data"]
+        git_repo: git repository object
+        comment: string with comment to commit
+        files: dict with files rendered in memory, all changes in working tree are committed if None
+    """
+    commit = git_repo.commit_files(files, comment) if files is not None else git_repo.commit_all(comment)
+    git_repo.push()
+    journal.record(type, 'pushed', commit=str(commit))
+
+def add_token_to_sectets(airee_repo, repo_gh, secrets={}):
     """Function to PAT from airee_repo object atribute to repository as a secret.
 
+    If config.org_secrets is set, PAT is kept as organization secret and repository
+    is added to its selected repositories.
+
     Args:
         airee_repo: Airee_gh_repo object
         repo_gh: Repository object where PAT will be placed
+        secrets: dict with other secrets of repository, uploaded together with PAT
     
     Returns:
         0 value if exit without error
     """
     # Add secret for infra repo
     logger.info(f"Adding secret TF_VAR_github_token")
-    airee_repo.set_secret(repo_gh, "TF_VAR_github_token", airee_repo.token)
+    if config.org_secrets:
+        airee_repo.add_repo_to_org_secret("TF_VAR_github_token", repo_gh, airee_repo.token)
+        if secrets:
+            airee_repo.set_secrets(repo_gh, secrets)
+    else:
+        airee_repo.set_secrets(repo_gh, dict(secrets, TF_VAR_github_token=airee_repo.token))
 
     return 0
 
-def workspace_repo_create(airee_repo, **kwargs):
+@metrics.labelled(type='workspace_data')
+def workspace_repo_create(airee_repo, journal=None, **kwargs):
     """Function to create "workspace data" repository.
 
+    Steps finished by previous run recorded in journal are skipped.
+
     Args:
         airee_repo: Airee_gh_repo object.
-        kwargs: dict with params passed to generate_from_template method in Airee_gh_repo object (cookiecutter params)
+        journal: Journal object with finished steps
+        kwargs: dict with params passed to render_from_template method in Airee_gh_repo object (cookiecutter params)
     
     Returns:
         git repository object of "workspace data" repository.
     """
+    journal = journal if journal else Journal()
     path = util.get_tmp_path('workspace_data')
-    repo_gh, priv_k, pub_k = create_repo_with_keypair(airee_repo, 'workspace_data')
+    repo_gh, priv_k, pub_k = create_repo_with_keypair(airee_repo, 'workspace_data', journal)
 
     logger.debug(f"Path to tmp folder: {path_join(path, 'workspace_data')}")
     logger.debug(f"Url to repo : {repo_gh.git_url}")
 
-    add_token_to_sectets(airee_repo, repo_gh)
-    workspace_git = Gitrepo(repo_gh.ssh_url, priv_k, pub_k)
+    if not journal.done('workspace_data', 'secrets'):
+        add_token_to_sectets(airee_repo, repo_gh)
+        journal.record('workspace_data', 'secrets')
+    workspace_git = git_module.Gitrepo(repo_gh.ssh_url, priv_k, pub_k)
 
-    workspace_git.clone_repo(path_join(path, 'workspace_data'))
-    airee_repo.generate_from_template('workspace_data', path, **kwargs)
-    workspace_git.commit_all("Init commit [skip ci]")
-    workspace_git.push()
+    # repository is pushed, only its new deploy key is needed by "app" repository
+    if not journal.done('workspace_data', 'pushed'):
+        workspace_git.clone_repo(path_join(path, 'workspace_data'))
+        files = airee_repo.render_from_template('workspace_data', path, **kwargs)
+        push_once(journal, 'workspace_data', workspace_git, "Init commit [skip ci]", files)
 
     return workspace_git
 
-def app_repo_create(airee_repo, workspace_git, **kwargs):
-    """Function to create "app" repository with "workspace data" repository as a submodule.
+@metrics.labelled(type='app')
+def app_repo_prepare(airee_repo, journal=None, **kwargs):
+    """Function to run part of "app" repository creation which not depend on "workspace data" repository.
+
+    Repository and deploy key are created and files are rendered from template.
 
     Args:
         airee_repo: Airee_gh_repo object.
-        workspace_git: workspace git repository object.
-        kwargs: dict with params passed to generate_from_template method in Airee_gh_repo object (cookiecutter params)
-    
+        journal: Journal object with finished steps
+        kwargs: dict with params passed to render_from_template method in Airee_gh_repo object (cookiecutter params)
+
     Returns:
-        git repository object of "app" repository.
+        git repository object, GitHub repository object and rendered files of "app" repository,
+        files are None if they were rendered on disk.
     """
     path = util.get_tmp_path('app')
-    repo_gh, priv_k, pub_k = create_repo_with_keypair(airee_repo, 'app')
+    repo_gh, priv_k, pub_k = create_repo_with_keypair(airee_repo, 'app', journal)
 
     logger.debug(f"Path to tmp folder: {path_join(path, 'app')}")
     logger.debug(f"Url to repo : {repo_gh.git_url}")
 
-    add_token_to_sectets(airee_repo, repo_gh)
-    airee_repo.set_secret(repo_gh, "priv_k_dags", workspace_git.prv_k.decode())
-
-    app_git = Gitrepo(repo_gh.ssh_url, priv_k, pub_k)
+    app_git = git_module.Gitrepo(repo_gh.ssh_url, priv_k, pub_k)
     app_git.clone_repo(path_join(path, 'app'))
-    airee_repo.generate_from_template('app', path, **kwargs)
-    app_git.add_submodule(workspace_git, 'dags')
-    app_git.commit_all("Init commit [skip ci]")
-    app_git.push()
+    files = airee_repo.render_from_template('app', path, **kwargs)
+
+    return app_git, repo_gh, files
+
+@metrics.labelled(type='app')
+def app_repo_finish(airee_repo, app_git, repo_gh, workspace_git, journal=None, files=None):
+    """Function to finish "app" repository with "workspace data" repository as a submodule.
+
+    Submodule is linked to pushed commit of "workspace data" repository without its clone.
+    PAT and private key of "workspace data" repository are set as secrets.
+
+    Args:
+        airee_repo: Airee_gh_repo object.
+        app_git: git repository object returned by app_repo_prepare.
+        repo_gh: GitHub repository object returned by app_repo_prepare.
+        workspace_git: workspace git repository object.
+        journal: Journal object with finished steps
+        files: dict with files returned by app_repo_prepare
+
+    Returns:
+        git repository object of "app" repository.
+    """
+    journal = journal if journal else Journal()
+    # priv_k_dags is set again if deploy key of "workspace data" repository was replaced
+    dags_key = (journal.done('workspace_data', 'key') or {}).get('id')
+    secrets = journal.done('app', 'secrets')
+    if not secrets or secrets.get('dags_key') != dags_key:
+        # both secrets of "app" repository are uploaded with one public key lookup
+        add_token_to_sectets(airee_repo, repo_gh, {"priv_k_dags": workspace_git.prv_k.decode()})
+        journal.record('app', 'secrets', dags_key=dags_key)
+
+    # submodule is linked to commit pushed to "workspace data" repository, it's not cloned
+    pushed = journal.done('workspace_data', 'pushed') or {}
+    app_git.link_submodule(workspace_git, 'dags', pushed.get('commit'))
+    push_once(journal, 'app', app_git, "Init commit [skip ci]", files)
 
     return app_git
 
-def infra_repo_create(airee_repo, **kwargs):
+def app_repo_create(airee_repo, workspace_git, journal=None, **kwargs):
+    """Function to create "app" repository with "workspace data" repository as a submodule.
+
+    Args:
+        airee_repo: Airee_gh_repo object.
+        workspace_git: workspace git repository object.
+        journal: Journal object with finished steps
+        kwargs: dict with params passed to render_from_template method in Airee_gh_repo object (cookiecutter params)
+    
+    Returns:
+        git repository object of "app" repository.
+    """
+    app_git, repo_gh, files = app_repo_prepare(airee_repo, journal, **kwargs)
+    return app_repo_finish(airee_repo, app_git, repo_gh, workspace_git, journal, files)
+
+@metrics.labelled(type='infra')
+def infra_repo_create(airee_repo, journal=None, **kwargs):
     """Function to create "infra" repository.
 
+    Steps finished by previous run recorded in journal are skipped.
+
     Args:
         airee_repo: Airee_gh_repo object.
-        kwargs: dict with params passed to generate_from_template method in Airee_gh_repo object (cookiecutter params)
+        journal: Journal object with finished steps
+        kwargs: dict with params passed to render_from_template method in Airee_gh_repo object (cookiecutter params)
     
     Returns:
         git repository object of "infra" repository.
     """
+    journal = journal if journal else Journal()
     path = util.get_tmp_path('infra')
-    repo_gh, priv_k, pub_k = create_repo_with_keypair(airee_repo, 'infra')
+    repo_gh, priv_k, pub_k = create_repo_with_keypair(airee_repo, 'infra', journal)
 
     logger.debug(f"Path to tmp folder: {path_join(path, 'infra')}")
     logger.debug(f"Url to repo : {repo_gh.git_url}")
 
-    add_token_to_sectets(airee_repo, repo_gh)
-    infra_git = Gitrepo(repo_gh.ssh_url, priv_k, pub_k)
+    if not journal.done('infra', 'secrets'):
+        add_token_to_sectets(airee_repo, repo_gh)
+        journal.record('infra', 'secrets')
+    infra_git = git_module.Gitrepo(repo_gh.ssh_url, priv_k, pub_k)
 
     infra_git.clone_repo(path_join(path, 'infra'))
-    airee_repo.generate_from_template('infra', path, **kwargs)
-    infra_git.commit_all("Init commit")
-    infra_git.push()
+    files = airee_repo.render_from_template('infra', path, **kwargs)
+    push_once(journal, 'infra', infra_git, "Init commit", files)
 
     return infra_git
 
+@metrics.timed('create_workspace')
+def create_workspace(airee_repo, workspace_kwargs, app_kwargs, infra_kwargs, journal=None):
+    """Function to create all Airee repositories of workspace.
+
+    Repositories are created in parallel. Only the end of "app" repository creation
+    (priv_k_dags secret, submodule and push) waits for "workspace data" repository,
+    so total time is set by the longest chain: workspace data -> app finish, or infra.
+
+    Args:
+        airee_repo: Airee_gh_repo object.
+        workspace_kwargs: dict with params passed to workspace_repo_create
+        app_kwargs: dict with params passed to app_repo_prepare
+        infra_kwargs: dict with params passed to infra_repo_create
+        journal: Journal object, repositories already pushed by previous run are skipped
+
+    Returns:
+        git repository objects of "workspace data", "app" and "infra" repositories,
+        None for repositories skipped in this run.
+    """
+    journal = journal if journal else Journal()
+    if journal.done('workspace', 'created'):
+        try:
+            airee_repo.get_airee_repo('infra')
+            logger.info(f"Workspace {airee_repo.workspace} already created")
+            return None, None, None
+        except github_exception.GithubException as e:
+            if e.status != 404:
+                raise e
+        # journal is kept after workspace was removed, it's created again from scratch
+        logger.warning(f"Workspace {airee_repo.workspace} recorded in journal doesn't exist, it's created again")
+        for type in ('workspace', 'workspace_data', 'app', 'infra'):
+            journal.forget(type)
+
+    def forked(func, *args, **kwargs):
+        # labels are kept per thread, they are set in every worker
+        with metrics.labels(workspace=airee_repo.workspace, env=airee_repo.env):
+            return func(*args, journal=journal, **kwargs)
+
+    def skipped():
+        return None
+
+    app_done = journal.done('app', 'pushed')
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # "workspace data" repository is needed by "app" repository until it's pushed
+        workspace_f = executor.submit(forked, workspace_repo_create, airee_repo.fork(), **workspace_kwargs) if not app_done else executor.submit(skipped)
+        app_f = executor.submit(forked, app_repo_prepare, airee_repo.fork(), **app_kwargs) if not app_done else executor.submit(skipped)
+        infra_f = executor.submit(forked, infra_repo_create, airee_repo.fork(), **infra_kwargs) if not journal.done('infra', 'pushed') else executor.submit(skipped)
+
+        workspace_git = workspace_f.result()
+        app_git = None
+        if not app_done:
+            app_git, app_repo_gh, app_files = app_f.result()
+            app_git = forked(app_repo_finish, airee_repo, app_git, app_repo_gh, workspace_git, files=app_files)
+        infra_git = infra_f.result()
+
+    journal.record('workspace', 'created')
+    return workspace_git, app_git, infra_git
+
+def create_kwargs(args):
+    """Function to validate "create" arguments and build params for repositories creation.
+
+    Args:
+        args: dict with "create" command arguments (workspace, env, tier, branch, project, ghrlabels,
+            ghorg, tfbuckend, key, cert, domain, dnszone, nfsdags)
+
+    Returns:
+        dicts with params passed to workspace_repo_create, app_repo_prepare and infra_repo_create.
+        If arguments are not valid, program will exit (sys exit) with status 1.
+    """
+    # check certs
+    if (args['cert'] == None) & (args['domain'] == None):
+        logger.info("Cert secret name was not passed. Self signed cert will be generated.")
+        app_cert = f"{args['workspace']}-{args['env']}-airee_cert"
+        app_key = f"{args['workspace']}-{args['env']}-airee_key"
+    elif (args['cert'] == None) & (args['domain'] != None):
+        logger.error("Domain passed without Cert! Please pass Cert Secret name.")
+        raise SystemExit(1)
+    else:
+        app_cert = args['cert']
+        app_key = args['key']
+
+    #check NFS
+    if args['nfsdags'] == 'no':
+        nfsdags = None
+    else:
+        nfsdags = args['nfsdags']
+
+    name_check(args['workspace'], "^[a-z0-9-]*$", 19, 1)
+
+    workspace_kwargs = dict(extra_context={'repo_name': 'workspace_data', 'env': args['env'], 'workspace': args['workspace'], 'org': args['ghorg'], 'labels': args['ghrlabels'], 'nfs_dags': nfsdags, 'project_id': args['project']}, default_config=True, overwrite_if_exists=True, no_input=True, checkout=args['branch'])
+    app_kwargs = dict(extra_context={'repo_name': 'app', 'env': args['env'], 'workspace': args['workspace'], 'org': args['ghorg'], 'labels': args['ghrlabels'], 'project_id': args['project'], 'key_name': app_key, 'cert_name': app_cert, 'nfs_dags': nfsdags}, default_config=True, overwrite_if_exists=True, no_input=True, checkout=args['branch'])
+    infra_kwargs = dict(extra_context={'repo_name': 'infra', 'env': args['env'], 'workspace': args['workspace'], 'org': args['ghorg'], 'airflow_performance': args['tier'], 'labels': args['ghrlabels'], 'project_id': args['project'], 'tf_backend': args['tfbuckend'], 'domain': args['domain'], 'dns_zone': args['dnszone'], 'cert_name': args['cert'], 'nfs_dags': nfsdags}, default_config=True, overwrite_if_exists=True, no_input=True, checkout=args['branch'])
+
+    return workspace_kwargs, app_kwargs, infra_kwargs
+
+def status_transition_error(old_status, status):
+    """Function to check if infra status can be changed.
+
+    Args:
+        old_status: string with current status from status.json
+        status: string with new status [up, pause, down]
+
+    Returns:
+        None if status can be changed, otherwise string with reason why operation cannot be executed.
+    """
+    if (old_status == "down") & (status == "pause"):
+        return "Pause operation cannot be execute while infra is down."
+    if old_status == status:
+        return f"{status} operation cannot be execute because infra status is now {status}"
+    return None
+
 def change_status_json(path, status):
 
     with open(path_join(path, 'infra', "status.json"), "r") as status_file:
        json_object = json.load(status_file)
 
-    if (json_object["status"] == "down") & (status == "pause"):
-        logger.error(f"Pause operation cannot be execute while infra is down.")
-        return 1
-    if json_object["status"] == status :
-        logger.error(f"{status} operation cannot be execute because infra status is now {status}")
+    error = status_transition_error(json_object["status"], status)
+    if error:
+        logger.error(error)
         return 1
     
     old_status = json_object["status"]
@@ -165,31 +400,158 @@ def change_status_json(path, status):
 
     return 0
 
-def change_status(airee_repo, status):
+def change_status_api(airee_repo, status, attempts=3):
+    """Function to change status in status.json of "infra" repository with GitHub Contents API.
 
-    path = util.get_tmp_path('infra')
+    File is updated with its blob sha, so if it was changed in meantime, file is read
+    again and transition is checked again.
+
+    Args:
+        airee_repo: Airee_gh_repo object
+        status: string with new status [up, pause, down]
+        attempts: int max number of reads and updates in case of concurrent changes
+
+    Returns:
+        string with status before operation,
+        None if Contents API can't be used and status need to be changed on cloned repository.
+    """
     repo_gh = airee_repo.get_airee_repo('infra')
-    priv_k_tmp, pub_k_tmp, dk_tmp = airee_repo.set_deploy_key('set_deploy_key', repo_gh, False)
+    for attempt in range(attempts):
+        try:
+            content, sha = airee_repo.get_file(repo_gh, "status.json")
+            json_object = json.loads(content)
+
+            old_status = json_object["status"]
+            error = status_transition_error(old_status, status)
+            if error:
+                logger.error(error)
+                return old_status
+
+            logger.info(f"Status change from {old_status} to {status}")
+            json_object["status"] = status
+            airee_repo.update_file(repo_gh, "status.json", "Update status", json.dumps(json_object, indent=2), sha)
+            return old_status
+        except github_exception.GithubException as e:
+            if e.status == 409 and attempt < attempts - 1:
+                logger.warning("status.json was changed in meantime, reading it again")
+            elif e.status in (403, 404):
+                logger.warning(f"Can't change status.json with Contents API ({e.status})")
+                return None
+            else:
+                raise
+
+def change_status_git(infra_git, path, status, attempts=3):
+    """Function to change status in cloned "infra" repository, commit and push the change.
+
+    Push is compare-and-swap, if status.json was changed in meantime push is rejected,
+    repository is synced with remote and transition is checked again with new status.
 
-    infra_git = Gitrepo(repo_gh.ssh_url, priv_k_tmp, pub_k_tmp)
-    infra_git.clone_repo(path_join(path, 'infra'))
+    Args:
+        infra_git: Gitrepo object with cloned "infra" repository
+        path: string path where "infra" directory is placed
+        status: string with new status [up, pause, down]
+        attempts: int max number of commits and pushes in case of concurrent changes
 
-    if not change_status_json(path, status):
+    Returns:
+        string with status before operation.
+    """
+    for attempt in range(attempts):
+        with open(path_join(path, 'infra', "status.json"), "r") as status_file:
+            old_status = json.load(status_file)["status"]
+        if change_status_json(path, status):
+            return old_status
         infra_git.commit_all("Update status")
-        infra_git.push()
-    
-    airee_repo.remove_deploy_key(dk_tmp)
+        try:
+            infra_git.push()
+            return old_status
+        except git_module.PushRejected:
+            if attempt == attempts - 1:
+                raise
+            logger.warning("status.json was changed in meantime, syncing with remote")
+            infra_git.sync()
+
+@metrics.labelled(type='infra')
+@metrics.timed('change_status')
+def change_status(airee_repo, status):
+    """Function to change status in status.json of "infra" repository.
 
-    return 0
+    Contents API is used if possible, otherwise repository is cloned in the cheapest clone mode which works,
+    or checked out from local mirror if config.mirror_cache_dir is set. Repository is cloned over HTTPS with
+    token shared by process (config.git_credentials = https) or over ssh with temporary deploy key.
+    Lease of workspace is held during operation, so changes of the same workspace in this process don't race,
+    changes made by other processes are detected by compare-and-swap update of status.json.
+
+    Args:
+        airee_repo: Airee_gh_repo object
+        status: string with new status [up, pause, down]
+
+    Returns:
+        string with status before operation. Status was changed
+        if status_transition_error(old_status, status) returns None.
+    """
+    with workspace_leases.hold((airee_repo.org, airee_repo.workspace, airee_repo.env)):
+        if config.status_fast_path:
+            old_status = change_status_api(airee_repo, status)
+            if old_status is not None:
+                return old_status
+
+        path = util.get_tmp_path('infra')
+        repo_gh = airee_repo.get_airee_repo('infra')
+        try:
+            with temporary_git(airee_repo, repo_gh) as infra_git:
+                if config.mirror_cache_dir:
+                    # local mirror is updated with incremental fetch instead of new clone
+                    with infra_git.worktree(path_join(path, 'infra'), git_module.MirrorCache()):
+                        old_status = change_status_git(infra_git, path, status)
+                else:
+                    # only status.json is needed, history and other files are not downloaded if possible
+                    infra_git.clone_cheapest(path_join(path, 'infra'), paths=["status.json"])
+                    old_status = change_status_git(infra_git, path, status)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return old_status
+
+@contextmanager
+def temporary_git(airee_repo, repo_gh):
+    """Function to create git repository object used by single operation on existing repository.
+
+    Repository is accessed over HTTPS with token shared by process (config.git_credentials = https),
+    deploy key is not created and removed, or over ssh with temporary deploy key removed when context ends.
+
+    Args:
+        airee_repo: Airee_gh_repo object
+        repo_gh: GitHub repository object
+
+    Returns:
+        context manager with Gitrepo object.
+    """
+    if config.git_credentials == 'https':
+        yield git_module.Gitrepo(repo_gh.clone_url, token=airee_repo.git_token)
+        return
+    priv_k_tmp, pub_k_tmp, dk_tmp = airee_repo.set_deploy_key('set_deploy_key', repo_gh, False)
+    try:
+        yield git_module.Gitrepo(repo_gh.ssh_url, priv_k_tmp, pub_k_tmp)
+    finally:
+        airee_repo.remove_deploy_key(dk_tmp, priv_k_tmp)
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Init Airee repos base on template')
+    parser.add_argument('--trace', action='store', required=False, default=os.environ.get('AIREE_TRACE'), help="json file where trace of all steps will be written (chrome://tracing format)")
+    parser.add_argument('--metrics', action='store', required=False, default=os.environ.get('AIREE_METRICS_FILE'), help="file where metrics will be written in Prometheus text format")
     subparser = parser.add_subparsers(dest='command')
     create = subparser.add_parser('create')
     pause = subparser.add_parser('pause')
     start = subparser.add_parser('start')
     destroy = subparser.add_parser('destroy')
+    warm_templates = subparser.add_parser('warm-templates')
+    create_batch = subparser.add_parser('create-batch')
+    bulk = subparser.add_parser('bulk')
+    status = subparser.add_parser('status', aliases=['list'])
+    reconcile = subparser.add_parser('reconcile')
+    upgrade = subparser.add_parser('upgrade')
+    serve = subparser.add_parser('serve')
 
     pause.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to perform actions in the repository and deploy keys - Required")
     pause.add_argument('-w', '--workspace', action='store', required=True, help="workspace name - Required")
@@ -206,6 +568,67 @@ if __name__ == "__main__":
     destroy.add_argument('-e', '--env', action='store', choices=['prd', 'dev', 'uat'], required=True, help="environment name - Required")
     destroy.add_argument('-g', '--ghorg', action='store', required=True, help="GitHub organization - Required")
 
+    warm_templates.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to read template repositories - Required")
+    warm_templates.add_argument('-g', '--ghorg', action='store', required=True, help="GitHub organization - Required")
+    warm_templates.add_argument('-b', '--branch', action='store', required=False, default='main', help="template repositories branch to be cached, optional parameter, default = main")
+
+    create_batch.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to create repositories and deploy keys - Required")
+    create_batch.add_argument('-g', '--ghorg', action='store', required=True, help="GitHub organization - Required")
+    create_batch.add_argument('-m', '--manifest', action='store', required=True, help="YAML, JSON or CSV file with workspaces, each with the same fields as 'create' arguments - Required")
+    create_batch.add_argument('-j', '--workers', action='store', type=int, required=False, default=config.batch_workers, help=f"number of workspaces created in parallel - default={config.batch_workers}")
+    create_batch.add_argument('-o', '--report', action='store', required=False, default=None, help="json file where result per workspace will be written")
+    create_batch.add_argument('--journal', action='store', required=False, default=config.journal_dir, help="directory of journals with finished steps, run again after failure continues from failed steps")
+
+    reconcile.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to create repositories and change status - Required")
+    reconcile.add_argument('-g', '--ghorg', action='store', required=True, help="GitHub organization - Required")
+    reconcile.add_argument('-m', '--manifest', action='store', required=True, help="YAML, JSON or CSV file with desired workspaces, each with 'create' fields and optional status [up, pause, down] - Required")
+    reconcile.add_argument('-j', '--workers', action='store', type=int, required=False, default=config.batch_workers, help=f"number of workspaces changed in parallel - default={config.batch_workers}")
+    reconcile.add_argument('-n', '--dry-run', action='store_true', help="only print actions")
+    reconcile.add_argument('-o', '--report', action='store', required=False, default=None, help="json file where actions and results will be written")
+    reconcile.add_argument('--journal', action='store', required=False, default=config.journal_dir, help="directory of journals with finished steps, run again after failure continues from failed steps")
+
+    upgrade.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to read templates and push to repositories - Required")
+    upgrade.add_argument('-g', '--ghorg', action='store', required=True, help="GitHub organization - Required")
+    upgrade.add_argument('-b', '--branch', action='store', required=False, default='main', help="template repositories branch or tag to upgrade to, resolved once for all workspaces - default = main")
+    upgrade.add_argument('--types', action='store', required=False, default=None, help="comma separated list of repository types [workspace_data, app, infra] - default all")
+    upgrade.add_argument('-e', '--env', action='store', choices=['prd', 'dev', 'uat'], required=False, default=None, help="select workspaces with environment")
+    upgrade.add_argument('-m', '--match', action='store', required=False, default=None, help="select workspaces with name matching glob, e.g. 'team-*'")
+    upgrade.add_argument('-w', '--workspaces', action='store', required=False, default=None, help="comma separated list of workspace names, with --env or all environments")
+    upgrade.add_argument('--manifest', action='store', required=False, default=None, help="YAML, JSON or CSV file with 'create' fields of workspaces, context of repositories created without template metadata")
+    upgrade.add_argument('--base', action='store', required=False, default=None, help="template commit sha which repositories without template metadata were created from, used with --manifest")
+    upgrade.add_argument('--canary', action='store', type=int, required=False, default=1, help="number of workspaces upgraded before the others - default=1")
+    upgrade.add_argument('--batch-size', action='store', type=int, required=False, default=None, help="number of workspaces upgraded in one batch after canary - default all")
+    upgrade.add_argument('--max-failures', action='store', type=int, required=False, default=0, help="number of failed workspaces after which rollout stops - default=0")
+    upgrade.add_argument('-j', '--workers', action='store', type=int, required=False, default=config.batch_workers, help=f"number of workspaces upgraded in parallel - default={config.batch_workers}")
+    upgrade.add_argument('-n', '--dry-run', action='store_true', help="only print changed files")
+    upgrade.add_argument('-o', '--report', action='store', required=False, default=None, help="json file where result per repository will be written")
+
+    bulk.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to perform actions in the repository - Required")
+    bulk.add_argument('-g', '--ghorg', action='store', required=True, help="GitHub organization - Required")
+    bulk.add_argument('-a', '--action', action='store', choices=list(STATUS_ACTIONS), required=True, help="operation executed on every selected workspace - Required")
+    bulk.add_argument('--all', action='store_true', help="select all workspaces in organization")
+    bulk.add_argument('-e', '--env', action='store', choices=['prd', 'dev', 'uat'], required=False, default=None, help="select workspaces with environment")
+    bulk.add_argument('-m', '--match', action='store', required=False, default=None, help="select workspaces with name matching glob, e.g. 'team-*'")
+    bulk.add_argument('-w', '--workspaces', action='store', required=False, default=None, help="comma separated list of workspace names, with --env or all environments")
+    bulk.add_argument('-j', '--workers', action='store', type=int, required=False, default=config.batch_workers, help=f"number of workspaces changed in parallel - default={config.batch_workers}")
+    bulk.add_argument('-n', '--dry-run', action='store_true', help="only list selected workspaces")
+    bulk.add_argument('-o', '--report', action='store', required=False, default=None, help="json file where summary will be written")
+
+    status.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to read repositories - Required")
+    status.add_argument('-g', '--ghorg', action='store', required=True, help="GitHub organization - Required")
+    status.add_argument('-e', '--env', action='store', choices=['prd', 'dev', 'uat'], required=False, default=None, help="select workspaces with environment")
+    status.add_argument('-m', '--match', action='store', required=False, default=None, help="select workspaces with name matching glob, e.g. 'team-*'")
+    status.add_argument('-w', '--workspaces', action='store', required=False, default=None, help="comma separated list of workspace names, with --env repositories are queried by name")
+    status.add_argument('--json', action='store_true', help="print statuses as json")
+    status.add_argument('-o', '--report', action='store', required=False, default=None, help="json file where statuses will be written")
+
+    serve.add_argument('-t', '--token', action='store', required=False, default=os.environ.get('AIREE_GH_TOKEN'), help="GitHub PAT used by all jobs, default from AIREE_GH_TOKEN env variable")
+    serve.add_argument('-g', '--ghorg', action='store', required=False, default=None, help="default GitHub organization of jobs")
+    serve.add_argument('--host', action='store', required=False, default=None, help="address to listen on - default=0.0.0.0 with AIREE_API_KEY, 127.0.0.1 without it")
+    serve.add_argument('--port', action='store', type=int, required=False, default=8080, help="port to listen on - default=8080")
+    serve.add_argument('-j', '--workers', action='store', type=int, required=False, default=config.batch_workers, help=f"number of jobs executed in parallel - default={config.batch_workers}")
+    serve.add_argument('--db', action='store', required=False, default=config.service_db, help=f"sqlite database with job queue - default={config.service_db}")
+
     create.add_argument('-t', '--token', action='store', required=True, help="GitHub PAT needed to create repositories and deploy keys - Required")
     create.add_argument('-w', '--workspace', action='store', required=True, help="workspace name - Required")
     create.add_argument('-e', '--env', action='store', choices=['prd', 'dev', 'uat'], required=False, default='dev', help="environment name (for future purposes) - default='dev'")
@@ -220,48 +643,91 @@ if __name__ == "__main__":
     create.add_argument('-d', '--domain', action='store', required=False, default=None, help="name of domain in GCP Project")
     create.add_argument('-z', '--dnszone', action='store', required=False, default=None, help="name of dns-zone service in GCP Project")
     create.add_argument('-n', '--nfsdags', action='store', required=False, choices=['yes', 'no'], default='no', help="Flag if DAGs will be keeped on NFS, otherwise DAGs will be in image")
+    create.add_argument('--journal', action='store', required=False, default=config.journal_dir, help="directory of journal with finished steps, run again after failure continues from failed step")
     args = vars(parser.parse_args())
+    # files are written also when command exits with error
+    if args['trace']:
+        metrics.enable_trace()
+        atexit.register(metrics.write_trace, args['trace'])
+    if args['metrics']:
+        atexit.register(metrics.write_metrics, args['metrics'])
     
 
     if args['command'] == 'create':
-        # check certs
-        if (args['cert'] == None) & (args['domain'] == None):
-            logging.info(f"Cert secret name was not passed. Self signed cert will be generated.")
-            app_cert = f"{args['workspace']}-{args['env']}-airee_cert"
-            app_key = f"{args['workspace']}-{args['env']}-airee_key"
-        elif (args['cert'] == None) & (args['domain'] != None):
-            logging.error("Domain passed without Cert! Please pass Cert Secret name.")
-            exit(1)
-        else:
-            app_cert = args['cert']
-            app_key = args['key']
-
-        #check NFS
-        if args['nfsdags'] == 'no':
-            nfsdags = None
-        else:
-            nfsdags = args['nfsdags']
-
+        workspace_kwargs, app_kwargs, infra_kwargs = create_kwargs(args)
         try:
-            name_check(args['workspace'], "^[a-z0-9-]*$", 19, 1)
-            airee = Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
-            workspace_data = workspace_repo_create(airee, extra_context={'repo_name': 'workspace_data', 'env': args['env'], 'workspace': args['workspace'], 'org': airee.org, 'labels': args['ghrlabels'], 'nfs_dags': nfsdags, 'project_id': args['project']}, default_config=True, overwrite_if_exists=True, no_input=True, checkout=args['branch'])
-            app = app_repo_create(airee, workspace_data, extra_context={'repo_name': 'app', 'env': args['env'], 'workspace': args['workspace'], 'org': airee.org, 'labels': args['ghrlabels'], 'project_id': args['project'], 'key_name': app_key, 'cert_name': app_cert, 'nfs_dags': nfsdags}, default_config=True, overwrite_if_exists=True, no_input=True, checkout=args['branch'])
-            infra = infra_repo_create(airee, extra_context={'repo_name': 'infra', 'env': args['env'], 'workspace': args['workspace'], 'org': airee.org, 'airflow_performance': args['tier'], 'labels': args['ghrlabels'], 'project_id': args['project'], 'tf_backend': args['tfbuckend'], 'domain': args['domain'], 'dns_zone': args['dnszone'], 'cert_name': args['cert'], 'nfs_dags': nfsdags}, default_config=True, overwrite_if_exists=True, no_input=True, checkout=args['branch'])
+            airee = airee_repos.Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
+            journal = Journal.for_workspace(args['journal'], args['ghorg'], args['workspace'], args['env'])
+            workspace_data, app, infra = create_workspace(airee, workspace_kwargs, app_kwargs, infra_kwargs, journal)
 
         except Exception as e:
             logger.error(str(e))
 
     elif args['command'] == 'pause':
-        airee = Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
-        infra = change_status(airee, 'pause')
+        airee = airee_repos.Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
+        infra = change_status(airee, STATUS_ACTIONS['pause'])
         
     elif args['command'] == 'start':
-        airee = Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
-        infra = change_status(airee, 'up')
+        airee = airee_repos.Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
+        infra = change_status(airee, STATUS_ACTIONS['start'])
 
     elif args['command'] == 'destroy':
-        airee = Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
-        infra = change_status(airee, 'down')
+        airee = airee_repos.Airee_gh_repo(args['token'], args['workspace'], env=args['env'], org=args['ghorg'])
+        infra = change_status(airee, STATUS_ACTIONS['destroy'])
+
+    elif args['command'] == 'bulk':
+        import fleet
+        if not (args['all'] or args['env'] or args['match'] or args['workspaces']):
+            logger.error("Pass --all to change status of all workspaces in organization")
+            raise SystemExit(1)
+        workspaces = args['workspaces'].split(',') if args['workspaces'] else None
+        summary = fleet.bulk_status(args['token'], args['ghorg'], STATUS_ACTIONS[args['action']], env=args['env'], match=args['match'], workspaces=workspaces, workers=args['workers'], dry_run=args['dry_run'], report=args['report'])
+        if summary['failed']:
+            raise SystemExit(1)
+
+    elif args['command'] in ('status', 'list'):
+        import fleet
+        workspaces = args['workspaces'].split(',') if args['workspaces'] else None
+        statuses = fleet.inventory(args['token'], args['ghorg'], env=args['env'], match=args['match'], workspaces=workspaces, report=args['report'])
+        if args['json']:
+            print(json.dumps(statuses, indent=2))
+        else:
+            for s in statuses:
+                print(f"{s['workspace']}\t{s['env']}\t{s['status'] or s['error']}")
+
+    elif args['command'] == 'create-batch':
+        import fleet
+        results = fleet.create_batch(args['token'], args['ghorg'], fleet.load_manifest(args['manifest']), args['workers'], args['report'], args['journal'])
+        if any(r['status'] == 'failed' for r in results):
+            raise SystemExit(1)
+
+    elif args['command'] == 'reconcile':
+        import fleet
+        results = fleet.reconcile(args['token'], args['ghorg'], fleet.load_manifest(args['manifest']), args['workers'], args['dry_run'], args['report'], args['journal'])
+        if any(r['result'] == 'failed' for r in results):
+            raise SystemExit(1)
+
+    elif args['command'] == 'upgrade':
+        import fleet, upgrade
+        if args['types'] and not set(args['types'].split(',')) <= set(upgrade.TYPES):
+            logger.error(f"Types need to be from {upgrade.TYPES}")
+            raise SystemExit(1)
+        types = args['types'].split(',') if args['types'] else None
+        workspaces = args['workspaces'].split(',') if args['workspaces'] else None
+        manifest = fleet.load_manifest(args['manifest']) if args['manifest'] else None
+        results = upgrade.upgrade_fleet(args['token'], args['ghorg'], args['branch'], types, env=args['env'], match=args['match'], workspaces=workspaces, manifest=manifest, base=args['base'],
+                                        workers=args['workers'], canary=args['canary'], batch_size=args['batch_size'], max_failures=args['max_failures'], dry_run=args['dry_run'], report=args['report'])
+        if any(r['result'] in ('failed', 'not_started') for r in results):
+            raise SystemExit(1)
+
+    elif args['command'] == 'serve':
+        import service
+        if not args['token']:
+            logger.error("Pass --token or set AIREE_GH_TOKEN env variable")
+            raise SystemExit(1)
+        service.Service(args['token'], args['ghorg'], args['workers'], config.service_api_key or None, args['db']).serve(args['host'], args['port'])
+
+    elif args['command'] == 'warm-templates':
+        template_cache.TemplateCache().warm(args['token'], args['ghorg'], args['branch'])
     
    
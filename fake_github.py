@@ -0,0 +1,457 @@
+"""Module with local stand-in of GitHub REST API used by benchmarks.
+
+Server implements endpoints used by airee_repos (organizations, repositories, deploy keys,
+secrets, contents and GitHub App installation tokens) and GraphQL queries of fleet (repositories by alias and pages of organization
+repositories with object(expression: ...) of blob). Repositories are local bare git repositories, their ssh_url
+is file:// url, so Gitrepo clones and pushes without network.
+Latency of every request and rate limits can be injected to reproduce GitHub behaviour.
+GET responses have ETag and conditional requests are answered with 304 Not Modified,
+which is not counted against rate limit, as by GitHub.
+
+Module use only standard library and git command line.
+
+    Typical usege:
+
+    server = FakeGitHub('/tmp/bench', latency=0.05)
+    server.start()
+    os.environ['AIREE_GH_API_URL'] = server.url
+    ...
+    server.stop()
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# libsodium public key used only to accept encrypted secrets, values are not decrypted
+PUBLIC_KEY = base64.b64encode(b'airee-benchmark-public-key-32byt').decode()
+
+
+class FakeGitHub:
+    """Class with local fake GitHub server.
+
+    Attributes:
+        root: string path of directory with bare repositories
+        latency: float seconds added to every request
+        rate_limit: int requests allowed per rate_window, unlimited if 0
+        rate_window: int seconds of primary rate limit window
+        secondary_every: int every n-th write request is answered with secondary rate limit, disabled if 0
+        url: string url of API after start
+        requests: dict with number of requests per "METHOD endpoint"
+    """
+    def __init__(self, root, latency=0, rate_limit=0, rate_window=3600, secondary_every=0, host='127.0.0.1', port=0):
+        """Create FakeGitHub object."""
+        self.root = root
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.secondary_every = secondary_every
+        self.requests = {}
+        self.orgs = {}
+        self.repos = {}
+        self.secrets = {}
+        self.lock = threading.RLock()
+        self.__ids = itertools.count(1)
+        self.__writes = itertools.count(1)
+        self.__window = (time.time() + rate_window, 0)
+        self.__repo_locks = {}
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        self.__server.fake = self
+        self.url = f'http://{host}:{self.__server.server_address[1]}'
+        os.makedirs(root, exist_ok=True)
+
+    def start(self):
+        """Start server in background thread."""
+        threading.Thread(target=self.__server.serve_forever, name='fake-github', daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop server."""
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def next_id(self):
+        """Return new unique id."""
+        return next(self.__ids)
+
+    def count(self, verb, endpoint):
+        """Count request and return rate limit headers and message if request is rate limited, None otherwise."""
+        with self.lock:
+            key = f'{verb} {endpoint}'
+            self.requests[key] = self.requests.get(key, 0) + 1
+            reset, used = self.__window
+            if time.time() > reset:
+                reset, used = time.time() + self.rate_window, 0
+            used += 1
+            self.__window = (reset, used)
+            headers = {}
+            if self.rate_limit:
+                headers = {
+                    'X-RateLimit-Limit': str(self.rate_limit),
+                    'X-RateLimit-Remaining': str(max(self.rate_limit - used, 0)),
+                    'X-RateLimit-Reset': str(int(reset)),
+                }
+                if used > self.rate_limit:
+                    return headers, 'API rate limit exceeded'
+            if self.secondary_every and verb in ('POST', 'PUT', 'PATCH', 'DELETE') and next(self.__writes) % self.secondary_every == 0:
+                return dict(headers, **{'Retry-After': '1'}), 'You have exceeded a secondary rate limit'
+            return headers, None
+
+    def refund(self, verb, endpoint):
+        """Give back rate limit of request answered with 304 Not Modified and count it."""
+        with self.lock:
+            key = f'{verb} {endpoint} 304'
+            self.requests[key] = self.requests.get(key, 0) + 1
+            reset, used = self.__window
+            self.__window = (reset, max(used - 1, 0))
+
+    def repo_lock(self, full_name):
+        """Return lock serializing changes of repository content."""
+        with self.lock:
+            return self.__repo_locks.setdefault(full_name, threading.Lock())
+
+    def api(self, path):
+        """Return absolute API url of path."""
+        return f'{self.url}{path}'
+
+    def org(self, login):
+        """Return organization, it's created on first use."""
+        with self.lock:
+            if login not in self.orgs:
+                self.orgs[login] = {'login': login, 'id': self.next_id(), 'url': self.api(f'/orgs/{login}'), 'repos_url': self.api(f'/orgs/{login}/repos')}
+            return self.orgs[login]
+
+    def git_dir(self, full_name):
+        """Return path of bare repository."""
+        return os.path.join(self.root, f'{full_name}.git')
+
+    def create_repo(self, org, name, private=True, auto_init=False):
+        """Create repository, with initial commit on main if auto_init is set."""
+        full_name = f'{org}/{name}'
+        with self.lock:
+            if full_name in self.repos:
+                return None
+            repo = {
+                'id': self.next_id(), 'name': name, 'full_name': full_name, 'private': private,
+                'owner': self.org(org), 'default_branch': 'main',
+                'url': self.api(f'/repos/{full_name}'), 'html_url': f'{self.url}/{full_name}',
+                'ssh_url': f'file://{self.git_dir(full_name)}', 'clone_url': f'file://{self.git_dir(full_name)}',
+                'git_url': f'file://{self.git_dir(full_name)}', 'keys': {},
+            }
+            self.repos[full_name] = repo
+        git_dir = self.git_dir(full_name)
+        git('init', '-q', '--bare', git_dir, cwd=None)
+        git('symbolic-ref', 'HEAD', 'refs/heads/main', cwd=git_dir)
+        git('config', 'uploadpack.allowFilter', 'true', cwd=git_dir)
+        git('config', 'uploadpack.allowAnySHA1InWant', 'true', cwd=git_dir)
+        if auto_init:
+            self.write_file(full_name, 'README.md', f'# {name}\n'.encode(), 'Initial commit')
+        return repo
+
+    def delete_repo(self, full_name):
+        """Delete repository and its bare git directory."""
+        with self.lock:
+            repo = self.repos.pop(full_name, None)
+        if repo:
+            shutil.rmtree(self.git_dir(full_name), ignore_errors=True)
+        return repo
+
+    def read_file(self, full_name, path, ref='main'):
+        """Return content and blob sha of file, None if it doesn't exist."""
+        git_dir = self.git_dir(full_name)
+        try:
+            sha = git('rev-parse', f'{ref}:{path}', cwd=git_dir).strip()
+        except subprocess.CalledProcessError:
+            return None
+        return git('cat-file', 'blob', sha, cwd=git_dir, binary=True), sha
+
+    def write_file(self, full_name, path, content, message, sha=None):
+        """Commit file on main branch.
+
+        Args:
+            full_name: string full name of repository
+            path: string path of file
+            content: bytes with content
+            message: string commit message
+            sha: string blob sha of replaced file, None for new file
+        Returns:
+            string blob sha and commit sha, None if sha doesn't match current file (conflict).
+        """
+        git_dir = self.git_dir(full_name)
+        with self.repo_lock(full_name):
+            current = self.read_file(full_name, path)
+            if (current[1] if current else None) != sha:
+                return None
+            blob = git('hash-object', '-w', '--stdin', cwd=git_dir, input=content).strip()
+            fd, index = tempfile.mkstemp(prefix='fake_github_index')
+            os.close(fd)
+            os.remove(index)
+            env = {'GIT_INDEX_FILE': index}
+            try:
+                parent = git('rev-parse', '-q', '--verify', 'refs/heads/main', cwd=git_dir, check=False).strip()
+                if parent:
+                    git('read-tree', parent, cwd=git_dir, env=env)
+                git('update-index', '--add', '--cacheinfo', f'100644,{blob},{path}', cwd=git_dir, env=env)
+                tree = git('write-tree', cwd=git_dir, env=env).strip()
+            finally:
+                if os.path.exists(index):
+                    os.remove(index)
+            commit = git('commit-tree', tree, *(['-p', parent] if parent else []), '-m', message, cwd=git_dir, env=AUTHOR).strip()
+            git('update-ref', 'refs/heads/main', commit, *([parent] if parent else []), cwd=git_dir)
+        return blob, commit
+
+
+AUTHOR = {'GIT_AUTHOR_NAME': 'fake', 'GIT_AUTHOR_EMAIL': 'fake@localhost', 'GIT_COMMITTER_NAME': 'fake', 'GIT_COMMITTER_EMAIL': 'fake@localhost'}
+
+
+def git(*args, cwd=None, env=None, input=None, binary=False, check=True):
+    """Run git command line and return its output, bytes if binary is set."""
+    r = subprocess.run(['git', *args], cwd=cwd, env=dict(os.environ, **(env or {})), capture_output=True,
+                       input=input.encode() if isinstance(input, str) else input)
+    if check and r.returncode != 0:
+        raise subprocess.CalledProcessError(r.returncode, ['git', *args], r.stdout, r.stderr)
+    return r.stdout if binary else r.stdout.decode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP request handler of fake GitHub API."""
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', r'/orgs/(?P<org>[^/]+)', 'get_org'),
+        ('GET', r'/orgs/(?P<org>[^/]+)/repos', 'list_repos'),
+        ('GET', r'/orgs/(?P<org>[^/]+)/installation', 'org_installation'),
+        ('POST', r'/app/installations/(?P<installation>\d+)/access_tokens', 'installation_token'),
+        ('POST', r'/orgs/(?P<org>[^/]+)/repos', 'create_repo'),
+        ('GET', r'/orgs/(?P<org>[^/]+)/actions/secrets/public-key', 'public_key'),
+        ('PUT', r'/orgs/(?P<org>[^/]+)/actions/secrets/(?P<name>[^/]+)', 'put_org_secret'),
+        ('GET', r'/orgs/(?P<org>[^/]+)/actions/secrets/(?P<name>[^/]+)/repositories', 'org_secret_repos'),
+        ('PUT', r'/orgs/(?P<org>[^/]+)/actions/secrets/(?P<name>[^/]+)/repositories/(?P<id>\d+)', 'add_org_secret_repo'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)', 'get_repo'),
+        ('DELETE', r'/repos/(?P<repo>[^/]+/[^/]+)', 'delete_repo'),
+        ('POST', r'/repos/(?P<repo>[^/]+/[^/]+)/keys', 'create_key'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/keys/(?P<id>\d+)', 'get_key'),
+        ('DELETE', r'/repos/(?P<repo>[^/]+/[^/]+)/keys/(?P<id>\d+)', 'delete_key'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/actions/secrets/public-key', 'public_key'),
+        ('PUT', r'/repos/(?P<repo>[^/]+/[^/]+)/actions/secrets/(?P<name>[^/]+)', 'put_secret'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/contents/(?P<path>.+)', 'get_contents'),
+        ('PUT', r'/repos/(?P<repo>[^/]+/[^/]+)/contents/(?P<path>.+)', 'put_contents'),
+        ('POST', r'/graphql', 'graphql'),
+    ]
+
+    def do_GET(self):
+        self.__dispatch('GET')
+
+    def do_POST(self):
+        self.__dispatch('POST')
+
+    def do_PUT(self):
+        self.__dispatch('PUT')
+
+    def do_DELETE(self):
+        self.__dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    # endpoints, each returns status and json body
+
+    def get_org(self, org):
+        return 200, self.fake.org(org)
+
+    def org_installation(self, org):
+        # GitHub App is installed in every organization, JWT is not verified
+        return 200, {'id': self.fake.org(org)['id'], 'account': {'login': org}}
+
+    def installation_token(self, installation):
+        expires = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 3600))
+        return 201, {'token': f'ghs_{installation}_{self.fake.next_id()}', 'expires_at': expires}
+
+    def list_repos(self, org):
+        query = parse_qs(urlparse(self.path).query)
+        per_page, page = int(query.get('per_page', [30])[0]), int(query.get('page', [1])[0])
+        with self.fake.lock:
+            repos = sorted((r for r in self.fake.repos.values() if r['owner']['login'] == org), key=lambda r: r['id'])
+        if page * per_page < len(repos):
+            self.extra_headers['Link'] = f'<{self.fake.api(f"/orgs/{org}/repos")}?per_page={per_page}&page={page + 1}>; rel="next"'
+        return 200, [self.__repo(r) for r in repos[(page - 1) * per_page:page * per_page]]
+
+    def create_repo(self, org):
+        body = self.body
+        repo = self.fake.create_repo(org, body['name'], body.get('private', True), body.get('auto_init', False))
+        if repo is None:
+            return 422, {'message': 'Repository creation failed.', 'errors': [{'resource': 'Repository', 'code': 'custom', 'field': 'name', 'message': 'name already exists on this account'}]}
+        return 201, self.__repo(repo)
+
+    def get_repo(self, repo):
+        r = self.fake.repos.get(repo)
+        return (200, self.__repo(r)) if r else (404, {'message': 'Not Found'})
+
+    def delete_repo(self, repo):
+        return (204, None) if self.fake.delete_repo(repo) else (404, {'message': 'Not Found'})
+
+    def create_key(self, repo):
+        r = self.fake.repos.get(repo)
+        if not r:
+            return 404, {'message': 'Not Found'}
+        key_id = self.fake.next_id()
+        key = {'id': key_id, 'key': self.body['key'], 'title': self.body.get('title'), 'read_only': self.body.get('read_only', True),
+               'verified': True, 'url': self.fake.api(f'/repos/{repo}/keys/{key_id}')}
+        r['keys'][key_id] = key
+        return 201, key
+
+    def get_key(self, repo, id):
+        key = self.fake.repos.get(repo, {}).get('keys', {}).get(int(id))
+        return (200, key) if key else (404, {'message': 'Not Found'})
+
+    def delete_key(self, repo, id):
+        key = self.fake.repos.get(repo, {}).get('keys', {}).pop(int(id), None)
+        return (204, None) if key else (404, {'message': 'Not Found'})
+
+    def public_key(self, repo=None, org=None):
+        return 200, {'key_id': '1', 'key': PUBLIC_KEY}
+
+    def put_secret(self, repo, name):
+        if repo not in self.fake.repos:
+            return 404, {'message': 'Not Found'}
+        with self.fake.lock:
+            new = (repo, name) not in self.fake.secrets
+            self.fake.secrets[(repo, name)] = self.body
+        return (201 if new else 204), None
+
+    def put_org_secret(self, org, name):
+        with self.fake.lock:
+            new = (org, name) not in self.fake.secrets
+            self.fake.secrets[(org, name)] = dict(self.body, selected_repository_ids=list(self.body.get('selected_repository_ids', [])))
+        return (201 if new else 204), None
+
+    def org_secret_repos(self, org, name):
+        secret = self.fake.secrets.get((org, name))
+        if not secret:
+            return 404, {'message': 'Not Found'}
+        repos = [{'id': i} for i in secret['selected_repository_ids']]
+        return 200, {'total_count': len(repos), 'repositories': repos}
+
+    def add_org_secret_repo(self, org, name, id):
+        secret = self.fake.secrets.get((org, name))
+        if not secret:
+            return 404, {'message': 'Not Found'}
+        with self.fake.lock:
+            if int(id) not in secret['selected_repository_ids']:
+                secret['selected_repository_ids'].append(int(id))
+        return 204, None
+
+    def get_contents(self, repo, path):
+        if repo not in self.fake.repos:
+            return 404, {'message': 'Not Found'}
+        path = unquote(path)
+        ref = parse_qs(urlparse(self.path).query).get('ref', ['main'])[0]
+        found = self.fake.read_file(repo, path, ref)
+        if not found:
+            return 404, {'message': 'Not Found'}
+        return 200, self.__content(repo, path, *found)
+
+    def put_contents(self, repo, path):
+        if repo not in self.fake.repos:
+            return 404, {'message': 'Not Found'}
+        path = unquote(path)
+        body = self.body
+        written = self.fake.write_file(repo, path, base64.b64decode(body['content']), body['message'], body.get('sha'))
+        if not written:
+            return 409, {'message': f'{path} does not match {body.get("sha")}'}
+        blob, commit = written
+        content = self.__content(repo, path, b'', blob)
+        content.pop('content')
+        return 200, {'content': content, 'commit': {'sha': commit, 'message': body['message'], 'url': self.fake.api(f'/repos/{repo}/git/commits/{commit}')}}
+
+    def graphql(self):
+        # only query shapes sent by fleet are understood, not general GraphQL
+        query, variables = self.body.get('query', ''), self.body.get('variables') or {}
+        expression = re.search(r'object\(expression: "([^":]+):([^"]+)"\)', query)
+
+        def node(full_name):
+            found = self.fake.read_file(full_name, expression[2], expression[1]) if expression else None
+            return {'name': full_name.split('/', 1)[1], 'object': {'text': found[0].decode()} if found else None}
+
+        data, errors = {}, []
+        if 'organization(' in query:
+            first = re.search(r'repositories\(first: \$?(\w+)', query)[1]
+            first = int(variables[first] if first in variables else first)
+            offset = int(variables.get('after') or 0)
+            with self.fake.lock:
+                names = sorted(name for name, r in self.fake.repos.items() if r['owner']['login'] == variables['owner'])
+            page = names[offset:offset + first]
+            data['organization'] = {'repositories': {
+                'pageInfo': {'hasNextPage': offset + first < len(names), 'endCursor': str(offset + len(page))},
+                'nodes': [node(name) for name in page],
+            }}
+        for alias, name in re.findall(r'(\w+): repository\(owner: \$owner, name: \$(\w+)\)', query):
+            full_name = f"{variables['owner']}/{variables[name]}"
+            if full_name in self.fake.repos:
+                data[alias] = node(full_name)
+            else:
+                data[alias] = None
+                errors.append({'type': 'NOT_FOUND', 'path': [alias], 'message': f"Could not resolve to a Repository with the name '{full_name}'."})
+        return 200, dict(data=data, **({'errors': errors} if errors else {}))
+
+    def __repo(self, r):
+        return {k: v for k, v in r.items() if k != 'keys'}
+
+    def __content(self, repo, path, content, sha):
+        return {'type': 'file', 'encoding': 'base64', 'content': base64.b64encode(content).decode(), 'sha': sha,
+                'name': os.path.basename(path), 'path': path, 'size': len(content),
+                'url': self.fake.api(f'/repos/{repo}/contents/{path}')}
+
+    def __dispatch(self, verb):
+        self.fake = self.server.fake
+        self.extra_headers = {}
+        path = urlparse(self.path).path.rstrip('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        self.body = json.loads(raw) if raw else {}
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+        for route_verb, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_verb == verb and match:
+                break
+        else:
+            return self.__reply(404, {'message': 'Not Found'}, {})
+
+        headers, limited = self.fake.count(verb, pattern)
+        if limited:
+            return self.__reply(403, {'message': limited}, headers)
+        if not self.headers.get('Authorization'):
+            return self.__reply(401, {'message': 'Requires authentication'}, headers)
+        status, data = getattr(self, name)(**match.groupdict())
+        if verb == 'GET' and status == 200:
+            etag = f'"{hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()}"'
+            self.extra_headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                self.fake.refund(verb, pattern)
+                return self.__reply(304, None, dict(headers, **self.extra_headers))
+        self.__reply(status, data, dict(headers, **self.extra_headers))
+
+    def __reply(self, status, data, headers):
+        payload = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
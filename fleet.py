@@ -0,0 +1,518 @@
+"""Module with operations on many Airee workspaces in one process.
+
+All workspaces share one GitHub client, one Organization object and one template cache.
+
+    Typical usege:
+
+    workspaces = load_manifest("workspaces.yaml")
+    report = create_batch(PAT, github_org, workspaces, workers=8)
+    summary = bulk_status(PAT, github_org, 'pause', env='dev')
+    statuses = inventory(PAT, github_org, env='dev')
+    summary = reconcile(PAT, github_org, load_manifest("workspaces.yaml"), workers=8)
+"""
+from airee_repos import Airee_gh_repo
+from pair_key import KeyPool
+from journal import Journal
+import entrypoint_init
+import config, gh_client, metrics
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import csv
+import json
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+# the same defaults and choices as in "create" command arguments
+CREATE_DEFAULTS = {
+    'env': 'dev',
+    'branch': 'main',
+    'ghrlabels': 'airflow',
+    'key': None,
+    'cert': None,
+    'domain': None,
+    'dnszone': None,
+    'nfsdags': 'no',
+}
+CREATE_REQUIRED = ['workspace', 'tier', 'project', 'tfbuckend']
+CREATE_CHOICES = {
+    'env': ['prd', 'dev', 'uat'],
+    'tier': ['small', 'standard', 'large'],
+    'nfsdags': ['yes', 'no'],
+}
+# name of "infra" repository in order to Airee naming convention
+INFRA_REPO = re.compile(r'^(?P<workspace>.+)_infra_(?P<env>{})$'.format('|'.join(CREATE_CHOICES['env'])))
+# status.json is read as blob of main branch, so repositories are not cloned
+STATUS_OBJECT = 'object(expression: "main:status.json") { ... on Blob { text } }'
+# page of organization repositories with status.json, GitHub returns max 100 repositories per page
+ORG_STATUS_QUERY = '''query($owner: String!, $first: Int!, $after: String) {
+  organization(login: $owner) {
+    repositories(first: $first, after: $after, orderBy: {field: NAME, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name %s }
+    }
+  }
+}''' % STATUS_OBJECT
+# statuses which can be set in status.json of "infra" repository
+STATUSES = ['up', 'pause', 'down']
+
+
+def load_manifest(path):
+    """Function to read list of workspaces from YAML, JSON or CSV file.
+
+    YAML and JSON file can contain list of workspaces or dict with "workspaces" key.
+    Each workspace has the same fields as "create" command arguments, e.g.
+    workspace, env, tier, branch, project, ghrlabels, tfbuckend, key, cert, domain, dnszone, nfsdags.
+
+    Args:
+        path: string path of manifest file
+    Returns:
+        list of dicts with workspaces.
+    """
+    with open(path, 'r') as manifest_file:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            workspaces = yaml.safe_load(manifest_file)
+        elif path.endswith('.json'):
+            workspaces = json.load(manifest_file)
+        elif path.endswith('.csv'):
+            workspaces = [{k: v if v != '' else None for k, v in row.items()} for row in csv.DictReader(manifest_file)]
+        else:
+            logger.error(f"Manifest {path} should be .yaml, .yml, .json or .csv file")
+            raise SystemExit(1)
+
+    if isinstance(workspaces, dict):
+        workspaces = workspaces.get('workspaces', [])
+    logger.info(f"{len(workspaces)} workspaces loaded from {path}")
+    return workspaces
+
+
+def create_args(workspace, token, ghorg):
+    """Function to build "create" command arguments for workspace from manifest.
+
+    Args:
+        workspace: dict with workspace from manifest
+        token: string value of PAT
+        ghorg: string name of GitHub Organization
+    Returns:
+        dict with "create" command arguments.
+        ValueError is raised if workspace is not valid.
+    """
+    args = dict(CREATE_DEFAULTS)
+    # YAML reads yes/no as bool and numbers as int, arguments are always strings
+    args.update({k: ('yes' if v else 'no') if isinstance(v, bool) else str(v) for k, v in workspace.items() if v is not None})
+    args.update({'command': 'create', 'token': token, 'ghorg': ghorg})
+
+    missing = [field for field in CREATE_REQUIRED if not args.get(field)]
+    if missing:
+        raise ValueError(f"Missing fields {', '.join(missing)}")
+    for field, choices in CREATE_CHOICES.items():
+        if args[field] not in choices:
+            raise ValueError(f"Field {field} should be one of {', '.join(choices)}, not {args[field]}")
+    return args
+
+
+def create_one(airee_repo, workspace, journal_dir=None):
+    """Function to create all repositories of single workspace from manifest.
+
+    Args:
+        airee_repo: Airee_gh_repo object shared by batch
+        workspace: dict with workspace from manifest
+        journal_dir: string path of journal directory, default config.journal_dir
+    Returns:
+        dict with result of workspace creation.
+    """
+    start = time.monotonic()
+    result = {'workspace': workspace.get('workspace'), 'env': workspace.get('env', CREATE_DEFAULTS['env'])}
+    try:
+        args = create_args(workspace, airee_repo.token, airee_repo.org)
+        workspace_kwargs, app_kwargs, infra_kwargs = entrypoint_init.create_kwargs(args)
+        journal = Journal.for_workspace(journal_dir if journal_dir else config.journal_dir, args['ghorg'], args['workspace'], args['env'])
+        entrypoint_init.create_workspace(airee_repo.for_workspace(args['workspace'], args['env']), workspace_kwargs, app_kwargs, infra_kwargs, journal)
+        result['status'] = 'created'
+    # SystemExit is used by repository objects to report known errors, e.g. existing repository
+    except (Exception, SystemExit) as e:
+        logger.error(f"Workspace {result['workspace']} not created: {e!r}")
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['seconds'] = round(time.monotonic() - start, 2)
+    return result
+
+
+def create_batch(token, ghorg, workspaces, workers=None, report=None, journal_dir=None):
+    """Function to create many workspaces with bounded pool of workers.
+
+    Args:
+        token: string value of PAT
+        ghorg: string name of GitHub Organization
+        workspaces: list of dicts with workspaces, e.g. from load_manifest
+        workers: int number of workspaces created in parallel, default config.batch_workers
+        report: string path of json file where results will be written
+        journal_dir: string path of directory with journals, failed workspaces continue from failed step in next run
+    Returns:
+        list of dicts with result per workspace.
+    """
+    workers = workers if workers else config.batch_workers
+    # every workspace needs 3 deploy keys
+    key_pool = KeyPool(size=max(config.key_pool_size, 3 * workers))
+    airee = Airee_gh_repo(token, None, org=ghorg, key_pool=key_pool)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda workspace: create_one(airee, workspace, journal_dir), workspaces))
+    finally:
+        key_pool.close()
+
+    failed = [r['workspace'] for r in results if r['status'] == 'failed']
+    logger.info(f"Created {len(results) - len(failed)} of {len(results)} workspaces")
+    if failed:
+        logger.error(f"Failed workspaces: {', '.join(str(w) for w in failed)}")
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+        logger.info(f"Report written to {report}")
+    return results
+
+
+def select_workspaces(airee_repo, env=None, match=None, workspaces=None):
+    """Function to find workspaces in GitHub Organization by their "infra" repositories.
+
+    If explicit list of workspaces and env are passed, organization is not listed.
+
+    Args:
+        airee_repo: Airee_gh_repo object
+        env: string with environment, all environments if not passed
+        match: string with glob which workspace name need to match, e.g. "team-*"
+        workspaces: list of workspace names
+    Returns:
+        sorted list of (workspace, env) tuples.
+    """
+    if workspaces and env:
+        return sorted((workspace, env) for workspace in workspaces if not match or fnmatch(workspace, match))
+
+    selected = []
+    # paginated listing of all repositories in organization
+    for repo in airee_repo.gh_org.get_repos():
+        name = INFRA_REPO.match(repo.name)
+        if not name:
+            continue
+        if env and name['env'] != env:
+            continue
+        if match and not fnmatch(name['workspace'], match):
+            continue
+        if workspaces and name['workspace'] not in workspaces:
+            continue
+        selected.append((name['workspace'], name['env']))
+    logger.info(f"{len(selected)} workspaces selected in {airee_repo.org}")
+    return sorted(selected)
+
+
+def status_one(airee_repo, workspace, env, status):
+    """Function to change status of single workspace.
+
+    Args:
+        airee_repo: Airee_gh_repo object shared by batch
+        workspace: string with name of workspace
+        env: string with environment of workspace
+        status: string with new status [up, pause, down]
+    Returns:
+        dict with result of operation: changed, skipped with reason or failed with error.
+    """
+    result = {'workspace': workspace, 'env': env}
+    try:
+        with metrics.labels(workspace=workspace, env=env):
+            old_status = entrypoint_init.change_status(airee_repo.for_workspace(workspace, env), status)
+        reason = entrypoint_init.status_transition_error(old_status, status)
+        result.update({'result': 'skipped', 'reason': reason} if reason else {'result': 'changed', 'from': old_status})
+    # SystemExit is used by repository objects to report known errors
+    except (Exception, SystemExit) as e:
+        logger.error(f"Status of workspace {workspace} {env} not changed: {e!r}")
+        result.update({'result': 'failed', 'error': repr(e)})
+    return result
+
+
+def bulk_status(token, ghorg, status, env=None, match=None, workspaces=None, workers=None, dry_run=False, report=None):
+    """Function to change status of many workspaces with bounded pool of workers.
+
+    Args:
+        token: string value of PAT
+        ghorg: string name of GitHub Organization
+        status: string with new status [up, pause, down]
+        env: string with environment, all environments if not passed
+        match: string with glob which workspace name need to match
+        workspaces: list of workspace names
+        workers: int number of workspaces changed in parallel, default config.batch_workers
+        dry_run: bool flag to only select workspaces
+        report: string path of json file where summary will be written
+    Returns:
+        dict with lists of changed, skipped and failed workspaces.
+    """
+    workers = workers if workers else config.batch_workers
+    airee = Airee_gh_repo(token, None, org=ghorg)
+    selected = select_workspaces(airee, env, match, workspaces)
+    if dry_run:
+        for workspace, ws_env in selected:
+            print(f"{workspace}\t{ws_env}")
+        return {'changed': [], 'skipped': [], 'failed': []}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda ws: status_one(airee, ws[0], ws[1], status), selected))
+
+    summary = {key: [r for r in results if r['result'] == key] for key in ('changed', 'skipped', 'failed')}
+    for r in summary['changed']:
+        print(f"changed\t{r['workspace']}\t{r['env']}\t{r['from']} -> {status}")
+    for r in summary['skipped']:
+        print(f"skipped\t{r['workspace']}\t{r['env']}\t{r['reason']}")
+    for r in summary['failed']:
+        print(f"failed\t{r['workspace']}\t{r['env']}\t{r['error']}")
+    logger.info(f"Status {status}: {len(summary['changed'])} changed, {len(summary['skipped'])} skipped, {len(summary['failed'])} failed")
+
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+        logger.info(f"Report written to {report}")
+    return summary
+
+
+def inventory(token, ghorg, env=None, match=None, workspaces=None, report=None):
+    """Function to read status of many workspaces from status.json of their "infra" repositories.
+
+    status.json is read with batched GraphQL queries instead of clone or REST request per repository.
+    If explicit list of workspaces and env are passed, repositories are queried by name with aliases,
+    config.gh_graphql_batch repositories per query. Otherwise pages of 100 organization repositories
+    are read with their status.json, so listing and status need the same single query per page.
+
+    Args:
+        token: string value of PAT
+        ghorg: string name of GitHub Organization
+        env: string with environment, all environments if not passed
+        match: string with glob which workspace name need to match, e.g. "team-*"
+        workspaces: list of workspace names
+        report: string path of json file where statuses will be written
+    Returns:
+        sorted list of dicts with workspace, env and status, status is None with error if it can't be read.
+    """
+    if workspaces and env:
+        names = sorted(f'{workspace}_infra_{env}' for workspace in set(workspaces) if not match or fnmatch(workspace, match))
+        nodes, queries = _query_repos(token, ghorg, names)
+    else:
+        nodes, queries = _query_org_repos(token, ghorg)
+
+    statuses = []
+    for name, node in nodes.items():
+        found = INFRA_REPO.match(name)
+        if not found:
+            continue
+        if env and found['env'] != env:
+            continue
+        if match and not fnmatch(found['workspace'], match):
+            continue
+        if workspaces and found['workspace'] not in workspaces:
+            continue
+        statuses.append(dict({'workspace': found['workspace'], 'env': found['env']}, **_parse_status(node)))
+    statuses.sort(key=lambda s: (s['workspace'], s['env']))
+    logger.info(f"Status of {len(statuses)} workspaces in {ghorg} read with {queries} GraphQL queries")
+
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(statuses, report_file, indent=2)
+        logger.info(f"Report written to {report}")
+    return statuses
+
+
+def _query_repos(token, ghorg, names):
+    """Return dict with repository name and GraphQL node (None if not found) and number of queries."""
+    nodes, queries = {}, 0
+    for start in range(0, len(names), config.gh_graphql_batch):
+        batch = names[start:start + config.gh_graphql_batch]
+        # repositories are queried with aliases r0, r1, ... and names passed as variables
+        declarations = ''.join(f', $n{i}: String!' for i in range(len(batch)))
+        fields = '\n'.join(f'  r{i}: repository(owner: $owner, name: $n{i}) {{ name {STATUS_OBJECT} }}' for i in range(len(batch)))
+        variables = dict({f'n{i}': name for i, name in enumerate(batch)}, owner=ghorg)
+        data = gh_client.graphql(token, f'query($owner: String!{declarations}) {{\n{fields}\n}}', variables)['data']
+        queries += 1
+        for i, name in enumerate(batch):
+            nodes[name] = data.get(f'r{i}')
+    return nodes, queries
+
+
+def _query_org_repos(token, ghorg):
+    """Return dict with name and GraphQL node of every repository in organization and number of queries."""
+    nodes, queries, after = {}, 0, None
+    while True:
+        variables = {'owner': ghorg, 'first': min(config.gh_graphql_batch, 100), 'after': after}
+        organization = gh_client.graphql(token, ORG_STATUS_QUERY, variables)['data']['organization']
+        queries += 1
+        if organization is None:
+            logger.error(f"Organization {ghorg} not found")
+            raise SystemExit(1)
+        repositories = organization['repositories']
+        nodes.update((node['name'], node) for node in repositories['nodes'])
+        if not repositories['pageInfo']['hasNextPage']:
+            return nodes, queries
+        after = repositories['pageInfo']['endCursor']
+
+
+def _parse_status(node):
+    """Return dict with status read from GraphQL node of "infra" repository, or error."""
+    if node is None:
+        return {'status': None, 'error': 'repository not found'}
+    if not node.get('object') or node['object'].get('text') is None:
+        return {'status': None, 'error': 'status.json not found'}
+    try:
+        return {'status': json.loads(node['object']['text'])['status']}
+    except (ValueError, KeyError, TypeError):
+        return {'status': None, 'error': 'status.json is not valid'}
+
+
+def plan(workspaces, actual):
+    """Function to compute actions which change actual state of workspaces to desired state from manifest.
+
+    Workspace without "infra" repository or its status.json is created, workspace with status.json different from
+    desired "status" field gets status transition. Workspace without "status" field keeps its status.
+    tier and other "create" fields are used only when workspace is created.
+
+    Args:
+        workspaces: list of dicts with workspaces from manifest
+        actual: dict with (workspace, env) tuple and dict with status and error as returned by inventory
+    Returns:
+        list of dicts with workspace, env, action [create, status, noop, invalid] and desired status.
+    """
+    actions = []
+    for workspace in workspaces:
+        name, env = workspace.get('workspace'), str(workspace.get('env') or CREATE_DEFAULTS['env'])
+        desired = workspace.get('status')
+        action = {'workspace': name, 'env': env, 'status': desired}
+        current = actual.get((name, env), {'status': None, 'error': 'repository not found'})
+        if desired is not None and desired not in STATUSES:
+            action.update({'action': 'invalid', 'reason': f"Field status should be one of {', '.join(STATUSES)}, not {desired}"})
+        elif current.get('error') in ('repository not found', 'status.json not found'):
+            # "infra" repository without status.json is left by failed creation, it's continued with journal
+            action['action'] = 'create'
+        elif current['status'] is None:
+            action.update({'action': 'invalid', 'reason': current['error']})
+        elif desired is None or desired == current['status']:
+            action.update({'action': 'noop', 'from': current['status']})
+        else:
+            reason = entrypoint_init.status_transition_error(current['status'], desired)
+            action.update({'action': 'invalid', 'reason': reason} if reason else {'action': 'status', 'from': current['status']})
+        actions.append(action)
+    return actions
+
+
+def apply_one(airee_repo, workspace, action, journal_dir=None):
+    """Function to execute action of single workspace computed by plan.
+
+    Args:
+        airee_repo: Airee_gh_repo object shared by reconcile
+        workspace: dict with workspace from manifest
+        action: dict with action from plan
+        journal_dir: string path of journal directory, default config.journal_dir
+    Returns:
+        dict with action and its result: changed, skipped with reason or failed with error.
+    """
+    result = dict(action)
+    current = None
+    if action['action'] == 'create':
+        created = create_one(airee_repo, workspace, journal_dir)
+        if created['status'] == 'failed':
+            result.update({'result': 'failed', 'error': created['error']})
+            return result
+        # new workspace gets status from template, desired status is set after creation if it differs
+        if action['status'] is not None:
+            current = _created_status(airee_repo, action['workspace'], action['env'])
+    if action['status'] is not None and action['status'] != current:
+        changed = status_one(airee_repo, action['workspace'], action['env'], action['status'])
+        if changed['result'] == 'failed':
+            result.update({'result': 'failed', 'error': changed['error']})
+            return result
+        if changed['result'] == 'skipped':
+            # status was changed by someone else after inventory, e.g. transition is not valid anymore
+            result.update({'result': 'skipped', 'reason': changed['reason']})
+            return result
+    result['result'] = 'changed'
+    return result
+
+
+def _created_status(airee_repo, workspace, env):
+    """Return status committed to status.json of just created workspace, None if it can't be read."""
+    name = f'{workspace}_infra_{env}'
+    try:
+        nodes, _ = _query_repos(airee_repo.token, airee_repo.org, [name])
+    except Exception as e:
+        logger.warning(f"Status of created workspace {workspace} {env} can't be read: {e!r}")
+        return None
+    return _parse_status(nodes.get(name)).get('status')
+
+
+def reconcile(token, ghorg, workspaces, workers=None, dry_run=False, report=None, journal_dir=None):
+    """Function to change workspaces to desired state from manifest, only differences are applied.
+
+    Actual state is read with batched GraphQL queries (see inventory), so when nothing changed
+    no repository is cloned and nothing is written. Creations and status transitions are executed
+    in parallel. Workspaces which are not in manifest are not changed.
+
+    Args:
+        token: string value of PAT
+        ghorg: string name of GitHub Organization
+        workspaces: list of dicts with workspaces, e.g. from load_manifest, with optional "status" field [up, pause, down]
+        workers: int number of workspaces changed in parallel, default config.batch_workers
+        dry_run: bool flag to only print actions
+        report: string path of json file where actions and results will be written
+        journal_dir: string path of directory with journals, failed creations continue from failed step in next run
+    Returns:
+        list of dicts with action and result per workspace.
+    """
+    workers = workers if workers else config.batch_workers
+    names = sorted({f"{w.get('workspace')}_infra_{w.get('env') or CREATE_DEFAULTS['env']}" for w in workspaces})
+    nodes, queries = _query_repos(token, ghorg, names)
+    actual = {}
+    for name, node in nodes.items():
+        found = INFRA_REPO.match(name)
+        if found:
+            actual[(found['workspace'], found['env'])] = _parse_status(node)
+    actions = plan(workspaces, actual)
+    logger.info(f"State of {len(actions)} workspaces in {ghorg} read with {queries} GraphQL queries")
+
+    pending = [(w, a) for w, a in zip(workspaces, actions) if a['action'] in ('create', 'status')]
+    for a in actions:
+        if a['action'] == 'create':
+            print(f"create\t{a['workspace']}\t{a['env']}" + (f"\t-> {a['status']}" if a['status'] else ''))
+        elif a['action'] == 'status':
+            print(f"status\t{a['workspace']}\t{a['env']}\t{a['from']} -> {a['status']}")
+        elif a['action'] == 'invalid':
+            print(f"invalid\t{a['workspace']}\t{a['env']}\t{a['reason']}")
+
+    results = [dict(a, result='failed' if a['action'] == 'invalid' else 'unchanged') for a in actions if a['action'] in ('noop', 'invalid')]
+    if pending and not dry_run:
+        creates = sum(1 for _, a in pending if a['action'] == 'create')
+        # deploy keys are generated in background only if workspaces are created, every workspace needs 3 deploy keys
+        key_pool = KeyPool(size=max(config.key_pool_size, 3 * min(workers, creates))) if creates else None
+        airee = Airee_gh_repo(token, None, org=ghorg, key_pool=key_pool)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results += list(executor.map(lambda wa: apply_one(airee, wa[0], wa[1], journal_dir), pending))
+        finally:
+            if key_pool:
+                key_pool.close()
+    elif pending:
+        results += [dict(a, result='planned') for _, a in pending]
+
+    counts = {key: sum(1 for r in results if r['result'] == key) for key in ('changed', 'planned', 'unchanged', 'skipped', 'failed')}
+    logger.info(f"Reconciled {len(results)} workspaces: " + ', '.join(f"{count} {key}" for key, count in counts.items() if count or key not in ('planned', 'skipped')))
+    for r in results:
+        if r['result'] == 'failed' and r['action'] != 'invalid':
+            logger.error(f"Workspace {r['workspace']} {r['env']} not reconciled: {r['error']}")
+        elif r['result'] == 'skipped':
+            logger.warning(f"Workspace {r['workspace']} {r['env']} skipped: {r['reason']}")
+
+    results.sort(key=lambda r: (str(r['workspace']), r['env']))
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+        logger.info(f"Report written to {report}")
+    return results
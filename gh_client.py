@@ -0,0 +1,630 @@
+"""Module with shared GitHub client used by all Airee objects.
+
+PyGithub keeps one persistent connection object per Github client and this object
+is not thread safe. Module replace PyGithub connection class with one which keeps
+request state per thread and sends all requests with one shared, pooled requests Session,
+so single Github client (and objects created by it) can be used by many workers.
+
+Every request goes through rate limit budget of its token:
+- token bucket refilled with speed computed from X-RateLimit-Remaining and X-RateLimit-Reset headers,
+- separate, slower bucket for writes (POST, PATCH, PUT, DELETE) to not hit secondary rate limits,
+- rate limited responses (403/429) are retried after Retry-After or X-RateLimit-Reset with jitter,
+- server errors of idempotent requests are retried with exponential backoff with jitter.
+
+GET responses with ETag or Last-Modified are kept in ResponseCache (in memory, optionally in sqlite
+database which survives between CLI runs) and sent again as conditional requests. GitHub answers
+304 Not Modified without counting it against rate limit, so repeated lookups of organizations
+and repositories don't spend rate limit budget.
+
+Git operations over HTTPS authenticate with tokens from git_tokens (TokenCache): PAT, or GitHub App
+installation token created once per organization and refreshed before it expires.
+
+    Typical usege:
+
+    gh = get_github(PAT)
+    org = gh.get_organization(github_org)
+    token = git_tokens.get(PAT, github_org)
+"""
+from github import Github, GithubIntegration
+from github.GithubException import GithubException
+from github.Requester import Requester
+import requests
+from urllib3.util.retry import Retry
+from base64 import b64encode
+from collections import OrderedDict
+from datetime import datetime, timezone
+import hashlib
+import json
+import random
+import threading
+import time
+import logging
+import config, metrics, util
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+# PyNaCl is needed only to encrypt secrets
+encoding = util.lazy_import('nacl.encoding')
+public = util.lazy_import('nacl.public')
+sqlite3 = util.lazy_import('sqlite3')
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+# errors after which request can be repeated by caller, if repeating it is safe
+CONNECTION_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+_lock = threading.Lock()
+_clients = {}
+_budgets = {}
+_session = None
+
+
+def session():
+    """Return requests Session shared by all GitHub connections.
+
+    Session keeps up to config.gh_pool_size connections alive per host. Only connection
+    errors are retried by urllib3, HTTP statuses are handled by Connection.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            retry = Retry(total=3, connect=3, read=2, status=0, backoff_factor=0.5, allowed_methods=IDEMPOTENT_METHODS)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=config.gh_pool_size, pool_block=True, max_retries=retry)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+class RateBudget:
+    """Class with token bucket limiting requests sent with one token to one GitHub API resource.
+
+    Bucket is refilled with speed which spreads requests left (X-RateLimit-Remaining)
+    until rate limit reset (X-RateLimit-Reset), but not faster than max_rate.
+    Budget is shared by all workers using the same token.
+
+    Attributes:
+        max_rate: float max requests per second
+        write_rate: float max write requests per second
+        burst: int number of requests which can be sent at once
+        remaining: int requests left reported by GitHub, None before first response
+        reset: float epoch time of rate limit reset reported by GitHub
+    """
+    def __init__(self, max_rate=None, write_rate=None, burst=None):
+        """Create RateBudget object."""
+        self.max_rate = max_rate if max_rate else config.gh_max_rate
+        self.write_rate = write_rate if write_rate else config.gh_write_rate
+        self.burst = burst if burst else config.gh_burst
+        self.remaining = None
+        self.reset = 0
+        self.__rate = self.max_rate
+        self.__tokens = float(self.burst)
+        self.__write_tokens = float(self.burst)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self, write=False):
+        """Method to reserve one request.
+
+        Reservation is not blocking, so it can be used by threads and event loop.
+
+        Args:
+            write: bool flag if request is a write (POST, PATCH, PUT, DELETE)
+        Returns:
+            float number of seconds to wait before request is sent.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            elapsed = now - self.__updated
+            self.__updated = now
+            self.__tokens = min(self.burst, self.__tokens + elapsed * self.__rate)
+            self.__write_tokens = min(self.burst, self.__write_tokens + elapsed * self.write_rate)
+
+            if self.remaining is not None and self.remaining <= config.gh_rate_limit_reserve and self.reset > time.time():
+                # budget is used up, requests wait for reset
+                self.remaining -= 1
+                return self.reset - time.time() + random.uniform(0, 1)
+
+            self.__tokens -= 1
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0
+            if write:
+                self.__write_tokens -= 1
+                if self.__write_tokens < 0:
+                    wait = max(wait, -self.__write_tokens / self.write_rate)
+            if self.remaining is not None:
+                self.remaining -= 1
+            return wait
+
+    def acquire(self, write=False):
+        """Method to wait until request can be sent.
+
+        Args:
+            write: bool flag if request is a write (POST, PATCH, PUT, DELETE)
+        Returns:
+            float number of seconds waited.
+        """
+        wait = self.reserve(write)
+        if wait > 0:
+            logger.debug(f"Waiting {wait:.2f}s for GitHub rate limit budget")
+            metrics.rate_limit_wait(wait, 'budget')
+            time.sleep(wait)
+        return wait
+
+    def refund(self):
+        """Method to give back request reserved for response which is not counted by GitHub, e.g. 304 Not Modified."""
+        with self.__lock:
+            self.__tokens = min(self.burst, self.__tokens + 1)
+
+    def update(self, headers):
+        """Method to update budget with X-RateLimit-* headers of GitHub response.
+
+        Args:
+            headers: dict-like object with response headers
+        """
+        if 'X-RateLimit-Remaining' not in headers or 'X-RateLimit-Reset' not in headers:
+            return
+        with self.__lock:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.reset = float(headers['X-RateLimit-Reset'])
+            window = max(self.reset - time.time(), 1)
+            self.__rate = min(self.max_rate, max(self.remaining / window, 0.01))
+
+
+def get_budget(authorization, resource='core'):
+    """Return rate limit budget shared by all workers using the same token.
+
+    Args:
+        authorization: string value of Authorization header, e.g. "token <PAT>"
+        resource: string GitHub rate limit resource [core, graphql, search]
+    Returns:
+        RateBudget object.
+    """
+    key = (hashlib.sha256((authorization or '').encode()).hexdigest(), resource)
+    with _lock:
+        if key not in _budgets:
+            _budgets[key] = RateBudget()
+        return _budgets[key]
+
+
+def resource_of(url):
+    """Return GitHub rate limit resource of request url."""
+    path = url.split('?')[0]
+    if path.endswith('/graphql'):
+        return 'graphql'
+    if '/search/' in path:
+        return 'search'
+    return 'core'
+
+
+def retry_delay(verb, status, headers, body, attempt):
+    """Function to compute how long to wait before request is sent again.
+
+    Args:
+        verb: string HTTP method
+        status: int HTTP status of response
+        headers: dict-like object with response headers
+        body: string response body
+        attempt: int number of attempts already made
+    Returns:
+        float number of seconds to wait, None if request should not be retried.
+    """
+    if attempt >= config.gh_max_retries:
+        return None
+    jitter = random.uniform(0, 1)
+    if status in (403, 429):
+        if 'Retry-After' in headers:
+            # secondary rate limit
+            delay = float(headers['Retry-After']) + jitter
+        elif headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in headers:
+            # primary rate limit
+            delay = max(float(headers['X-RateLimit-Reset']) - time.time(), 0) + jitter
+        elif 'secondary rate limit' in (body or '').lower() or 'abuse' in (body or '').lower():
+            delay = 60 * 2 ** attempt * (1 + jitter)
+        else:
+            return None
+        return delay if delay <= config.gh_max_wait else None
+    if status in (500, 502, 503, 504) and verb.upper() in IDEMPOTENT_METHODS:
+        # full jitter exponential backoff
+        return random.uniform(0, config.gh_backoff * 2 ** attempt)
+    return None
+
+
+def count_retry(status, delay):
+    """Function to count retry of GitHub request in metrics."""
+    if status in (403, 429):
+        metrics.rate_limit_wait(delay, 'rate_limited')
+    else:
+        metrics.inc('airee_retries_total', step='github_request')
+        metrics.inc('airee_retry_sleep_seconds_total', delay, step='github_request')
+
+
+class Response:
+    """Class mimic httplib response object expected by PyGithub."""
+    def __init__(self, status, headers, text):
+        """Create Response object from status, headers and body of requests or cached response."""
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+    def getheaders(self):
+        """Return list of response headers."""
+        return self.headers.items()
+
+    def read(self):
+        """Return response body."""
+        return self.text
+
+
+class ResponseCache:
+    """Class with cache of GitHub GET responses validated with conditional requests.
+
+    Response with ETag or Last-Modified header is kept per url, token and Accept header. Next request
+    of the same url is sent with If-None-Match / If-Modified-Since and 304 Not Modified is answered
+    with cached response. The least recently used responses above size and responses not validated
+    for ttl seconds are removed. If path is set, responses are also kept in sqlite database,
+    so they are reused by next CLI runs and by other processes.
+
+    Attributes:
+        size: int max number of cached responses, cache is disabled if 0
+        ttl: int seconds after which response which wasn't validated is removed
+        path: string path of sqlite database, responses are kept only in memory if empty
+    """
+    def __init__(self, size=None, ttl=None, path=None):
+        """Create ResponseCache object."""
+        self.size = size if size is not None else config.gh_cache_size
+        self.ttl = ttl if ttl else config.gh_cache_ttl
+        self.path = path if path is not None else config.gh_cache_db
+        self.__entries = OrderedDict()
+        self.__db = None
+        self.__lock = threading.Lock()
+
+    def key(self, host, port, url, headers):
+        """Return cache key of GET request, None if request can't be cached."""
+        if not self.size or 'If-None-Match' in headers or 'If-Modified-Since' in headers:
+            # conditional requests of PyGithub (e.g. GithubObject.update) are passed as they are
+            return None
+        # response depends on token (permissions) and requested media type
+        return hashlib.sha256(f"{host}:{port}{url}\n{headers.get('Authorization')}\n{headers.get('Accept')}".encode()).hexdigest()
+
+    def get(self, key):
+        """Return cached response dict with etag, last_modified, headers and body, None if not cached."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None and self.path:
+                row = self.__connect().execute('SELECT etag, last_modified, headers, body, stored FROM responses WHERE key = ?', (key,)).fetchone()
+                if row:
+                    entry = {'etag': row[0], 'last_modified': row[1], 'headers': json.loads(row[2]), 'body': row[3], 'stored': row[4]}
+                    self.__entries[key] = entry
+                    while len(self.__entries) > self.size:
+                        self.__entries.popitem(last=False)
+            if entry is None:
+                return None
+            if entry['stored'] + self.ttl < time.time():
+                self.__remove(key)
+                return None
+            self.__entries.move_to_end(key)
+            return entry
+
+    def put(self, key, headers, body):
+        """Method to cache response if it has ETag or Last-Modified header."""
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        entry = {'etag': etag, 'last_modified': last_modified, 'headers': dict(headers), 'body': body, 'stored': time.time()}
+        with self.__lock:
+            self.__entries[key] = entry
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+            if self.path:
+                db = self.__connect()
+                with db:
+                    db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, etag, last_modified, json.dumps(entry['headers']), body, entry['stored']))
+                    # the least recently validated responses above size are removed
+                    db.execute('DELETE FROM responses WHERE stored < ? OR key IN (SELECT key FROM responses ORDER BY stored DESC LIMIT -1 OFFSET ?)', (time.time() - self.ttl, self.size))
+
+    def touch(self, key):
+        """Method to mark cached response as validated by 304 response."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return
+            entry['stored'] = time.time()
+            if self.path:
+                db = self.__connect()
+                with db:
+                    db.execute('UPDATE responses SET stored = ? WHERE key = ?', (entry['stored'], key))
+
+    def clear(self):
+        """Method to remove all cached responses."""
+        with self.__lock:
+            self.__entries.clear()
+            if self.path:
+                db = self.__connect()
+                with db:
+                    db.execute('DELETE FROM responses')
+
+    def __remove(self, key):
+        self.__entries.pop(key, None)
+        if self.path:
+            db = self.__connect()
+            with db:
+                db.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def __connect(self):
+        # connection is used by many threads, access is serialized by lock of cache
+        if self.__db is None:
+            self.__db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            with self.__db:
+                self.__db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, body TEXT, stored REAL)')
+        return self.__db
+
+
+responses = ResponseCache()
+
+
+def validators(entry):
+    """Return headers of conditional request validating cached response."""
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+class Connection:
+    """Class mimic httplib connection object expected by PyGithub.
+
+    Request passed to "request" method is kept per thread, so the same object
+    can be used by many threads in parallel.
+
+    Attributes:
+        host: string with API host
+        port: int with API port
+        protocol: string http or https
+        timeout: int request timeout in seconds
+        verify: bool or string with ssl verification passed to requests
+    """
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, pool_size=None, protocol='https', **kwargs):
+        """Create Connection object."""
+        self.protocol = protocol
+        self.port = port if port else (443 if protocol == 'https' else 80)
+        self.host = host
+        self.timeout = timeout
+        self.verify = kwargs.get("verify", True)
+        self.__local = threading.local()
+
+    def request(self, verb, url, input, headers):
+        """Store request which will be sent by getresponse."""
+        self.__local.request = (verb, url, input, headers)
+
+    def getresponse(self):
+        """Send stored request using shared session and rate limit budget of its token."""
+        verb, url, input, headers = self.__local.request
+        budget = get_budget(headers.get('Authorization'), resource_of(url))
+        cache_key = responses.key(self.host, self.port, url, headers) if verb.upper() == 'GET' else None
+        cached = responses.get(cache_key) if cache_key else None
+        if cached:
+            headers = dict(headers, **validators(cached))
+        attempt = 0
+        while True:
+            budget.acquire(write=verb.upper() not in ('GET', 'HEAD'))
+            r = session().request(
+                verb,
+                f"{self.protocol}://{self.host}:{self.port}{url}",
+                headers=headers,
+                data=input,
+                timeout=self.timeout,
+                verify=self.verify,
+                allow_redirects=False,
+            )
+            budget.update(r.headers)
+            if cached and r.status_code == 304:
+                # not modified response isn't counted by GitHub
+                budget.refund()
+                responses.touch(cache_key)
+                metrics.inc('airee_gh_cache_requests_total', result='hit')
+                cached_headers = requests.structures.CaseInsensitiveDict(cached['headers'])
+                cached_headers.update(r.headers)
+                return Response(200, cached_headers, cached['body'])
+            delay = retry_delay(verb, r.status_code, r.headers, r.text, attempt)
+            if delay is None:
+                if cache_key and r.status_code == 200:
+                    responses.put(cache_key, r.headers, r.text)
+                    metrics.inc('airee_gh_cache_requests_total', result='miss')
+                return Response(r.status_code, r.headers, r.text)
+            attempt += 1
+            logger.warning(f"GitHub answered {r.status_code} for {verb} {url.split('?')[0]}, retry {attempt} in {delay:.1f}s")
+            count_retry(r.status_code, delay)
+            time.sleep(delay)
+
+    def close(self):
+        """Connections are kept in shared session pool, nothing to close."""
+        return
+
+
+class HTTPConnection(Connection):
+    """Connection for http scheme, e.g. GitHub Enterprise or local test server."""
+    def __init__(self, host, port=None, **kwargs):
+        """Create HTTPConnection object."""
+        super().__init__(host, port, protocol='http', **kwargs)
+
+
+class PublicKeyCache:
+    """Class with cache of GitHub Actions public keys used to encrypt secrets.
+
+    Public key of repository or organization changes rarely, so it's fetched once
+    and kept for ttl seconds. Key is invalidated when GitHub rejects secret encrypted with it.
+
+    Attributes:
+        ttl: int seconds after which public key is fetched again
+    """
+    def __init__(self, ttl=None):
+        """Create PublicKeyCache object."""
+        self.ttl = ttl if ttl else config.gh_public_key_ttl
+        self.__keys = {}
+        self.__lock = threading.Lock()
+
+    def get(self, url):
+        """Return tuple with key_id and key for repository or organization API url, None if not cached."""
+        with self.__lock:
+            entry = self.__keys.get(url)
+        if entry and entry[0] > time.monotonic():
+            return entry[1], entry[2]
+        return None
+
+    def put(self, url, key_id, key):
+        """Method to cache public key of repository or organization API url."""
+        with self.__lock:
+            self.__keys[url] = (time.monotonic() + self.ttl, key_id, key)
+
+    def invalidate(self, url):
+        """Method to remove public key from cache."""
+        with self.__lock:
+            self.__keys.pop(url, None)
+
+
+public_keys = PublicKeyCache()
+
+
+class TokenCache:
+    """Class with tokens used by git over HTTPS, shared by all operations of process.
+
+    If GitHub App is configured (config.gh_app_id and config.gh_app_key_file), installation token
+    of organization is created once and refreshed when it expires in less than refresh_margin seconds,
+    so git operations don't need temporary deploy keys. Otherwise PAT is used.
+
+    Attributes:
+        app_id: string id of GitHub App, PAT is used if empty
+        key_file: string path of private key (PEM) of GitHub App
+        installation_id: string id of GitHub App installation, found by organization if empty
+        refresh_margin: int seconds before expiration when installation token is refreshed
+    """
+    def __init__(self, app_id=None, key_file=None, installation_id=None, refresh_margin=300):
+        """Create TokenCache object."""
+        self.app_id = app_id if app_id is not None else config.gh_app_id
+        self.key_file = key_file if key_file is not None else config.gh_app_key_file
+        self.installation_id = installation_id if installation_id is not None else config.gh_app_installation_id
+        self.refresh_margin = refresh_margin
+        self.__tokens = {}
+        self.__locks = {}
+        self.__lock = threading.Lock()
+
+    def get(self, pat, org, base_url=None):
+        """Return token for git operations in repositories of organization.
+
+        Args:
+            pat: string value of PAT, returned if GitHub App is not configured
+            org: string name of GitHub Organization
+            base_url: string url of GitHub API, default from config.gh_api_url
+        Returns:
+            string token.
+        """
+        if not self.app_id:
+            return pat
+        base_url = (base_url if base_url else config.gh_api_url).rstrip('/')
+        key = (base_url, org)
+        with self.__lock:
+            lock = self.__locks.setdefault(key, threading.Lock())
+        # only one thread creates token of organization, others wait for it
+        with lock:
+            token, expires = self.__tokens.get(key, (None, 0))
+            if expires - self.refresh_margin < time.time():
+                token, expires = self.__create(base_url, org)
+                self.__tokens[key] = (token, expires)
+                logger.debug(f"Installation token of {org} created, valid for {int(expires - time.time())}s")
+            return token
+
+    def invalidate(self, org, base_url=None):
+        """Method to remove token of organization, e.g. when it was rejected."""
+        base_url = (base_url if base_url else config.gh_api_url).rstrip('/')
+        with self.__lock:
+            self.__tokens.pop((base_url, org), None)
+
+    def __create(self, base_url, org):
+        """Return new installation token and its expiration epoch time."""
+        with open(self.key_file, 'r') as key_file:
+            integration = GithubIntegration(self.app_id, key_file.read(), base_url=base_url)
+        headers = {'Authorization': f'Bearer {integration.create_jwt()}', 'Accept': 'application/vnd.github.v3+json'}
+        installation_id = self.installation_id
+        if not installation_id:
+            r = session().get(f'{base_url}/orgs/{org}/installation', headers=headers, timeout=30)
+            if r.status_code != 200:
+                raise GithubException(r.status_code, r.json() if r.text else None, r.headers)
+            installation_id = r.json()['id']
+        r = session().post(f'{base_url}/app/installations/{installation_id}/access_tokens', headers=headers, timeout=30)
+        if r.status_code != 201:
+            raise GithubException(r.status_code, r.json() if r.text else None, r.headers)
+        data = r.json()
+        expires = datetime.strptime(data['expires_at'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+        return data['token'], expires
+
+
+git_tokens = TokenCache()
+
+
+def encrypt(key, value):
+    """Function to encrypt secret value with GitHub Actions public key (libsodium sealed box).
+
+    Args:
+        key: string base64 encoded public key
+        value: string value of secret
+    Returns:
+        string base64 encoded encrypted value.
+    """
+    sealed_box = public.SealedBox(public.PublicKey(key.encode(), encoding.Base64Encoder()))
+    return b64encode(sealed_box.encrypt(value.encode())).decode()
+
+
+def get_github(token, base_url=None):
+    """Return Github client shared by all workers using the same token.
+
+    Args:
+        token: string value of PAT
+        base_url: string url of GitHub API, default from config.gh_api_url
+    Returns:
+        GitHub class object.
+    """
+    base_url = base_url if base_url else config.gh_api_url
+    with _lock:
+        if not _clients:
+            Requester.injectConnectionClasses(HTTPConnection, Connection)
+            logger.debug("Shared GitHub connection installed")
+        if (token, base_url) not in _clients:
+            _clients[(token, base_url)] = Github(token, base_url=base_url, pool_size=config.gh_pool_size)
+        return _clients[(token, base_url)]
+
+
+def graphql_url(base_url=None):
+    """Return url of GraphQL API for url of REST API, e.g. https://ghe.example.com/api/v3 -> https://ghe.example.com/api/graphql."""
+    base_url = (base_url if base_url else config.gh_api_url).rstrip('/')
+    if base_url.endswith('/api/v3'):
+        return f"{base_url[:-len('/v3')]}/graphql"
+    return f"{base_url}/graphql"
+
+
+def graphql(token, query, variables=None, base_url=None):
+    """Function to send GraphQL query with shared GitHub client.
+
+    Query uses the same pool of connections, retries and rate limit budget (graphql resource) as REST requests.
+
+    Args:
+        token: string value of PAT
+        query: string GraphQL query
+        variables: dict with variables of query
+        base_url: string url of GitHub REST API, default from config.gh_api_url
+    Returns:
+        dict with "data" and optional "errors" of response, e.g. NOT_FOUND errors of missing repositories.
+        GithubException is raised if response has no data.
+    """
+    requester = get_github(token, base_url)._Github__requester
+    headers, response = requester.requestJsonAndCheck('POST', graphql_url(base_url), input={'query': query, 'variables': variables or {}})
+    if not response or response.get('data') is None:
+        # GraphQL errors are returned with status 200
+        raise GithubException(200, response, headers)
+    for error in response.get('errors', []):
+        logger.debug(f"GraphQL error: {error.get('type')} {error.get('message')}")
+    return response
@@ -9,10 +9,22 @@ It use mainly pygit2 frameworks.
     # done some changes on files
     app_git.commit_all("Init commit")
     app_git.push()
+
+    # HTTPS with token instead of deploy key
+    infra_git = Gitrepo(clone_url, token=lambda: gh_client.git_tokens.get(PAT, github_org))
 """
-import pygit2
 import logging
-import config
+import config, metrics, util
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from retry import retry
 
 logger = logging.getLogger(__name__)
@@ -20,28 +32,69 @@ logger.setLevel(config.log_lvl)
 logger.addHandler(config.ch)
 logger.propagate = False
 
+# libgit2 is loaded only when repository is used, not by commands which change status with GitHub API
+pygit2 = util.lazy_import('pygit2')
+
+# user name of HTTPS token auth, it works for PAT and GitHub App installation token
+TOKEN_USER = 'x-access-token'
+# credential helper of git command line reading token from environment, so token is not kept in repository config
+TOKEN_HELPER = ['-c', 'credential.helper=', '-c', 'credential.helper=!f() { test "$1" = get && echo "username=%s" && echo "password=$AIREE_GIT_TOKEN"; }; f' % TOKEN_USER]
+# messages of git command line and libgit2 when remote branch has commits which are not in local branch
+REJECTED_MESSAGES = ('[rejected]', 'non-fast-forward', 'fetch first', 'non-fastforwardable', 'contains commits that are not present locally')
+
+
+class PushRejected(Exception):
+    """Push was rejected because remote branch was changed in meantime, commit need to be made again after sync."""
+
 class Gitrepo:
     """Class to conect with git repository.
 
-    Object of this class comunicate with git repository using ssh connecions with public and private key auth.
+    Object of this class comunicate with git repository using ssh connecions with public and private key auth,
+    or using HTTPS with token (PAT or GitHub App installation token) auth.
     There are methods to basic operation on git repository like commit, clone, push or add submodule.
     Some of methods are decorated with retry function to handle connections issues.
 
+    Repository can be cloned in one of modes from CLONE_MODES:
+    - full: all history and all branches (pygit2)
+    - single_branch: all history of one branch (pygit2)
+    - shallow: last commit of one branch (git command line)
+    - sparse: last commit of one branch, only given paths are downloaded and checked out (git command line)
+    libgit2 used by pygit2 can't work with shallow and sparse repositories, so in these modes
+    commit and push are also made by git command line.
+
     Attributes:
-        keypair: pygit2 keypair object contain public and private key for auth
+        keypair: pygit2 keypair object contain public and private key for auth, None with token auth
         callbacks: pygit2 callback object to handle comunication with remote repository
-        ssh_url: string with ssh's type url to repository
+        ssh_url: string with ssh's type url to repository, https url with token auth
         prv_k: string byte encoded private key
         pub_k: string byte encoded public key
+        token: string token or function returning current token used with https url
         repo: pygit repository object
+        path: string path of cloned repository
+        cli: bool flag if repository is handled by git command line
+        detached: bool flag if HEAD of worktree is detached, it's pushed to branch
     """
-    def __init__(self, ssh_url, prv_k, pub_k):
-        """Create Gitrepo object."""
-        self.keypair = pygit2.KeypairFromMemory("git", pub_k.decode(), prv_k.decode(), "")
-        self.callbacks = pygit2.RemoteCallbacks(credentials=self.keypair)
+    # modes from the cheapest one
+    CLONE_MODES = ['sparse', 'shallow', 'single_branch', 'full']
+
+    def __init__(self, ssh_url, prv_k=None, pub_k=None, token=None):
+        """Create Gitrepo object.
+
+        token can be function, it's called by every network operation, so refreshed token is used.
+        """
+        self.token = token
+        if prv_k is not None:
+            self.keypair = pygit2.KeypairFromMemory("git", pub_k.decode(), prv_k.decode(), "")
+            self.callbacks = pygit2.RemoteCallbacks(credentials=self.keypair)
+        else:
+            self.keypair = None
+            credentials = (lambda url, username, allowed: pygit2.UserPass(TOKEN_USER, self.__token())) if token is not None else None
+            self.callbacks = pygit2.RemoteCallbacks(credentials=credentials)
         self.ssh_url = self.__check_ssh_url(ssh_url)
         self.prv_k = prv_k
         self.pub_k = pub_k
+        self.cli = False
+        self.detached = False
         logger.debug(f"Gitrepo object for repo {ssh_url} created")
 
 
@@ -52,21 +105,174 @@ class Gitrepo:
             return url
         elif url.startswith("git@"):
             return f"ssh://{url.replace(':','/')}"
+        elif url.startswith("file://"):
+            # local repository, e.g. remote of benchmarks
+            return url
+        elif url.startswith("https://") and self.token is not None:
+            return url
         else:
-            logger.error("SSH url is not valid. Need start with 'ssh://' or 'git@'")
-            raise
+            logger.error("SSH url is not valid. Need start with 'ssh://', 'git@' or 'file://', or 'https://' with token")
+            raise ValueError(f"Url {url} is not valid")
+
+    def __token(self):
+        """Return current token."""
+        return self.token() if callable(self.token) else self.token
 
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
-    def clone_repo(self, path):
+    @metrics.timed('clone_repo')
+    @retry(tries=2, delay=20, backoff=2, logger=metrics.retry_logger(logger, 'clone_repo'))
+    def clone_repo(self, path, mode='full', branch='main', paths=None):
         """Method to clone repository on provided path.
         It create attribute "repo".
+
+        Args:
+            path: string path where repository will be cloned
+            mode: string clone mode from CLONE_MODES, default full
+            branch: string branch cloned in single_branch, shallow and sparse mode
+            paths: list of paths checked out in sparse mode, e.g. ['status.json']
         """
-        self.repo = pygit2.clone_repository(self.ssh_url, path, callbacks=self.callbacks)
-        self.repo.remotes.set_url("origin", self.ssh_url)
-        logger.debug(f"Repo created on path {path}")
+        return self.__clone(path, mode, branch, paths)
+
+    def __clone(self, path, mode, branch, paths):
+        """Clone repository in given mode, not retried."""
+        self.path = path
+        if mode == 'full':
+            self.repo = pygit2.clone_repository(self.ssh_url, path, callbacks=self.callbacks)
+        elif mode == 'single_branch':
+            refspec = f"+refs/heads/{branch}:refs/remotes/origin/{branch}"
+            self.repo = pygit2.clone_repository(self.ssh_url, path, callbacks=self.callbacks, checkout_branch=branch,
+                                                remote=lambda repo, name, url: repo.remotes.create(name, url, refspec))
+        elif mode == 'shallow':
+            self.__git('clone', '-q', '--depth', '1', '--single-branch', '--branch', branch, self.ssh_url, path, cwd=None)
+            self.__open_cli(path)
+        elif mode == 'sparse':
+            self.__git('clone', '-q', '--depth', '1', '--single-branch', '--branch', branch, '--filter=blob:none', '--no-checkout', self.ssh_url, path, cwd=None)
+            # core.sparseCheckout with pattern file works in every git version, "sparse-checkout set" needs git 2.25+
+            self.__git('config', 'core.sparseCheckout', 'true')
+            with open(os.path.join(path, '.git', 'info', 'sparse-checkout'), 'w') as f:
+                f.write(''.join(f"/{p.lstrip('/')}\n" for p in paths or []))
+            self.__git('checkout', '-q', branch)
+            self.__open_cli(path)
+        else:
+            raise ValueError(f"Clone mode should be one of {', '.join(self.CLONE_MODES)}, not {mode}")
+        if not self.cli:
+            self.repo.remotes.set_url("origin", self.ssh_url)
+        logger.debug(f"Repo created on path {path} ({mode} clone)")
         return 0
 
+    def clone_cheapest(self, path, paths=None, branch='main', modes=None):
+        """Method to clone repository in the cheapest mode which works.
+
+        Modes using git command line are skipped if git is not installed.
+        If clone in one mode fails, next mode is used.
+
+        Args:
+            path: string path where repository will be cloned
+            paths: list of paths which will be changed, only they are checked out in sparse mode
+            branch: string branch which will be changed
+            modes: list of modes to try, default CLONE_MODES (sparse only if paths are passed)
+        Returns:
+            string with used mode.
+        """
+        modes = modes if modes else [mode for mode in self.CLONE_MODES if paths or mode != 'sparse']
+        if not shutil.which('git'):
+            modes = [mode for mode in modes if mode not in ('shallow', 'sparse')]
+        for mode in modes:
+            try:
+                self.__clone(path, mode, branch, paths)
+                return mode
+            except Exception as e:
+                if mode == modes[-1]:
+                    raise
+                logger.warning(f"Can't clone in {mode} mode, trying next mode: {e}")
+                shutil.rmtree(path, ignore_errors=True)
+                self.cli = False
+
+    @contextmanager
+    def worktree(self, path, cache, branch='main'):
+        """Method to checkout branch into worktree of local bare mirror of repository.
+
+        Mirror is cloned once (without blobs) and later only updated with incremental fetch,
+        so only new objects are transferred. Mirror is locked while worktree exists,
+        worktree is removed when context ends. Commit and push are made by git command line.
 
+        Args:
+            path: string path of worktree
+            cache: MirrorCache object
+            branch: string branch checked out in worktree
+        Returns:
+            context manager with path of worktree.
+        """
+        mirror = cache.mirror_path(self.ssh_url)
+        with cache.lock(self.ssh_url):
+            if os.path.isdir(mirror):
+                self.__git('fetch', '-q', '--prune', 'origin', '+refs/heads/*:refs/heads/*', cwd=mirror)
+                self.__git('worktree', 'prune', cwd=mirror)
+                logger.debug(f"Mirror {mirror} updated")
+            else:
+                self.__git('clone', '-q', '--bare', '--filter=blob:none', self.ssh_url, mirror, cwd=None)
+                logger.debug(f"Mirror {mirror} created")
+            # detached worktree, so fetch can always update branches of mirror
+            self.__git('worktree', 'add', '-q', '--detach', path, branch, cwd=mirror)
+            self.path = path
+            self.__open_cli(path)
+            self.detached = True
+            try:
+                yield path
+            finally:
+                self.__git('worktree', 'remove', '--force', path, cwd=mirror)
+                self.detached = False
+        cache.evict()
+
+    def __open_cli(self, path):
+        """Open repository cloned by git command line.
+
+        Older libgit2 can refuse to open partial clone, repository is handled by git command line anyway.
+        """
+        self.cli = True
+        try:
+            self.repo = pygit2.Repository(path)
+        except pygit2.GitError as e:
+            logger.debug(f"pygit2 can't open {path}: {e}")
+            self.repo = None
+
+    @contextmanager
+    def __ssh_env(self):
+        """Return environment for git command line with private key in temporary file.
+
+        File is readable only by owner and it's removed when command ends.
+        With token auth token is passed in environment variable read by TOKEN_HELPER.
+        """
+        if self.prv_k is None:
+            yield dict(os.environ, GIT_TERMINAL_PROMPT='0', **({'AIREE_GIT_TOKEN': self.__token()} if self.token is not None else {}))
+            return
+        fd, key_path = tempfile.mkstemp(prefix='airee_key')
+        try:
+            with os.fdopen(fd, 'wb') as key_file:
+                key_file.write(bytes(self.prv_k))
+            ssh = f"ssh -i {key_path} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR"
+            yield dict(os.environ, GIT_SSH_COMMAND=ssh, GIT_TERMINAL_PROMPT='0')
+        finally:
+            os.remove(key_path)
+
+    def __git(self, *args, cwd='', env=None, quiet=False):
+        """Run git command line in repository and return its output.
+
+        Args:
+            args: git command arguments
+            cwd: string working directory, default path of repository, None for current directory
+            env: dict with additional environment variables
+            quiet: bool flag to log failure on debug level, when caller handles it
+        """
+        with self.__ssh_env() as ssh_env:
+            helper = TOKEN_HELPER if self.token is not None else []
+            r = subprocess.run(['git', *helper, *args], cwd=self.path if cwd == '' else cwd, env=dict(ssh_env, **(env or {})),
+                               capture_output=True, text=True)
+        if r.returncode != 0:
+            (logger.debug if quiet else logger.error)(f"git {args[0]} failed: {r.stderr.strip()}")
+            raise subprocess.CalledProcessError(r.returncode, ['git', *args], r.stdout, r.stderr)
+        return r.stdout
+
+    @metrics.timed('commit_all')
     def commit_all(self, comment, author=["Init", "test@dsstream.com"], commiter=["Init", "test@dsstream.com"]):
         """Method to commit all changes in local repository.
 
@@ -77,6 +283,12 @@ class Gitrepo:
         Returns
             pygit2 commit object
         """
+        if self.cli:
+            env = {'GIT_AUTHOR_NAME': author[0], 'GIT_AUTHOR_EMAIL': author[1], 'GIT_COMMITTER_NAME': commiter[0], 'GIT_COMMITTER_EMAIL': commiter[1]}
+            self.__git('add', '-A')
+            self.__git('commit', '-q', '--allow-empty', '-m', comment, env=env)
+            logger.debug("Commited")
+            return pygit2.Oid(hex=self.__git('rev-parse', 'HEAD').strip())
         auth = pygit2.Signature(*author)
         comm = pygit2.Signature(*commiter)
         index = self.repo.index
@@ -88,20 +300,147 @@ class Gitrepo:
         logger.debug(f"Commited")
         return commit_obj
 
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
+    @metrics.timed('commit_files')
+    def commit_files(self, files, comment, author=["Init", "test@dsstream.com"], commiter=["Init", "test@dsstream.com"]):
+        """Method to commit files kept in memory, e.g. rendered by template_render.
+
+        Files are written as blobs straight to object database (or to shared BlobStore, if it's enabled)
+        and merged with tree of index, so changes staged before (e.g. submodule) are kept. Tree is built with TreeBuilder,
+        working tree is not scanned nor written, index is only set to the new tree.
+
+        Args:
+            files: dict with path of file and tuple (bytes content, bool executable)
+            comment: string with comment to commit
+            author: list of two strings with name and email of changes author
+            commiter: list of two strings with name and email of commiter
+        Returns
+            pygit2 commit object
+        """
+        if self.cli:
+            # repository handled by git command line, files are written to working tree
+            for path, (content, executable) in files.items():
+                file_path = os.path.join(self.path, path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'wb') as f:
+                    f.write(content)
+                os.chmod(file_path, 0o755 if executable else 0o644)
+            return self.commit_all(comment, author, commiter)
+        auth = pygit2.Signature(*author)
+        comm = pygit2.Signature(*commiter)
+        store = BlobStore.shared()
+        if store:
+            store.attach(self)
+        index = self.repo.index
+        tree = self.__write_tree(self.repo.get(index.write_tree()), files, store)
+        index.read_tree(tree)
+        index.write()
+        # branch doesn't exist yet in clone of empty repository
+        branch = self.repo.references.get('refs/heads/main')
+        parents = [branch.target] if branch is not None else []
+        commit_obj = self.repo.create_commit('refs/heads/main', auth, comm, comment, tree, parents)
+        logger.debug(f"Commited {len(files)} files without working tree")
+        return commit_obj
+
+    def __write_tree(self, tree, files, store=None):
+        """Write tree with files merged into existing tree and return its oid.
+
+        Args:
+            tree: pygit2 Tree object which is extended, None for new tree
+            files: dict with path of file relative to tree and tuple (bytes content, bool executable)
+            store: BlobStore object attached to repository, blobs are written to repository if None
+        """
+        builder = self.repo.TreeBuilder(tree) if tree is not None else self.repo.TreeBuilder()
+        subtrees = {}
+        for path, entry in files.items():
+            name, _, rest = path.partition('/')
+            if rest:
+                subtrees.setdefault(name, {})[rest] = entry
+            else:
+                content, executable = entry
+                blob = store.write(content) if store else self.repo.create_blob(content)
+                builder.insert(name, blob, pygit2.GIT_FILEMODE_BLOB_EXECUTABLE if executable else pygit2.GIT_FILEMODE_BLOB)
+        for name, subfiles in subtrees.items():
+            subtree = tree[name] if tree is not None and name in tree else None
+            builder.insert(name, self.__write_tree(subtree if isinstance(subtree, pygit2.Tree) else None, subfiles, store), pygit2.GIT_FILEMODE_TREE)
+        return builder.write()
+
+    def remove_files(self, paths):
+        """Method to remove files from working tree and index, removal is committed by next commit_all or commit_files.
+
+        Args:
+            paths: list of strings with paths of files relative to repository
+        """
+        for path in paths:
+            file_path = os.path.join(self.path, path)
+            if os.path.lexists(file_path):
+                os.remove(file_path)
+        if self.cli:
+            self.__git('rm', '-q', '--cached', '--ignore-unmatch', '--', *paths)
+            return
+        index = self.repo.index
+        for path in paths:
+            if path in index:
+                index.remove(path)
+        index.write()
+
+    @metrics.timed('push')
     def push(self, branch=['refs/heads/main']):
         """Method push all commited changes to remote.
 
+        Push is compare-and-swap: if remote branch was changed in meantime (non fast-forward),
+        PushRejected is raised and push is not retried, so stale commit never overwrites the change.
+        Caller can sync repository with remote, make the change again and push it.
+
         Args:
             branch: list of strings with branches name where changes will be pushed. Default value main (refs/heads/main)
         """
-        remote = self.repo.remotes["origin"]
-        remote.push(branch, callbacks=self.callbacks)
+        if not self.__push(branch):
+            metrics.inc('airee_push_rejected_total')
+            raise PushRejected(f"Push to {self.ssh_url} rejected, remote branch was changed")
         logger.debug(f"Pushed")
         return 0
 
+    @retry(tries=2, delay=20, backoff=2, logger=metrics.retry_logger(logger, 'push'))
+    def __push(self, branch):
+        """Push branches, connection errors are retried. Returns False if push was rejected."""
+        try:
+            if self.cli:
+                self.__git('push', '-q', 'origin', *[f'HEAD:{b}' if self.detached else b for b in branch], quiet=True)
+            else:
+                # libgit2 reports references rejected by remote only to callback
+                rejected = []
+                self.callbacks.push_update_reference = lambda refname, message: rejected.append(f"{refname}: {message}") if message else None
+                self.repo.remotes["origin"].push(branch, callbacks=self.callbacks)
+                if rejected:
+                    logger.debug(f"Push rejected: {', '.join(rejected)}")
+                    return False
+        except (subprocess.CalledProcessError, pygit2.GitError) as e:
+            if any(message in str(getattr(e, 'stderr', None) or e) for message in REJECTED_MESSAGES):
+                return False
+            raise
+        return True
+
+    @metrics.timed('sync')
+    def sync(self, branch='main'):
+        """Method to reset repository to current commit of remote branch, local commits and changes are dropped.
 
-    @retry(tries=2, delay=20, backoff=2, logger=logger)
+        It's used after PushRejected, shallow and sparse clones stay shallow and sparse.
+
+        Args:
+            branch: string branch fetched from remote
+        """
+        if self.cli:
+            shallow = self.__git('rev-parse', '--is-shallow-repository').strip() == 'true'
+            self.__git('fetch', '-q', *(['--depth', '1'] if shallow else []), 'origin', f'refs/heads/{branch}')
+            self.__git('reset', '-q', '--hard', 'FETCH_HEAD')
+        else:
+            self.repo.remotes["origin"].fetch([f'+refs/heads/{branch}:refs/remotes/origin/{branch}'], callbacks=self.callbacks)
+            self.repo.reset(self.repo.references[f'refs/remotes/origin/{branch}'].target, pygit2.GIT_RESET_HARD)
+        logger.debug(f"Synced with origin {branch}")
+        return 0
+
+    @metrics.timed('add_submodule')
+    @retry(tries=2, delay=20, backoff=2, logger=metrics.retry_logger(logger, 'add_submodule'))
     def add_submodule(self, git_repo, path):
         """Method to add submodule.
 
@@ -111,4 +450,203 @@ class Gitrepo:
         """
         self.repo.add_submodule(git_repo.ssh_url, path, callbacks=git_repo.callbacks)
         logger.debug(f"Submodule added")
-        return 0
\ No newline at end of file
+        return 0
+
+    @metrics.timed('link_submodule')
+    def link_submodule(self, git_repo, path, commit=None, checkout=False):
+        """Method to add submodule without clone of submodule repository.
+
+        .gitmodules and gitlink entry with commit of submodule are written to index from known url and commit,
+        nothing is downloaded. Working tree of submodule is checked out only if checkout is True,
+        it's cloned from local clone of submodule repository, not from network.
+
+        Args:
+            git_repo: Gitrepo object of submodule repository
+            path: string with path where submodule will be placed
+            commit: string sha of submodule commit, default HEAD of local clone of submodule repository
+            checkout: bool flag to check out working tree of submodule
+        """
+        commit = str(commit if commit else git_repo.repo.head.target)
+        if self.cli:
+            self.__git('config', '-f', '.gitmodules', f'submodule.{path}.path', path)
+            self.__git('config', '-f', '.gitmodules', f'submodule.{path}.url', git_repo.ssh_url)
+            self.__git('add', '.gitmodules')
+            self.__git('update-index', '--add', '--cacheinfo', f'160000,{commit},{path}')
+            # empty directory is not submodule checkout, "add -A" doesn't remove gitlink
+            os.makedirs(os.path.join(self.path, path), exist_ok=True)
+        else:
+            index = self.repo.index
+            gitmodules = self.repo[index['.gitmodules'].id].data.decode() if '.gitmodules' in index else ''
+            if f'[submodule "{path}"]' not in gitmodules:
+                gitmodules += f'[submodule "{path}"]\n\tpath = {path}\n\turl = {git_repo.ssh_url}\n'
+            index.add(pygit2.IndexEntry('.gitmodules', self.repo.create_blob(gitmodules.encode()), pygit2.GIT_FILEMODE_BLOB))
+            index.add(pygit2.IndexEntry(path, pygit2.Oid(hex=commit), pygit2.GIT_FILEMODE_COMMIT))
+            index.write()
+        if checkout:
+            sub_repo = pygit2.clone_repository(git_repo.path, os.path.join(self.path, path))
+            sub_repo.remotes.set_url("origin", git_repo.ssh_url)
+            sub_repo.checkout_tree(sub_repo[commit])
+            sub_repo.set_head(pygit2.Oid(hex=commit))
+        logger.debug(f"Submodule {path} linked to commit {commit}")
+        return 0
+
+
+class MirrorCache:
+    """Class to keep local bare mirrors of repositories used by Gitrepo.worktree.
+
+    Each mirror has lock file, so operations on the same repository are serialized between
+    threads and processes. Modification time of lock file is time of last usage of mirror,
+    the least recently used mirrors are removed when cache is bigger than max_size.
+
+    Attributes:
+        path: string path of cache directory
+        max_size: int bytes limit of all mirrors
+    """
+    def __init__(self, path=None, max_size=None):
+        """Create MirrorCache object."""
+        self.path = path if path else config.mirror_cache_dir
+        self.max_size = max_size if max_size is not None else config.mirror_cache_max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    def mirror_path(self, url):
+        """Return path of mirror for repository url."""
+        name = os.path.basename(url.rstrip('/'))
+        name = name if name.endswith('.git') else f'{name}.git'
+        return os.path.join(self.path, f"{hashlib.sha1(url.encode()).hexdigest()[:12]}_{name}")
+
+    @contextmanager
+    def lock(self, url, blocking=True):
+        """Method to lock mirror of repository.
+
+        Args:
+            url: string url of repository
+            blocking: bool flag to wait for lock, if False BlockingIOError is raised when mirror is locked
+        Returns:
+            context manager holding the lock.
+        """
+        lock_path = f'{self.mirror_path(url)}.lock'
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                yield lock_path
+            finally:
+                os.utime(lock_path)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict(self):
+        """Method to remove the least recently used mirrors above max_size.
+
+        Mirrors locked by other operations are skipped.
+
+        Returns:
+            list of removed mirrors.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            mirror = os.path.join(self.path, name)
+            if name.endswith('.git') and os.path.isdir(mirror):
+                lock_path = f'{mirror}.lock'
+                last_used = os.path.getmtime(lock_path) if os.path.exists(lock_path) else 0
+                size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(mirror) for f in files)
+                entries.append((last_used, size, mirror))
+
+        removed = []
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, mirror in sorted(entries):
+            if total <= self.max_size:
+                break
+            lock_path = f'{mirror}.lock'
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                # lock file is kept, other process can wait on it
+                shutil.rmtree(mirror, ignore_errors=True)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            total -= size
+            removed.append(mirror)
+            logger.debug(f"Mirror {mirror} removed from cache, last used {time.ctime(last_used)}")
+        return removed
+
+
+
+class BlobStore:
+    """Class with bare repository keeping blobs of rendered files shared by many repositories.
+
+    Repository which commits files with Gitrepo.commit_files has objects of store as git alternate
+    (objects/info/alternates), so blob of file rendered for many workspaces is written once and
+    only its id is put to tree of every repository. Push sends blobs from alternate as other objects.
+    Ids of blobs written by this process are kept in memory, so blob already in store is only hashed,
+    it's neither looked up in object database nor written again.
+
+    Attributes:
+        path: string path of bare repository
+        max_entries: int max number of blob ids kept in memory
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None, max_entries=None):
+        """Create BlobStore object, bare repository is created if it doesn't exist."""
+        self.path = path if path else config.blob_store_dir
+        self.max_entries = max_entries if max_entries is not None else config.render_cache_size
+        if os.path.isdir(os.path.join(self.path, 'objects')):
+            self.repo = pygit2.Repository(self.path)
+        else:
+            self.repo = pygit2.init_repository(self.path, bare=True)
+        self.objects = os.path.join(self.repo.path, 'objects')
+        self.__oids = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Return BlobStore object shared by process for config.blob_store_dir, None if store is disabled or can't be used."""
+        if not config.blob_store_dir:
+            return None
+        with cls._shared_lock:
+            if config.blob_store_dir not in cls._shared:
+                try:
+                    cls._shared[config.blob_store_dir] = cls(config.blob_store_dir)
+                except (OSError, pygit2.GitError) as e:
+                    logger.warning(f"Blob store {config.blob_store_dir} can't be used, blobs are written to every repository: {e}")
+                    cls._shared[config.blob_store_dir] = None
+            return cls._shared[config.blob_store_dir]
+
+    def write(self, content):
+        """Method to write blob to store if it's not there yet.
+
+        Args:
+            content: bytes with content of file
+        Returns:
+            pygit2 Oid of blob.
+        """
+        oid = pygit2.hash(content)
+        with self.__lock:
+            if oid in self.__oids:
+                self.__oids.move_to_end(oid)
+                return oid
+            self.repo.create_blob(content)
+            self.__oids[oid] = True
+            while len(self.__oids) > self.max_entries:
+                self.__oids.popitem(last=False)
+            return oid
+
+    def attach(self, git_repo):
+        """Method to add store as alternate object database of repository.
+
+        Args:
+            git_repo: Gitrepo object with repository opened by pygit2
+        """
+        alternates = os.path.join(git_repo.repo.path, 'objects', 'info', 'alternates')
+        existing = []
+        if os.path.exists(alternates):
+            with open(alternates, 'r') as f:
+                existing = f.read().splitlines()
+        if self.objects in existing:
+            return
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, 'a') as f:
+            f.write(f"{self.objects}\n")
+        git_repo.repo.odb.add_disk_alternate(self.objects)
+        logger.debug(f"Blob store {self.path} attached to {git_repo.path}")
@@ -0,0 +1,97 @@
+"""Module with journal of finished steps of workspace creation.
+
+Every finished step of "create" (repository created, deploy key set, secrets set, files pushed)
+is written to local json file in config.journal_dir (on disk by default), so failed "create" can be run
+again and it continues from the failed step instead of exit on already existing repository.
+Journal without path is kept only in memory.
+
+    Typical usege:
+
+    journal = Journal.for_workspace(config.journal_dir, github_org, name_of_workspace, env)
+    if not journal.done('infra', 'repo'):
+        repo_gh = airee.create_repo(name)
+        journal.record('infra', 'repo', id=repo_gh.id)
+"""
+import config
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from os.path import join as path_join
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+
+class Journal:
+    """Class with journal of finished steps of workspace creation.
+
+    Steps are kept per repository type [infra, app, workspace_data], each step with its data,
+    e.g. id of created deploy key. File is written atomically after every step.
+
+    Attributes:
+        path: string path of json file, journal is kept only in memory if None
+    """
+    def __init__(self, path=None):
+        """Create Journal object, steps are loaded from file if it exists."""
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__steps = {}
+        if path and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.__steps = json.load(f)
+            logger.info(f"Journal {path} loaded, create continues from last finished step")
+
+    @classmethod
+    def for_workspace(cls, directory, org, workspace, env):
+        """Return journal of workspace kept in directory, in memory if directory is empty.
+
+        Args:
+            directory: string path of journal directory, e.g. config.journal_dir
+            org: string name of GitHub Organization
+            workspace: string with name of workspace
+            env: string with environment of workspace
+        Returns:
+            Journal object.
+        """
+        return cls(path_join(directory, org, f'{workspace}_{env}.json') if directory else None)
+
+    def done(self, type, step):
+        """Return dict with data of finished step or None if step was not finished.
+
+        Args:
+            type: string with type ["infra", "app", "workspace_data"] or "workspace"
+            step: string with name of step, e.g. repo, key, secrets, pushed
+        """
+        with self.__lock:
+            return self.__steps.get(type, {}).get(step)
+
+    def record(self, type, step, **data):
+        """Method to record finished step with its data."""
+        with self.__lock:
+            self.__steps.setdefault(type, {})[step] = dict(data, finished=time.time())
+            self.__write()
+        logger.debug(f"Step {step} of {type} recorded")
+
+    def forget(self, type, step=None):
+        """Method to remove step, or all steps of type, e.g. when repository doesn't exist anymore."""
+        with self.__lock:
+            if step:
+                self.__steps.get(type, {}).pop(step, None)
+            else:
+                self.__steps.pop(type, None)
+            self.__write()
+
+    def __write(self):
+        """Write journal atomically, file is readable only by owner."""
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp{secrets.token_urlsafe(6)}'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(self.__steps, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,276 @@
+"""Module with timing instrumentation of controller steps.
+
+Hot steps (repository creation, deploy keys, secrets, clone, render, commit, push) are wrapped
+in timed spans. Duration of spans is kept as Prometheus histograms, retries and rate limit
+waits as counters. Labels of spans (workspace, env, type of repository) are kept in context
+variable, so they are set once per workspace or repository and not passed to every function.
+Optionally all spans are kept as trace which can be written as Chrome trace json file
+(chrome://tracing or https://ui.perfetto.dev).
+
+Only step and type labels are used in Prometheus metrics to keep their cardinality low,
+trace has all labels.
+
+    Typical usege:
+
+    @metrics.timed('push')
+    def push(self):
+        ...
+
+    with metrics.labels(workspace=name_of_workspace, type='infra'):
+        infra_git.push()
+    print(metrics.render())
+"""
+import config
+from contextlib import contextmanager
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# labels of spans used in Prometheus metrics
+METRIC_LABELS = ('type',)
+
+_labels = contextvars.ContextVar('airee_labels', default={})
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_trace = None
+_start = time.time()
+
+HELP = {
+    'airee_step_duration_seconds': 'Duration of controller steps.',
+    'airee_step_errors_total': 'Controller steps which raised exception.',
+    'airee_retries_total': 'Retries of controller steps.',
+    'airee_retry_sleep_seconds_total': 'Time spent sleeping before retry of controller steps.',
+    'airee_rate_limit_waits_total': 'GitHub requests delayed by rate limit budget or rate limited response.',
+    'airee_rate_limit_wait_seconds_total': 'Time spent waiting for GitHub rate limit.',
+    'airee_gh_cache_requests_total': 'GitHub GET requests answered from cache after 304 (hit) or cached after 200 (miss).',
+    'airee_push_rejected_total': 'Pushes rejected because remote branch was changed in meantime.',
+    'airee_lease_waits_total': 'Operations which waited for lease of workspace held by other operation.',
+    'airee_lease_wait_seconds_total': 'Time spent waiting for lease of workspace.',
+}
+
+
+@contextmanager
+def labels(**kwargs):
+    """Context manager adding labels to all spans started inside it, in current thread or task."""
+    token = _labels.set(dict(_labels.get(), **kwargs))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def labelled(**kwargs):
+    """Decorator adding labels to all spans started by function."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            with labels(**kwargs):
+                return func(*args, **kw)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(name, **kwargs):
+    """Context manager measuring duration of step.
+
+    Args:
+        name: string name of step, e.g. push
+        kwargs: labels of this span only
+    """
+    span_labels = dict(_labels.get(), **kwargs)
+    start = time.time()
+    begin = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - begin
+        observe(name, duration, span_labels, error)
+        if _trace is not None:
+            with _lock:
+                _trace.append({
+                    'name': name, 'ph': 'X', 'ts': int((start - _start) * 1e6), 'dur': int(duration * 1e6),
+                    'pid': os.getpid(), 'tid': threading.get_ident(),
+                    'args': dict(span_labels, error=error) if error else span_labels,
+                })
+
+
+def timed(name):
+    """Decorator measuring duration of function as step with given name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(name, duration, span_labels=None, error=None):
+    """Function to record duration of step in histogram.
+
+    Args:
+        name: string name of step
+        duration: float seconds
+        span_labels: dict with labels of span
+        error: string name of exception raised by step
+    """
+    key = metric_key(name, span_labels)
+    with _lock:
+        histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0, 0.0])
+        for i, bucket in enumerate(BUCKETS):
+            if duration <= bucket:
+                histogram[0][i] += 1
+        histogram[1] += 1
+        histogram[2] += duration
+    if error:
+        inc('airee_step_errors_total', step=name, error=error, **dict(key[1:]))
+
+
+def inc(metric, value=1, **kwargs):
+    """Function to increment counter.
+
+    Args:
+        metric: string name of counter
+        value: number added to counter
+        kwargs: labels of counter
+    """
+    key = (metric, tuple(sorted((k, str(v)) for k, v in kwargs.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def metric_key(name, span_labels=None):
+    """Return histogram key with step name and labels used in Prometheus metrics."""
+    span_labels = span_labels if span_labels is not None else _labels.get()
+    return (name,) + tuple((label, str(span_labels[label])) for label in METRIC_LABELS if label in span_labels)
+
+
+class RetryLogger:
+    """Logger passed to retry decorator, it counts retries and their sleep time of step.
+
+    retry calls logger.warning(fmt, error, delay) before every sleep.
+    """
+    def __init__(self, logger, step):
+        """Create RetryLogger object."""
+        self.logger = logger
+        self.step = step
+
+    def warning(self, fmt, error, delay, *args):
+        """Count retry and pass message to wrapped logger."""
+        inc('airee_retries_total', step=self.step)
+        inc('airee_retry_sleep_seconds_total', delay, step=self.step)
+        self.logger.warning(fmt, error, delay, *args)
+
+
+def retry_logger(logger, step):
+    """Return logger for retry decorator counting retries of step."""
+    return RetryLogger(logger, step)
+
+
+def rate_limit_wait(seconds, reason):
+    """Function to count wait for GitHub rate limit.
+
+    Args:
+        seconds: float seconds of wait
+        reason: string reason [budget, rate_limited]
+    """
+    inc('airee_rate_limit_waits_total', reason=reason)
+    inc('airee_rate_limit_wait_seconds_total', seconds, reason=reason)
+
+
+def render():
+    """Return all metrics in Prometheus text format."""
+    lines = []
+    with _lock:
+        histograms = {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines.append(f"# HELP airee_step_duration_seconds {HELP['airee_step_duration_seconds']}")
+    lines.append('# TYPE airee_step_duration_seconds histogram')
+    for key in sorted(histograms):
+        buckets, count, total = histograms[key]
+        base = [('step', key[0])] + list(key[1:])
+        for bucket, value in zip(BUCKETS, buckets):
+            lines.append(f"airee_step_duration_seconds_bucket{_format(base + [('le', str(bucket))])} {value}")
+        lines.append(f"airee_step_duration_seconds_bucket{_format(base + [('le', '+Inf')])} {count}")
+        lines.append(f"airee_step_duration_seconds_sum{_format(base)} {total}")
+        lines.append(f"airee_step_duration_seconds_count{_format(base)} {count}")
+
+    for metric in sorted({key[0] for key in counters}):
+        lines.append(f"# HELP {metric} {HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} counter")
+        for key in sorted(k for k in counters if k[0] == metric):
+            lines.append(f"{metric}{_format(list(key[1]))} {counters[key]}")
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """Return dict with count, total and mean seconds per step, e.g. for benchmarks."""
+    with _lock:
+        steps = {}
+        for key, (_, count, total) in _histograms.items():
+            step = steps.setdefault(key[0], {'count': 0, 'seconds': 0.0})
+            step['count'] += count
+            step['seconds'] += total
+    for step in steps.values():
+        step['mean'] = step['seconds'] / step['count'] if step['count'] else 0
+    return steps
+
+
+def reset():
+    """Function to remove all recorded metrics and trace."""
+    global _trace
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _trace = [] if _trace is not None else None
+
+
+def enable_trace():
+    """Function to start keeping all spans in trace."""
+    global _trace
+    with _lock:
+        if _trace is None:
+            _trace = []
+
+
+def write_trace(path):
+    """Function to write trace as Chrome trace json file."""
+    with _lock:
+        events = list(_trace or [])
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    logger.info(f"Trace with {len(events)} spans written to {path}")
+
+
+def write_metrics(path):
+    """Function to write metrics in Prometheus text format, e.g. for node exporter textfile collector."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+    logger.info(f"Metrics written to {path}")
+
+
+def _format(pairs):
+    """Return Prometheus labels of list of (name, value) pairs."""
+    if not pairs:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
@@ -5,8 +5,10 @@ https://cryptography.io/en/latest/hazmat/primitives/asymmetric/ec/#cryptography.
 """
 from cryptography.hazmat.primitives.asymmetric import rsa, ed25519, ec
 from cryptography.hazmat.primitives import serialization
-import config
+from collections import deque
+import config, metrics
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 logger.setLevel(config.log_lvl)
@@ -25,6 +27,7 @@ class PairKey:
         """"""
         pass
     
+    @metrics.timed('generate_key_rsa')
     def generate_pair_rsa(public_exponent=65537, key_size=2048):
         """Method to generate RSA key pair.
         
@@ -45,11 +48,12 @@ class PairKey:
         public_key = private_key.public_key()
         
         pem_pub = public_key.public_bytes(
-            serialization.Encoding.PEM,
+            serialization.Encoding.OpenSSH,
             serialization.PublicFormat.OpenSSH)
         logger.debug("created RSA keypair")
         return pem_priv, pem_pub
 
+    @metrics.timed('generate_key_ed25519')
     def generate_pair_ed25519():
         """Method to generate ED25519 key pair.
         
@@ -72,6 +76,7 @@ class PairKey:
         return private_bytes, public_bytes
 
     # working with pygit2 :)
+    @metrics.timed('generate_key_ecdsa')
     def generate_pair_ecdsa():
         """Method to generate ED25519 key pair.
         
@@ -111,4 +116,112 @@ class PairKey:
         with open(f'{path}/{pub_name}', 'wb') as f:
             f.write(pub_b)
             logger.debug(f"Priv key saved on {path}/{pub_name}")
-        return 0
\ No newline at end of file
+        return 0
+
+
+class KeyPool:
+    """Class to keep key pairs generated in background thread.
+
+    Pool is filled up to "size" key pairs per algorithm, so key pair is taken with O(1) latency
+    instead of being generated on critical path of request. If pool is empty, key pair is generated inline
+    and counted as miss. Keys are kept only in memory, private keys as bytearray which is zeroed
+    when key is discarded or pool is closed (copies made by callers, e.g. str for pygit2, can't be zeroed).
+
+    Attributes:
+        size: int number of key pairs kept per algorithm
+        algorithms: list of algorithms [ecdsa, ed25519, rsa] filled in background
+        hits: dict with number of key pairs taken from pool per algorithm
+        misses: dict with number of key pairs generated inline per algorithm
+    """
+    GENERATORS = {
+        'ecdsa': PairKey.generate_pair_ecdsa,
+        'ed25519': PairKey.generate_pair_ed25519,
+        'rsa': PairKey.generate_pair_rsa,
+    }
+
+    def __init__(self, size=None, algorithms=['ecdsa']):
+        """Create KeyPool object and start background thread filling it."""
+        self.size = size if size else config.key_pool_size
+        self.algorithms = list(algorithms)
+        self.hits = {alg: 0 for alg in self.algorithms}
+        self.misses = {alg: 0 for alg in self.algorithms}
+        self.__keys = {alg: deque() for alg in self.algorithms}
+        self.__cond = threading.Condition()
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__fill, name='key-pool', daemon=True)
+        self.__thread.start()
+        logger.debug(f"Key pool for {', '.join(self.algorithms)} started with size {self.size}")
+
+    def get(self, algorithm='ecdsa'):
+        """Method to take key pair from pool.
+
+        Args:
+            algorithm: string with algorithm [ecdsa, ed25519, rsa]
+        Returns:
+            priv - private key as bytearray
+            pub - public key as bytes
+        """
+        with self.__cond:
+            keys = self.__keys.get(algorithm)
+            if keys:
+                self.hits[algorithm] += 1
+                self.__cond.notify()
+                return keys.popleft()
+            self.misses[algorithm] = self.misses.get(algorithm, 0) + 1
+            self.__cond.notify()
+        logger.debug(f"Key pool miss for {algorithm}")
+        return self.__generate(algorithm)
+
+    def stats(self):
+        """Method to return pool usage, e.g. to size the pool.
+
+        Returns:
+            dict with hits, misses and number of ready key pairs per algorithm.
+        """
+        with self.__cond:
+            return {alg: {'hits': self.hits.get(alg, 0), 'misses': self.misses.get(alg, 0), 'ready': len(self.__keys.get(alg, []))}
+                    for alg in set(self.hits) | set(self.misses)}
+
+    def close(self):
+        """Method to stop background thread and zero all key pairs left in pool."""
+        with self.__cond:
+            self.__closed = True
+            for keys in self.__keys.values():
+                while keys:
+                    KeyPool.discard(keys.popleft()[0])
+            self.__cond.notify_all()
+        self.__thread.join()
+        logger.debug(f"Key pool closed, stats: {self.stats()}")
+
+    @staticmethod
+    def discard(priv):
+        """Method to zero private key kept in bytearray.
+
+        Args:
+            priv: private key as bytearray, other types are ignored
+        """
+        if isinstance(priv, bytearray):
+            priv[:] = bytes(len(priv))
+
+    def __generate(self, algorithm):
+        """Generate key pair with private key as bytearray."""
+        priv, pub = KeyPool.GENERATORS[algorithm]()
+        return bytearray(priv), pub
+
+    def __fill(self):
+        """Keep pool filled up to size until it is closed."""
+        while True:
+            with self.__cond:
+                while not self.__closed and all(len(keys) >= self.size for keys in self.__keys.values()):
+                    self.__cond.wait()
+                if self.__closed:
+                    return
+                algorithm = min(self.__keys, key=lambda alg: len(self.__keys[alg]))
+            # key is generated without lock, so "get" is not blocked
+            key_pair = self.__generate(algorithm)
+            with self.__cond:
+                if self.__closed:
+                    KeyPool.discard(key_pair[0])
+                    return
+                self.__keys[algorithm].append(key_pair)
+
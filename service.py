@@ -0,0 +1,424 @@
+"""Module with long-running controller service with HTTP API and persistent job queue.
+
+Service keeps GitHub client, Organization objects, template cache and deploy key pool
+warm in memory, so single operation doesn't pay for interpreter start, imports and lookups.
+Operations are stored in sqlite job queue and executed by bounded pool of workers,
+jobs interrupted by restart are queued again. Jobs of the same workspace are executed one after another,
+jobs of different workspaces in parallel.
+
+Endpoints:
+    GET  /health                                    - service state and number of queued and running jobs
+    POST /workspaces                                - create workspace, body with the same fields as "create" arguments
+    POST /workspaces/<workspace>/<env>/<action>     - change status, action is one of pause, start, destroy
+    GET  /jobs/<id>                                 - job status and result
+    GET  /jobs?status=<status>&limit=<n>            - the newest jobs
+    GET  /metrics                                   - step durations, retries and rate limit waits in Prometheus format
+
+    Typical usege:
+
+    service = Service(PAT, github_org)
+    service.serve('0.0.0.0', 8080)
+"""
+from airee_repos import Airee_gh_repo
+from pair_key import KeyPool
+from template_cache import TemplateCache
+import entrypoint_init
+import fleet
+import config, metrics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import hmac
+import json
+import logging
+import os
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+JOB_STATUSES = ['queued', 'running', 'done', 'failed']
+# addresses where API without key can listen, reachable only from the same host
+LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+
+class JobQueue:
+    """Class with persistent queue of jobs kept in sqlite database.
+
+    Attributes:
+        path: string path of sqlite database file
+    """
+    def __init__(self, path=None):
+        """Create JobQueue object, database is created if it doesn't exist."""
+        self.path = path if path else config.service_db
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.__db.row_factory = sqlite3.Row
+        # job arguments can contain TLS private key
+        os.chmod(self.path, 0o600)
+        with self.__lock:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, command TEXT, ghorg TEXT, workspace TEXT, env TEXT, args TEXT, '
+                'status TEXT, result TEXT, created REAL, started REAL, finished REAL)'
+            )
+            self.__db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS jobs_workspace ON jobs (ghorg, workspace, env, status)')
+
+    def submit(self, command, ghorg, workspace, env, args):
+        """Method to add job to queue.
+
+        Args:
+            command: string with command [create, pause, start, destroy]
+            ghorg: string name of GitHub Organization
+            workspace: string with name of workspace
+            env: string with environment of workspace
+            args: dict with job arguments
+        Returns:
+            string with id of job.
+        """
+        job_id = uuid.uuid4().hex
+        with self.__lock:
+            self.__db.execute(
+                'INSERT INTO jobs (id, command, ghorg, workspace, env, args, status, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, command, ghorg, workspace, env, json.dumps(args), 'queued', time.time())
+            )
+        logger.debug(f"Job {job_id} {command} {workspace} {env} queued")
+        return job_id
+
+    def claim(self):
+        """Method to take the oldest queued job of workspace without running job and mark it as running.
+
+        Running job is lease of its workspace: jobs of the same workspace are executed one after another
+        in order of submission, jobs of different workspaces are executed in parallel.
+
+        Returns:
+            dict with job or None if there is no job which can be started.
+        """
+        with self.__lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.__db.execute(
+                    "SELECT * FROM jobs AS queued WHERE status = 'queued' AND NOT EXISTS ("
+                    "SELECT 1 FROM jobs AS running WHERE running.status = 'running' AND running.ghorg = queued.ghorg "
+                    "AND running.workspace = queued.workspace AND running.env = queued.env) "
+                    "ORDER BY created LIMIT 1"
+                ).fetchone()
+                if row:
+                    self.__db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), row['id']))
+            finally:
+                self.__db.execute('COMMIT')
+        return self.__job(row, args=True) if row else None
+
+    def finish(self, job_id, status, result):
+        """Method to store result of job.
+
+        Args:
+            job_id: string with id of job
+            status: string with final status [done, failed]
+            result: dict with result of job
+        """
+        with self.__lock:
+            self.__db.execute('UPDATE jobs SET status = ?, result = ?, finished = ? WHERE id = ?', (status, json.dumps(result), time.time(), job_id))
+
+    def requeue(self):
+        """Method to queue again jobs which were running when service was stopped.
+
+        Returns:
+            int number of queued jobs.
+        """
+        with self.__lock:
+            count = self.__db.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'").rowcount
+        if count:
+            logger.warning(f"{count} interrupted jobs queued again")
+        return count
+
+    def get(self, job_id):
+        """Return dict with job or None if it doesn't exist."""
+        with self.__lock:
+            row = self.__db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.__job(row) if row else None
+
+    def list(self, status=None, limit=100):
+        """Return list of the newest jobs, optionally with given status."""
+        with self.__lock:
+            if status:
+                rows = self.__db.execute('SELECT * FROM jobs WHERE status = ? ORDER BY created DESC LIMIT ?', (status, limit)).fetchall()
+            else:
+                rows = self.__db.execute('SELECT * FROM jobs ORDER BY created DESC LIMIT ?', (limit,)).fetchall()
+        return [self.__job(row) for row in rows]
+
+    def counts(self):
+        """Return dict with number of jobs per status."""
+        with self.__lock:
+            rows = self.__db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict({status: 0 for status in JOB_STATUSES}, **{row[0]: row[1] for row in rows})
+
+    @staticmethod
+    def __job(row, args=False):
+        """Return dict with job, arguments are returned only to workers."""
+        job = {key: row[key] for key in row.keys() if key not in ('args', 'result')}
+        job['result'] = json.loads(row['result']) if row['result'] else None
+        if args:
+            job['args'] = json.loads(row['args'])
+        return job
+
+
+class Service:
+    """Class with controller service executing jobs from queue.
+
+    Attributes:
+        token: string value of PAT
+        ghorg: string name of default GitHub Organization
+        workers: int number of jobs executed in parallel
+        api_key: string key required in X-API-Key header, API listens only on loopback address if None
+        journal_dir: string path of journals of "create" jobs, job interrupted by restart continues from last finished step
+        queue: JobQueue object
+        key_pool: KeyPool object shared by all jobs
+        template_cache: TemplateCache object shared by all jobs
+    """
+    def __init__(self, token, ghorg=None, workers=None, api_key=None, db=None, journal_dir=None):
+        """Create Service object."""
+        self.token = token
+        self.ghorg = ghorg
+        self.workers = workers if workers else config.batch_workers
+        self.api_key = api_key
+        self.queue = JobQueue(db)
+        # journal is always kept on disk, next to job queue if it's not configured
+        self.journal_dir = journal_dir or config.journal_dir or os.path.join(os.path.dirname(os.path.abspath(self.queue.path)), 'journal')
+        self.key_pool = KeyPool(size=max(config.key_pool_size, 3 * self.workers))
+        self.template_cache = TemplateCache()
+        self.__airee = {}
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__stop = threading.Event()
+        self.__threads = []
+
+    def airee(self, ghorg):
+        """Return Airee_gh_repo object for GitHub Organization, created once and shared by all jobs."""
+        with self.__lock:
+            if ghorg not in self.__airee:
+                self.__airee[ghorg] = Airee_gh_repo(self.token, None, org=ghorg, template_cache=self.template_cache, key_pool=self.key_pool)
+            return self.__airee[ghorg]
+
+    def submit_create(self, workspace):
+        """Method to queue creation of workspace.
+
+        Args:
+            workspace: dict with the same fields as "create" arguments, optionally with ghorg
+        Returns:
+            string with id of job.
+            ValueError is raised if workspace is not valid.
+        """
+        workspace = dict(workspace)
+        ghorg = workspace.pop('ghorg', None) or self.ghorg
+        if not ghorg:
+            raise ValueError("Missing field ghorg")
+        args = fleet.create_args(workspace, self.token, ghorg)
+        return self.queue.submit('create', ghorg, args['workspace'], args['env'], workspace)
+
+    def submit_status(self, action, workspace, env, ghorg=None):
+        """Method to queue status change of workspace.
+
+        Args:
+            action: string with action [pause, start, destroy]
+            workspace: string with name of workspace
+            env: string with environment of workspace
+            ghorg: string name of GitHub Organization, default one of service
+        Returns:
+            string with id of job.
+            ValueError is raised if arguments are not valid.
+        """
+        ghorg = ghorg if ghorg else self.ghorg
+        if action not in entrypoint_init.STATUS_ACTIONS:
+            raise ValueError(f"Action should be one of {', '.join(entrypoint_init.STATUS_ACTIONS)}, not {action}")
+        if env not in fleet.CREATE_CHOICES['env']:
+            raise ValueError(f"Env should be one of {', '.join(fleet.CREATE_CHOICES['env'])}, not {env}")
+        if not ghorg:
+            raise ValueError("Missing ghorg")
+        return self.queue.submit(action, ghorg, workspace, env, {})
+
+    def run_job(self, job):
+        """Method to execute single job with functions used by command line.
+
+        Args:
+            job: dict with job taken from queue
+        Returns:
+            string with final status and dict with result of job.
+        """
+        airee = self.airee(job['ghorg'])
+        if job['command'] == 'create':
+            result = fleet.create_one(airee, job['args'], self.journal_dir)
+            return ('failed' if result['status'] == 'failed' else 'done'), result
+        result = fleet.status_one(airee, job['workspace'], job['env'], entrypoint_init.STATUS_ACTIONS[job['command']])
+        return ('failed' if result['result'] == 'failed' else 'done'), result
+
+    def start(self):
+        """Method to start workers, interrupted jobs are queued again."""
+        self.queue.requeue()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__work, name=f'airee-worker-{i}', daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+        logger.info(f"{self.workers} workers started")
+
+    def stop(self, timeout=None):
+        """Method to stop workers after their current jobs."""
+        self.__stop.set()
+        self.__wakeup.set()
+        for thread in self.__threads:
+            thread.join(timeout)
+        self.key_pool.close()
+
+    def notify(self):
+        """Method to wake up workers waiting for jobs."""
+        self.__wakeup.set()
+
+    def serve(self, host=None, port=8080):
+        """Method to run HTTP API until SIGTERM or SIGINT.
+
+        Jobs run with PAT of service, so API without api_key listens only on loopback address.
+
+        Args:
+            host: string with address to listen on, default 0.0.0.0 with api_key and 127.0.0.1 without it
+            port: int with port to listen on
+        """
+        if not host:
+            host = '0.0.0.0' if self.api_key else '127.0.0.1'
+        if not self.api_key and host not in LOOPBACK_HOSTS:
+            logger.error(f"API without key can't listen on {host}, set AIREE_API_KEY env variable")
+            raise SystemExit(1)
+        if not self.api_key:
+            logger.warning(f"AIREE_API_KEY is not set, API listens only on {host}")
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        server.service = self
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, terminate)
+
+        self.start()
+        logger.info(f"Controller service listening on {host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Controller service stopping")
+        finally:
+            server.server_close()
+            self.stop(timeout=1)
+
+    def __work(self):
+        """Worker loop, it takes jobs from queue until service is stopped."""
+        while not self.__stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self.__wakeup.wait(timeout=1)
+                self.__wakeup.clear()
+                continue
+            logger.info(f"Job {job['id']} {job['command']} {job['workspace']} {job['env']} started")
+            try:
+                status, result = self.run_job(job)
+            # SystemExit is used by repository objects to report known errors
+            except (Exception, SystemExit) as e:
+                logger.error(f"Job {job['id']} failed: {e!r}")
+                status, result = 'failed', {'error': repr(e)}
+            self.queue.finish(job['id'], status, result)
+            logger.info(f"Job {job['id']} {status}")
+            # next job of the same workspace can be started by waiting worker
+            self.__wakeup.set()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP request handler of controller service API."""
+
+    def do_GET(self):
+        """Handle GET request, /metrics is open for Prometheus scraper."""
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            return self.__reply(200, metrics.render(), 'text/plain; version=0.0.4')
+        if not self.__authorized():
+            return
+        parts = [part for part in url.path.split('/') if part]
+        queue = self.server.service.queue
+        if parts == ['health']:
+            self.__reply(200, {'status': 'ok', 'jobs': queue.counts(), 'key_pool': self.server.service.key_pool.stats()})
+        elif parts == ['jobs']:
+            query = parse_qs(url.query)
+            status = query.get('status', [None])[0]
+            if status and status not in JOB_STATUSES:
+                return self.__reply(400, {'error': f"Status should be one of {', '.join(JOB_STATUSES)}"})
+            limit = query.get('limit', ['100'])[0]
+            if not limit.isdigit():
+                return self.__reply(400, {'error': 'Limit should be a number'})
+            self.__reply(200, {'jobs': queue.list(status, int(limit))})
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = queue.get(parts[1])
+            if job:
+                self.__reply(200, job)
+            else:
+                self.__reply(404, {'error': f"Job {parts[1]} not found"})
+        else:
+            self.__reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        """Handle POST request."""
+        if not self.__authorized():
+            return
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        service = self.server.service
+        try:
+            body = self.__body()
+            if parts == ['workspaces']:
+                job_id = service.submit_create(body)
+            elif len(parts) == 4 and parts[0] == 'workspaces':
+                job_id = service.submit_status(parts[3], parts[1], parts[2], body.get('ghorg') or parse_qs(url.query).get('ghorg', [None])[0])
+            else:
+                return self.__reply(404, {'error': 'Not found'})
+        except ValueError as e:
+            return self.__reply(400, {'error': str(e)})
+        service.notify()
+        self.__reply(202, {'id': job_id, 'status': 'queued', 'url': f'/jobs/{job_id}'})
+
+    def log_message(self, format, *args):
+        """Log requests with module logger instead of stderr."""
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def __authorized(self):
+        """Check API key of request, reply 401 if it's not valid."""
+        api_key = self.server.service.api_key
+        if not api_key or hmac.compare_digest(self.headers.get('X-API-Key', ''), api_key):
+            return True
+        self.__reply(401, {'error': 'Invalid API key'})
+        return False
+
+    def __body(self):
+        """Return json body of request as dict."""
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Body is not valid json: {e}")
+        if not isinstance(body, dict):
+            raise ValueError("Body should be json object")
+        return body
+
+    def __reply(self, code, obj, content_type='application/json'):
+        """Send json response, or text if content type is not json."""
+        data = json.dumps(obj).encode() if content_type == 'application/json' else obj.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
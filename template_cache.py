@@ -0,0 +1,266 @@
+"""Module with local cache of cookiecutter template repositories.
+
+Templates are kept on disk per GitHub Organization, template repository and commit,
+so provisioning against the same branch many times does not clone template again.
+Freshness of cached copy is checked with cheap "git ls-remote" call.
+It use git command line, the same as cookiecutter.
+
+    Typical usege:
+
+    cache = TemplateCache()
+    with cache.use(PAT, github_org, config.template['infra'], 'main') as template_dir:
+        cookiecutter(template_dir, output_dir=path, no_input=True)
+"""
+import config
+from contextlib import contextmanager
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import subprocess
+import threading
+import time
+from os.path import join as path_join
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+SHA_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+TOKEN_IN_URL = re.compile(r'//[^/@\s]+@')
+# templates used in last seconds are not removed, they can be rendered by other process
+IN_USE_GRACE = 300
+
+
+class TemplateCache:
+    """Class to keep cookiecutter templates in local directory.
+
+    Layout of cache directory is <path>/<org>/<template>/<commit>/<template>,
+    so template directory has the same name as after "git clone".
+    Last usage of cached commit is kept as modification time of <commit> directory
+    and it is used by eviction policy. Templates used by this process (see use) and templates
+    used by any process in last IN_USE_GRACE seconds are not removed.
+
+    Attributes:
+        path: string path of cache directory
+        max_age: int seconds after which not used template is removed
+        max_size: int bytes limit of all cached templates
+    """
+    def __init__(self, path=None, max_age=None, max_size=None):
+        """Create TemplateCache object."""
+        self.path = path if path else config.template_cache_dir
+        self.max_age = max_age if max_age is not None else config.template_cache_max_age
+        self.max_size = max_size if max_size is not None else config.template_cache_max_size
+        self.__lock = threading.Lock()
+        self.__key_locks = {}
+        self.__in_use = {}
+        logger.debug(f"Template cache in {self.path}")
+
+    def get(self, token, org, template, checkout='main'):
+        """Method to return path to local copy of template repository.
+
+        If commit for given checkout is not cached yet, template is fetched from GitHub.
+        Template can be removed by eviction after IN_USE_GRACE seconds, use "use" to keep it longer.
+
+        Args:
+            token: string value of PAT
+            org: string name of GitHub Organization where template is placed
+            template: string name of template repository, e.g. from config.template
+            checkout: string with branch, tag or commit of template
+        Returns:
+            string path of template directory which can be passed to cookiecutter.
+        """
+        with self.use(token, org, template, checkout) as template_dir:
+            return template_dir
+
+    @contextmanager
+    def use(self, token, org, template, checkout='main'):
+        """Method to return path to local copy of template repository which isn't removed until context ends.
+
+        Args:
+            token: string value of PAT
+            org: string name of GitHub Organization where template is placed
+            template: string name of template repository, e.g. from config.template
+            checkout: string with branch, tag or commit of template
+        Returns:
+            context manager with string path of template directory.
+        """
+        name = self.__template_name(template)
+        url = config.template_url.format(token=token, org=org, template=template)
+        sha = self.resolve(url, org, name, checkout)
+        key_dir = path_join(self.path, org, name, sha)
+        template_dir = path_join(key_dir, name)
+
+        with self.__lock:
+            self.__in_use[key_dir] = self.__in_use.get(key_dir, 0) + 1
+        try:
+            with self.__key_lock(key_dir):
+                if os.path.isdir(template_dir):
+                    logger.debug(f"Template {name} {checkout} ({sha}) taken from cache")
+                else:
+                    self.__fetch(url, checkout, sha, key_dir, name)
+                    self.evict()
+                os.utime(key_dir)
+            yield template_dir
+        finally:
+            with self.__lock:
+                self.__in_use[key_dir] -= 1
+                if not self.__in_use[key_dir]:
+                    del self.__in_use[key_dir]
+
+    @staticmethod
+    def commit_of(template_dir):
+        """Return commit sha of template directory returned by get."""
+        return os.path.basename(os.path.dirname(template_dir))
+
+    def resolve(self, url, org, name, checkout='main'):
+        """Method to resolve branch or tag of template repository into commit.
+
+        If remote can't be reached, last known commit for checkout is used.
+
+        Args:
+            url: string url of template repository
+            org: string name of GitHub Organization
+            name: string name of template
+            checkout: string with branch, tag or commit of template
+        Returns:
+            string with commit sha.
+        """
+        if SHA_PATTERN.match(checkout):
+            return checkout
+        refs_file = path_join(self.path, org, name, 'refs.json')
+        try:
+            out = self.__git('ls-remote', url, f'refs/heads/{checkout}', f'refs/tags/{checkout}', f'refs/tags/{checkout}^{{}}')
+        except subprocess.CalledProcessError as e:
+            known = self.__read_json(refs_file).get(checkout)
+            if known and os.path.isdir(path_join(self.path, org, name, known)):
+                logger.warning(f"Can't check template {name} on remote, last known commit {known} is used")
+                return known
+            raise e
+
+        refs = dict(reversed(line.split('\t')) for line in out.splitlines() if line)
+        sha = refs.get(f'refs/tags/{checkout}^{{}}') or refs.get(f'refs/heads/{checkout}') or refs.get(f'refs/tags/{checkout}')
+        if not sha:
+            logger.error(f"Template {name} has no branch or tag {checkout}")
+            raise ValueError(f"Template {name} has no branch or tag {checkout}")
+
+        with self.__lock:
+            known = self.__read_json(refs_file)
+            if known.get(checkout) != sha:
+                known[checkout] = sha
+                self.__write_json(refs_file, known)
+        return sha
+
+    def warm(self, token, org, checkout='main', types=None):
+        """Method to fill cache with templates, e.g. when Docker image is built.
+
+        Args:
+            token: string value of PAT
+            org: string name of GitHub Organization where templates are placed
+            checkout: string with branch, tag or commit of templates
+            types: list of Airee types [infra, app, workspace_data], default all from config.template
+        Returns:
+            dict with type and path of cached template.
+        """
+        types = types if types else list(config.template)
+        return {type: self.get(token, org, config.template[type], checkout) for type in types}
+
+    def evict(self):
+        """Method to remove templates not used longer than max_age and the oldest ones above max_size.
+
+        Returns:
+            list of removed directories.
+        """
+        entries = []
+        for org in self.__listdir(self.path):
+            for name in self.__listdir(path_join(self.path, org)):
+                for sha in self.__listdir(path_join(self.path, org, name)):
+                    if SHA_PATTERN.match(sha):
+                        key_dir = path_join(self.path, org, name, sha)
+                        entries.append([os.path.getmtime(key_dir), self.__size(key_dir), key_dir])
+
+        removed = []
+        now = time.time()
+        total = sum(entry[1] for entry in entries)
+        with self.__lock:
+            in_use = set(self.__in_use)
+        for mtime, size, key_dir in sorted(entries):
+            if key_dir in in_use or now - mtime < IN_USE_GRACE:
+                continue
+            if now - mtime > self.max_age or total > self.max_size:
+                shutil.rmtree(key_dir, ignore_errors=True)
+                total -= size
+                removed.append(key_dir)
+                logger.debug(f"Template {key_dir} removed from cache")
+        return removed
+
+    def __fetch(self, url, checkout, sha, key_dir, name):
+        """Method to fetch single commit of template into cache."""
+        tmp_dir = f'{key_dir}.tmp{secrets.token_urlsafe(6)}'
+        work_dir = path_join(tmp_dir, name)
+        os.makedirs(work_dir)
+        try:
+            self.__git('init', '-q', work_dir)
+            self.__git('-C', work_dir, 'fetch', '-q', '--depth', '1', url, sha)
+            self.__git('-C', work_dir, 'checkout', '-q', sha)
+            # template is rendered from files only, .git dir is not needed
+            shutil.rmtree(path_join(work_dir, '.git'))
+            try:
+                os.rename(tmp_dir, key_dir)
+            except OSError:
+                logger.debug(f"Template {name} ({sha}) was fetched in parallel")
+            logger.debug(f"Template {name} {checkout} ({sha}) fetched to cache")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def __key_lock(self, key):
+        """Return lock for given cache entry."""
+        with self.__lock:
+            return self.__key_locks.setdefault(key, threading.Lock())
+
+    def __git(self, *args):
+        """Run git command and return its output.
+
+        Token is masked in command of raised exception, so it's not visible in logs.
+        """
+        try:
+            return subprocess.run(['git', *args], check=True, capture_output=True, text=True).stdout
+        except subprocess.CalledProcessError as e:
+            cmd = [TOKEN_IN_URL.sub('//***@', arg) for arg in e.cmd]
+            logger.error(f"Command {' '.join(cmd[:2])} failed: {TOKEN_IN_URL.sub('//***@', e.stderr or '')}")
+            raise subprocess.CalledProcessError(e.returncode, cmd) from None
+
+    @staticmethod
+    def __template_name(template):
+        """Return template repository name without .git suffix."""
+        return template[:-len('.git')] if template.endswith('.git') else template
+
+    @staticmethod
+    def __listdir(path):
+        """Return content of directory or empty list if it does not exist."""
+        return os.listdir(path) if os.path.isdir(path) else []
+
+    @staticmethod
+    def __size(path):
+        """Return size in bytes of all files in directory."""
+        return sum(os.path.getsize(path_join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+    @staticmethod
+    def __read_json(path):
+        """Return content of json file or empty dict if it does not exist."""
+        if not os.path.isfile(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def __write_json(path, obj):
+        """Write json file atomically."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp{secrets.token_urlsafe(6)}'
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f, indent=2)
+        os.replace(tmp_path, path)
@@ -0,0 +1,273 @@
+"""Module to render cookiecutter templates in memory.
+
+cookiecutter writes rendered project on disk (inside os.chdir() to template directory), then git index
+reads and hashes all files again before commit. Module renders the same files with the same cookiecutter
+context and Jinja environment straight to memory and Gitrepo.commit_files writes them as blobs
+to object database of repository, so neither working tree nor index scan is needed. Rendering doesn't
+change working directory, so many templates can be rendered in parallel.
+
+Templates with pre_gen_project or post_gen_project hooks can change generated files,
+they are still rendered by cookiecutter on disk.
+
+Every template file is analysed once: Jinja AST of its path and content gives cookiecutter keys it
+depends on. Rendered file is cached by the values of only these keys, so static files (workflows,
+Terraform modules, assets) are rendered once for all workspaces and file which uses e.g. workspace name
+is rendered once per workspace. Files using extension tags, globals or filters which can be random
+(e.g. {% now %}, random_ascii_string, random) or including other templates are always rendered. The same bytes objects are returned for cached files,
+so Gitrepo.commit_files writes them once per repository (or once to BlobStore, if it's enabled).
+
+    Typical usege:
+
+    files = render_files(template_dir, extra_context={'repo_name': 'infra', 'workspace': name_of_workspace})
+    infra_git.commit_files(files, "Init commit")
+"""
+import config, util
+from collections import OrderedDict
+import json
+import logging
+import os
+import stat
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+cookiecutter = util.lazy_import('cookiecutter')
+cookiecutter_config = util.lazy_import('cookiecutter.config')
+cookiecutter_environment = util.lazy_import('cookiecutter.environment')
+cookiecutter_exceptions = util.lazy_import('cookiecutter.exceptions')
+cookiecutter_find = util.lazy_import('cookiecutter.find')
+cookiecutter_generate = util.lazy_import('cookiecutter.generate')
+cookiecutter_prompt = util.lazy_import('cookiecutter.prompt')
+binaryornot_check = util.lazy_import('binaryornot.check')
+jinja2 = util.lazy_import('jinja2')
+jinja2_defaults = util.lazy_import('jinja2.defaults')
+
+HOOKS = ('pre_gen_project', 'post_gen_project')
+# file depends on context in a way which can't be keyed by values of context, it's always rendered
+VOLATILE = None
+# context, Jinja globals and special variables which don't change rendered output between calls (lipsum is random)
+DETERMINISTIC_NAMES = {'cookiecutter', 'range', 'dict', 'cycler', 'joiner', 'namespace', 'loop', 'caller', 'varargs', 'kwargs'}
+# filters of cookiecutter extensions which don't change output between calls, other filters
+# of extensions can be random or use current time, e.g. shuffle
+DETERMINISTIC_FILTERS = {'jsonify', 'slugify'}
+VOLATILE_FILTERS = {'random', 'shuffle'}
+
+_lock = threading.Lock()
+_analysis = {}
+_rendered = OrderedDict()
+
+
+def has_hooks(template_dir):
+    """Return True if template has pre_gen_project or post_gen_project hook."""
+    hooks_dir = os.path.join(template_dir, 'hooks')
+    if not os.path.isdir(hooks_dir):
+        return False
+    # the same hook files as found by cookiecutter, backup files are skipped
+    return any(os.path.splitext(name)[0] in HOOKS and not name.endswith('~') for name in os.listdir(hooks_dir))
+
+
+def build_context(template_dir, extra_context=None, default_config=False):
+    """Return context of template, the same as built by cookiecutter without input.
+
+    Args:
+        template_dir: string path of template with cookiecutter.json
+        extra_context: dict with values which override defaults of template
+        default_config: bool flag to skip user cookiecutter config
+    Returns:
+        dict with "cookiecutter" context.
+    """
+    user_config = cookiecutter_config.get_user_config(default_config=default_config)
+    context = cookiecutter_generate.generate_context(
+        context_file=os.path.join(template_dir, 'cookiecutter.json'),
+        default_context=user_config['default_context'],
+        extra_context=extra_context,
+    )
+    context['cookiecutter'] = cookiecutter_prompt.prompt_for_config(context, no_input=True)
+    context['cookiecutter']['_template'] = template_dir
+    return context
+
+
+def render_files(template_dir, extra_context=None, default_config=False):
+    """Function to render files of cookiecutter template in memory.
+
+    Paths and content are rendered as by cookiecutter: binary files and paths from _copy_without_render
+    are copied without rendering, executable bit of template file is kept.
+
+    Args:
+        template_dir: string path of template with cookiecutter.json
+        extra_context: dict with values which override defaults of template
+        default_config: bool flag to skip user cookiecutter config
+    Returns:
+        dict with path of file relative to rendered project directory and tuple (bytes content, bool executable).
+        cookiecutter UndefinedVariableInTemplate is raised if template use undefined variable.
+    """
+    context = build_context(template_dir, extra_context, default_config)
+    project_dir = cookiecutter_find.find_template(template_dir)
+    cookiecutter_generate.ensure_dir_is_templated(os.path.basename(project_dir))
+    env = cookiecutter_environment.StrictEnvironment(context=context, keep_trailing_newline=True)
+    env.loader = jinja2.FileSystemLoader(project_dir)
+
+    files, hits = {}, 0
+    for root, dirs, names in os.walk(project_dir):
+        rel_root = os.path.relpath(root, project_dir)
+        # directories from _copy_without_render are copied with their names not rendered
+        copy_dirs = [d for d in dirs if cookiecutter_generate.is_copy_only_path(os.path.normpath(os.path.join(rel_root, d)), context)]
+        dirs[:] = [d for d in dirs if d not in copy_dirs]
+        for copy_dir in copy_dirs:
+            for copy_root, _, copy_names in os.walk(os.path.join(root, copy_dir)):
+                for name in copy_names:
+                    infile = os.path.join(copy_root, name)
+                    files[os.path.relpath(infile, project_dir)] = _read(infile)
+
+        for name in names:
+            infile = os.path.join(root, name)
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            copy_only = cookiecutter_generate.is_copy_only_path(rel_path, context)
+            identity, keys = analyze(env, infile, rel_path, copy_only)
+            cache_key = (identity, copy_only, _values(context, keys | {'_new_lines'})) if keys is not VOLATILE else None
+            rendered = _cached(cache_key)
+            if rendered is not None:
+                hits += 1
+            else:
+                rendered = _render(env, context, infile, rel_path, copy_only)
+                _store(cache_key, rendered)
+            outfile, entry = rendered
+            if outfile is None:
+                logger.debug(f"The resulting file name is empty: {rel_path}")
+                continue
+            files[outfile] = entry
+    logger.debug(f"{len(files)} files rendered in memory from {template_dir}, {hits} taken from render cache")
+    return {path.replace(os.path.sep, '/'): entry for path, entry in files.items()}
+
+
+def analyze(env, infile, rel_path, copy_only=False):
+    """Function to find cookiecutter keys which rendered path and content of template file depend on.
+
+    Result is cached by path, size, modification time and mode of file, so every file is parsed once.
+
+    Args:
+        env: Jinja environment of template, with extensions of template
+        infile: string path of template file
+        rel_path: string path of file relative to project directory of template, it's rendered as output path
+        copy_only: bool flag if file is copied without rendering
+    Returns:
+        tuple with identity of file and frozenset of keys, or VOLATILE if file must be always rendered.
+    """
+    st = os.stat(infile)
+    identity = (infile, st.st_size, st.st_mtime_ns, st.st_mode)
+    with _lock:
+        if identity in _analysis:
+            return identity, _analysis[identity]
+    keys = _keys(env.parse(rel_path))
+    if keys is not VOLATILE and not copy_only and not binaryornot_check.is_binary(infile):
+        with open(infile, 'r', encoding='utf-8') as f:
+            content_keys = _keys(env.parse(f.read()))
+        keys = keys | content_keys if content_keys is not VOLATILE else VOLATILE
+    with _lock:
+        _analysis[identity] = keys
+    return identity, keys
+
+
+def _keys(ast):
+    """Return frozenset of cookiecutter keys used in Jinja AST, VOLATILE if they can't be found."""
+    nodes = jinja2.nodes
+    if any(True for _ in ast.find_all((nodes.ExtensionAttribute, nodes.ImportedName, nodes.Include, nodes.Import, nodes.FromImport, nodes.Extends))):
+        # extension tags can be not deterministic (e.g. "now"), included templates are not analysed
+        return VOLATILE
+    filters = {node.name for node in ast.find_all(nodes.Filter)}
+    if filters & VOLATILE_FILTERS or filters - set(jinja2_defaults.DEFAULT_FILTERS) - DETERMINISTIC_FILTERS:
+        # random filters and filters of extensions, e.g. {{ items | random }}
+        return VOLATILE
+    # variables and macros defined in template
+    defined = {node.name for node in ast.find_all((nodes.Name, nodes.Macro)) if getattr(node, 'ctx', 'store') != 'load'}
+    if {node.name for node in ast.find_all(nodes.Name) if node.ctx == 'load'} - defined - DETERMINISTIC_NAMES:
+        # globals of Jinja and extensions, e.g. lipsum, random_ascii_string
+        return VOLATILE
+    keys, used = set(), 0
+    for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+        if isinstance(node.node, nodes.Name) and node.node.name == 'cookiecutter':
+            if isinstance(node, nodes.Getattr):
+                keys.add(node.attr)
+            elif isinstance(node.arg, nodes.Const):
+                keys.add(node.arg.value)
+            else:
+                return VOLATILE
+            used += 1
+    if used != sum(1 for node in ast.find_all(nodes.Name) if node.name == 'cookiecutter'):
+        # whole context is used, e.g. {% for key in cookiecutter %}
+        return VOLATILE
+    return frozenset(keys)
+
+
+def _values(context, keys):
+    """Return string with values of keys in context, part of render cache key."""
+    return json.dumps([[key, context['cookiecutter'].get(key)] for key in sorted(keys)], sort_keys=True, default=str)
+
+
+def _render(env, context, infile, rel_path, copy_only):
+    """Return tuple with output path (None if it's empty) and tuple (bytes content, bool executable) of file."""
+    try:
+        outfile = env.from_string(rel_path).render(**context)
+        if not os.path.basename(outfile):
+            return None, None
+        outfile = os.path.normpath(outfile).replace(os.path.sep, '/')
+        if copy_only or binaryornot_check.is_binary(infile):
+            return outfile, _read(infile)
+        content = env.get_template(rel_path.replace(os.path.sep, '/')).render(**context)
+        # Jinja renders "\n", it's replaced with newline written by cookiecutter
+        newline = _newline(infile, context)
+        if newline != '\n':
+            content = content.replace('\n', newline)
+        return outfile, (content.encode('utf-8'), _executable(infile))
+    except jinja2.exceptions.UndefinedError as err:
+        raise cookiecutter_exceptions.UndefinedVariableInTemplate(f"Unable to create file '{rel_path}'", err, context)
+
+
+def _cached(key):
+    """Return rendered file from render cache, None if it's not cached."""
+    if key is None:
+        return None
+    with _lock:
+        rendered = _rendered.get(key)
+        if rendered is not None:
+            _rendered.move_to_end(key)
+        return rendered
+
+
+def _store(key, rendered):
+    """Put rendered file to render cache, the least recently used files above config.render_cache_size are removed."""
+    if key is None or not config.render_cache_size:
+        return
+    with _lock:
+        _rendered[key] = rendered
+        while len(_rendered) > config.render_cache_size:
+            _rendered.popitem(last=False)
+
+
+def _read(path):
+    """Return content and executable flag of file copied without rendering."""
+    with open(path, 'rb') as f:
+        return f.read(), _executable(path)
+
+
+def _newline(path, context):
+    """Return newline which installed cookiecutter writes to file rendered from template file.
+
+    cookiecutter 1.x writes os.linesep, 2.x writes _new_lines from context or newline
+    of the first line of template file (os.linesep if it has no newline).
+    """
+    if int(cookiecutter.__version__.split('.')[0]) < 2:
+        return os.linesep
+    if context['cookiecutter'].get('_new_lines'):
+        return context['cookiecutter']['_new_lines']
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        f.readline()
+        return f.newlines or os.linesep
+
+
+def _executable(path):
+    """Return True if file is executable by owner."""
+    return bool(os.stat(path).st_mode & stat.S_IXUSR)
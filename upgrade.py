@@ -0,0 +1,318 @@
+"""Module to upgrade existing workspaces to new commit of templates.
+
+Every repository created from template has TEMPLATE_METADATA file with template commit and context.
+Template is rendered in memory with the same context at that commit (base) and at new commit (target),
+only paths which differ between base and target are checked out (sparse clone) and changed:
+- file not changed in repository (the same as base) is replaced with target,
+- file changed in repository is merged with "git merge-file", conflicting files are kept and reported,
+- file already equal to target is skipped.
+TEMPLATE_METADATA is moved to target commit only if there are no conflicts, so next upgrade
+tries conflicting files again. Repository with metadata at target commit is not cloned.
+
+Workspaces are upgraded with bounded pool of workers: first canary workspaces, then batches.
+Rollout stops when more than max_failures workspaces failed. Lease of workspace is held during upgrade,
+if repository was changed in meantime push is rejected and files are merged again with new content.
+
+    Typical usege:
+
+    results = upgrade_fleet(PAT, github_org, 'main', env='dev', canary=2, batch_size=20, workers=8)
+"""
+from airee_repos import Airee_gh_repo, TEMPLATE_METADATA, template_metadata
+from template_cache import TemplateCache
+import entrypoint_init
+import fleet
+import git_module
+import template_render
+import config, metrics, util
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from github.GithubException import GithubException
+from os.path import join as path_join
+import json
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+
+logger = logging.getLogger(__name__)
+logger.setLevel(config.log_lvl)
+logger.addHandler(config.ch)
+logger.propagate = False
+
+# the same order as repositories are created
+TYPES = ['workspace_data', 'app', 'infra']
+
+
+def diff_files(base, target):
+    """Return sorted list of paths which differ between two dicts with rendered files."""
+    return sorted(path for path in set(base) | set(target) if base.get(path) != target.get(path))
+
+
+def merge_file(ours, base, theirs):
+    """Function to merge change of template into file of repository.
+
+    Args:
+        ours: tuple (bytes content, bool executable) of file in repository, None if file doesn't exist
+        base: tuple with file rendered from template commit of repository, None if it wasn't rendered
+        theirs: tuple with file rendered from target commit of template, None if it isn't rendered
+    Returns:
+        tuple with merged file (None if file is removed) and bool conflict flag, file is ours if there is conflict.
+    """
+    if ours == theirs:
+        return ours, False
+    if ours == base:
+        return theirs, False
+    if ours is None or base is None or theirs is None or any(b'\0' in entry[0] for entry in (ours, base, theirs)):
+        return ours, True
+    executable = theirs[1] if ours[1] == base[1] else ours[1]
+    with tempfile.TemporaryDirectory(prefix='airee_merge') as tmp_dir:
+        names = []
+        for name, entry in (('ours', ours), ('base', base), ('theirs', theirs)):
+            with open(path_join(tmp_dir, name), 'wb') as f:
+                f.write(entry[0])
+            names.append(path_join(tmp_dir, name))
+        try:
+            r = subprocess.run(['git', 'merge-file', '-p', '-q', *names], capture_output=True)
+        except FileNotFoundError:
+            # git command line is not installed
+            return ours, True
+    if r.returncode != 0:
+        # number of conflicts, or negative value on error
+        return ours, True
+    return (r.stdout, executable), False
+
+
+def read_metadata(airee_repo, repo_gh):
+    """Return dict with TEMPLATE_METADATA of repository, None if repository has no metadata."""
+    try:
+        content, _ = airee_repo.get_file(repo_gh, TEMPLATE_METADATA)
+    except GithubException as e:
+        if e.status == 404:
+            return None
+        raise
+    return json.loads(content)
+
+
+def render(airee_repo, type, commit, context):
+    """Return dict with files of template rendered in memory at given commit, the same as by render_from_template."""
+    with airee_repo.template_cache.use(airee_repo.token, airee_repo.org, config.template[type], commit) as template_dir:
+        if template_render.has_hooks(template_dir):
+            raise ValueError(f"Template {config.template[type]} has hooks, it can't be upgraded in memory")
+        return template_render.render_files(template_dir, context, default_config=True)
+
+
+def _read_entry(repo_dir, path):
+    """Return tuple (bytes content, bool executable) of file in working tree, None if it doesn't exist."""
+    file_path = path_join(repo_dir, path)
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'rb') as f:
+        return f.read(), bool(os.stat(file_path).st_mode & stat.S_IXUSR)
+
+
+def merge_files(repo_dir, changed, base_files, target_files):
+    """Function to merge changed files of template into working tree of repository.
+
+    Args:
+        repo_dir: string path of cloned repository
+        changed: list of paths which differ between base and target
+        base_files: dict with files rendered from template commit of repository
+        target_files: dict with files rendered from target commit of template
+    Returns:
+        dict with files to write for Gitrepo.commit_files, list of paths to remove and list of conflicting paths.
+    """
+    writes, removes, conflicts = {}, [], []
+    for file_path in changed:
+        ours = _read_entry(repo_dir, file_path)
+        merged, conflict = merge_file(ours, base_files.get(file_path), target_files.get(file_path))
+        if conflict:
+            conflicts.append(file_path)
+        elif merged is None and ours is not None:
+            removes.append(file_path)
+        elif merged is not None and merged != ours:
+            writes[file_path] = merged
+    return writes, removes, conflicts
+
+
+@metrics.timed('upgrade_repo')
+def upgrade_repo(airee_repo, type, target, checkout='main', context=None, base=None, dry_run=False, attempts=3):
+    """Function to upgrade single repository of workspace to target commit of template.
+
+    Args:
+        airee_repo: Airee_gh_repo object of workspace
+        type: string with type ["infra", "app", "workspace_data"]
+        target: string sha of template commit
+        checkout: string branch or tag of template which target was resolved from
+        context: dict with cookiecutter context used if repository has no TEMPLATE_METADATA
+        base: string sha of template commit used if repository has no TEMPLATE_METADATA
+        dry_run: bool flag to only find changed paths
+        attempts: int max number of merges and pushes in case of concurrent changes of repository
+    Returns:
+        dict with result [current, planned, upgraded, conflict, skipped, failed] and changed and conflicting paths.
+    """
+    result = {'workspace': airee_repo.workspace, 'env': airee_repo.env, 'type': type}
+    repo_gh = airee_repo.get_airee_repo(type)
+    metadata = read_metadata(airee_repo, repo_gh)
+    if metadata is None:
+        if context is None or base is None:
+            result.update({'result': 'skipped', 'reason': f"{TEMPLATE_METADATA} not found, pass manifest and base commit"})
+            return result
+        metadata = {'commit': base, 'context': context}
+    result.update({'from': metadata['commit'], 'to': target})
+    if metadata['commit'] == target:
+        result['result'] = 'current'
+        return result
+
+    base_files = render(airee_repo, type, metadata['commit'], metadata['context'])
+    target_files = render(airee_repo, type, target, metadata['context'])
+    changed = diff_files(base_files, target_files)
+    result['changed'] = changed
+    if dry_run:
+        result['result'] = 'planned'
+        return result
+
+    path = util.get_tmp_path(f'upgrade_{type}')
+    try:
+        with entrypoint_init.temporary_git(airee_repo, repo_gh) as git_repo:
+            repo_dir = path_join(path, type)
+            # only changed files and metadata are downloaded if possible
+            git_repo.clone_cheapest(repo_dir, paths=changed + [TEMPLATE_METADATA])
+            for attempt in range(attempts):
+                writes, removes, conflicts = merge_files(repo_dir, changed, base_files, target_files)
+                if not conflicts:
+                    writes[TEMPLATE_METADATA] = (template_metadata(config.template[type], target, checkout, metadata['context']), False)
+                if not writes and not removes:
+                    break
+                if removes:
+                    git_repo.remove_files(removes)
+                git_repo.commit_files(writes, f"Upgrade template {config.template[type]} to {target[:7]}")
+                try:
+                    git_repo.push()
+                    break
+                except git_module.PushRejected:
+                    if attempt == attempts - 1:
+                        raise
+                    # repository was changed in meantime, files are merged again with new content
+                    logger.warning(f"Repository {type} was changed in meantime, syncing with remote")
+                    git_repo.sync()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    result.update({'result': 'conflict' if conflicts else 'upgraded', 'written': sorted(p for p in writes if p != TEMPLATE_METADATA), 'removed': removes, 'conflicts': conflicts})
+    return result
+
+
+def upgrade_workspace(airee_repo, workspace, env, types, targets, checkout='main', contexts=None, base=None, dry_run=False):
+    """Function to upgrade all repositories of single workspace.
+
+    Args:
+        airee_repo: Airee_gh_repo object shared by rollout
+        workspace: string with name of workspace
+        env: string with environment of workspace
+        types: list of repository types
+        targets: dict with type and target commit of template
+        checkout: string branch or tag of templates
+        contexts: dict with type and context used if repository has no TEMPLATE_METADATA
+        base: string sha of template commit used if repository has no TEMPLATE_METADATA
+        dry_run: bool flag to only find changed paths
+    Returns:
+        list of dicts with result per repository.
+    """
+    results = []
+    ws_repo = airee_repo.for_workspace(workspace, env)
+    with metrics.labels(workspace=workspace, env=env), entrypoint_init.workspace_leases.hold((airee_repo.org, workspace, env)):
+        for type in types:
+            try:
+                results.append(upgrade_repo(ws_repo, type, targets[type], checkout, (contexts or {}).get(type), base, dry_run))
+            # SystemExit is used by repository objects to report known errors
+            except (Exception, SystemExit) as e:
+                logger.error(f"Repository {type} of workspace {workspace} {env} not upgraded: {e!r}")
+                results.append({'workspace': workspace, 'env': env, 'type': type, 'result': 'failed', 'error': repr(e)})
+    return results
+
+
+def manifest_contexts(workspaces, token, ghorg, types):
+    """Return dict with (workspace, env) and dict with type and context built from manifest as by "create" command."""
+    contexts = {}
+    for workspace in workspaces:
+        args = fleet.create_args(workspace, token, ghorg)
+        kwargs = dict(zip(['workspace_data', 'app', 'infra'], entrypoint_init.create_kwargs(args)))
+        contexts[(args['workspace'], args['env'])] = {type: kwargs[type]['extra_context'] for type in types}
+    return contexts
+
+
+def upgrade_fleet(token, ghorg, checkout='main', types=None, env=None, match=None, workspaces=None, manifest=None, base=None,
+                  workers=None, canary=1, batch_size=None, max_failures=0, dry_run=False, report=None):
+    """Function to upgrade many workspaces to current commit of templates, canary workspaces first, then in batches.
+
+    Args:
+        token: string value of PAT
+        ghorg: string name of GitHub Organization
+        checkout: string branch or tag of templates
+        types: list of repository types, default all
+        env: string with environment, all environments if not passed
+        match: string with glob which workspace name need to match
+        workspaces: list of workspace names
+        manifest: list of dicts with workspaces from load_manifest, workspaces and their context for repositories without TEMPLATE_METADATA
+        base: string sha of template commit which repositories without TEMPLATE_METADATA were created from
+        workers: int number of workspaces upgraded in parallel, default config.batch_workers
+        canary: int number of workspaces upgraded before the others
+        batch_size: int number of workspaces upgraded in one batch after canary, all if not passed
+        max_failures: int number of failed workspaces after which rollout stops
+        dry_run: bool flag to only find changed paths
+        report: string path of json file where results will be written
+    Returns:
+        list of dicts with result per repository.
+    """
+    workers = workers if workers else config.batch_workers
+    types = types if types else TYPES
+    airee = Airee_gh_repo(token, None, org=ghorg)
+    contexts = manifest_contexts(manifest, token, ghorg, types) if manifest else {}
+    if manifest:
+        selected = sorted(ws for ws in contexts if (not env or ws[1] == env) and (not match or fnmatch(ws[0], match)) and (not workspaces or ws[0] in workspaces))
+    else:
+        selected = fleet.select_workspaces(airee, env, match, workspaces)
+    # branch is resolved once, so all workspaces are upgraded to the same commit
+    targets = {type: TemplateCache.commit_of(airee.template_cache.get(token, ghorg, config.template[type], checkout)) for type in types}
+    logger.info(f"Upgrade of {len(selected)} workspaces to " + ', '.join(f"{config.template[type]} {sha[:7]}" for type, sha in targets.items()))
+
+    stages = [selected[:canary]] if canary else []
+    rest = selected[canary:]
+    size = batch_size if batch_size else max(len(rest), 1)
+    stages += [rest[i:i + size] for i in range(0, len(rest), size)]
+
+    results, failed = [], 0
+    for number, stage in enumerate(stages):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            stage_results = list(executor.map(lambda ws: upgrade_workspace(airee, ws[0], ws[1], types, targets, checkout, contexts.get(ws), base, dry_run), stage))
+        failed += sum(1 for ws_results in stage_results if any(r['result'] == 'failed' for r in ws_results))
+        results += [r for ws_results in stage_results for r in ws_results]
+        logger.info(f"{'Canary' if canary and number == 0 else 'Batch'} of {len(stage)} workspaces finished, {failed} workspaces failed so far")
+        if failed > max_failures:
+            not_started = [ws for later in stages[number + 1:] for ws in later]
+            logger.error(f"Rollout stopped, {failed} workspaces failed, {len(not_started)} workspaces not started")
+            results += [{'workspace': ws, 'env': ws_env, 'type': type, 'result': 'not_started'} for ws, ws_env in not_started for type in types]
+            break
+
+    for r in results:
+        detail = {
+            'upgraded': lambda r: f"{r['from'][:7]} -> {r['to'][:7]} {len(r['written'])} written, {len(r['removed'])} removed",
+            'conflict': lambda r: f"{r['from'][:7]} -> {r['to'][:7]} conflicts: {', '.join(r['conflicts'])}",
+            'planned': lambda r: f"{r['from'][:7]} -> {r['to'][:7]} {', '.join(r['changed']) if r['changed'] else 'no files changed'}",
+            'current': lambda r: r['to'][:7],
+            'skipped': lambda r: r['reason'],
+            'failed': lambda r: r['error'],
+            'not_started': lambda r: '',
+        }[r['result']](r)
+        print(f"{r['result']}\t{r['workspace']}\t{r['env']}\t{r['type']}\t{detail}")
+    counts = {}
+    for r in results:
+        counts[r['result']] = counts.get(r['result'], 0) + 1
+    logger.info("Upgrade finished: " + ', '.join(f"{count} {key}" for key, count in sorted(counts.items())))
+
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+        logger.info(f"Report written to {report}")
+    return results
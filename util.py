@@ -1,7 +1,12 @@
 """Module with utility functions."""
-import config
+import config, metrics
+from contextlib import contextmanager
+import importlib
 import secrets
 import logging
+import sys
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 logger.setLevel(config.log_lvl)
@@ -12,4 +17,82 @@ def get_tmp_path(prefix):
     """Method generate path in /tmp/ with random sufix"""
     logging.debug(f"Generating temp path with prefix '{prefix}'")
     random_dir_sufix = secrets.token_urlsafe(10)
-    return f'/tmp/{prefix}{random_dir_sufix}'
\ No newline at end of file
+    return f'/tmp/{prefix}{random_dir_sufix}'
+
+
+class LazyModule:
+    """Proxy of module which is imported on first attribute access.
+
+    Heavy dependencies (cookiecutter, pygit2, PyGithub) are imported only by commands which use them,
+    so short commands and --help start fast. Import is guarded by lock, proxy can be shared by threads.
+
+    Attributes:
+        name: string full name of module, e.g. cookiecutter.main
+    """
+    def __init__(self, name):
+        """Create LazyModule object, module is not imported yet."""
+        self.name = name
+        self.__module = None
+        self.__lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            with self.__lock:
+                if self.__module is None:
+                    self.__module = importlib.import_module(self.name)
+        return getattr(self.__module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self.name}'{'' if self.__module is None else ' (imported)'}>"
+
+
+def lazy_import(name):
+    """Return module if it's already imported, otherwise proxy importing it on first use.
+
+    Args:
+        name: string full name of module
+    Returns:
+        module or LazyModule object.
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+
+class Leases:
+    """Class with per key leases held by operations in this process, e.g. per workspace.
+
+    Operations with the same key are executed one after another, operations with different keys in parallel.
+    Lock of key is kept only while lease is held or awaited, so number of locks doesn't grow with number of keys.
+    """
+    def __init__(self):
+        """Create Leases object without held leases."""
+        self.__locks = {}
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        """Method to hold lease of key until context ends, it waits while lease is held by other thread.
+
+        Args:
+            key: hashable key, e.g. tuple with organization, workspace and environment
+        """
+        with self.__lock:
+            entry = self.__locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            if not entry[0].acquire(blocking=False):
+                logger.debug(f"Waiting for lease of {key}")
+                start = time.perf_counter()
+                entry[0].acquire()
+                metrics.inc('airee_lease_waits_total')
+                metrics.inc('airee_lease_wait_seconds_total', time.perf_counter() - start)
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with self.__lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.__locks[key]
+